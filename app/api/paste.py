@@ -12,8 +12,11 @@ from api.decorators import optional_login_api
 import constants.api
 import database.attachment
 import database.paste
+import database.upload_session
 import database.user
 import util.cryptography
+import util.paste_unlock
+import util.pagination
 
 
 @app.route(PasteSubmitURI.path, methods=['POST'])
@@ -49,6 +52,35 @@ def submit_paste():
             constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE,
         )
 
+    is_attachment_size_invalid = [
+        attachment.get('size') is not None and (
+            not isinstance(attachment['size'], (int, long)) or
+            isinstance(attachment['size'], bool) or
+            attachment['size'] < 0
+        )
+        for attachment in data.get('attachments', [])
+    ]
+    if any(is_attachment_size_invalid):
+        return flask.jsonify(constants.api.INCOMPLETE_PARAMS_FAILURE), constants.api.INCOMPLETE_PARAMS_FAILURE_CODE
+
+    try:
+        # Reject attachments beyond the quotas before the paste is created
+        # The quotas count the decoded data, rather than the size declared by the client
+        database.attachment.check_attachment_quota(
+            [
+                database.attachment.get_decoded_size(attachment.get('data'))
+                for attachment in data.get('attachments', [])
+            ],
+            user_id=current_user.user_id if current_user.is_authenticated else None,
+        )
+    except AttachmentQuotaExceededException:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE),
+            constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE_CODE,
+        )
+    except:
+        return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
+
     try:
         new_paste = database.paste.create_new_paste(
             contents=data.get('contents'),
@@ -87,6 +119,244 @@ def submit_paste():
             for attachment in new_attachments
         ]
         return flask.jsonify(resp_data), constants.api.SUCCESS_CODE
+    except AttachmentQuotaExceededException:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE),
+            constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE_CODE,
+        )
+    except:
+        return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
+
+
+@app.route(PasteAttachmentUploadURI.path, methods=['POST'])
+def upload_paste_attachment():
+    """
+    Endpoint for adding an attachment to an existing paste, with the raw file data as the request body. Since the body
+    holds the file, the request parameters are supplied in the query string. The body is streamed to disk, so
+    attachments of any size can be uploaded without being buffered in memory, or encoded as base64.
+    The user can add an attachment to a paste in two ways:
+    (1) Supply the paste's deactivation token in the request, or
+    (2) Authenticate with an API key in the X-Api-Key header, and own the paste.
+    Unlike the other endpoints, the session cookie is not accepted: the body of this endpoint need not be JSON, so a
+    cross-site form could otherwise upload attachments on behalf of a logged-in user. The API key is not accepted in
+    the query string, where it would be recorded in access logs.
+    """
+    args = flask.request.args
+    if not args.get('paste_id') or not args.get('name'):
+        return flask.jsonify(constants.api.INCOMPLETE_PARAMS_FAILURE), constants.api.INCOMPLETE_PARAMS_FAILURE_CODE
+
+    if not config.ENABLE_PASTE_ATTACHMENTS:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE),
+            constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE_CODE,
+        )
+
+    max_size = int(config.MAX_ATTACHMENT_SIZE * 1000 * 1000)
+    if max_size and flask.request.content_length and flask.request.content_length > max_size:
+        # Reject the upload before reading any of the body, if the client declared its size
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE),
+            constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE,
+        )
+
+    try:
+        api_key = flask.request.headers.get(constants.api.API_KEY_HEADER)
+        user = database.user.get_user_by_api_key(api_key, active_only=True) if api_key else None
+
+        paste = database.paste.get_paste_by_id(util.cryptography.get_decid(args['paste_id']), active_only=True)
+        is_paste_owner = user is not None and paste.user_id == user.user_id
+        if not is_paste_owner and args.get('deactivation_token') != paste.deactivation_token:
+            return flask.jsonify(constants.api.AUTH_FAILURE), constants.api.AUTH_FAILURE_CODE
+
+        # Reject the upload before reading any of the body, if the client declared a size beyond the quotas
+        database.attachment.check_attachment_quota([flask.request.content_length or 0], paste_id=paste.paste_id)
+        attachment = database.attachment.create_new_attachment_from_stream(
+            paste_id=paste.paste_id,
+            file_name=args['name'],
+            mime_type=args.get('mime_type') or flask.request.mimetype or 'application/octet-stream',
+            stream=flask.request.stream,
+            max_size=max_size,
+        )
+        return flask.jsonify({
+            constants.api.RESULT: constants.api.RESULT_SUCCESS,
+            constants.api.MESSAGE: None,
+            'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+            'attachment': {
+                'name': attachment.file_name,
+                'size': attachment.file_size,
+                'mime_type': attachment.mime_type,
+            },
+        }), constants.api.SUCCESS_CODE
+    except UserDoesNotExistException:
+        return flask.jsonify(constants.api.AUTH_FAILURE), constants.api.AUTH_FAILURE_CODE
+    except (PasteDoesNotExistException, InvalidIDException):
+        return flask.jsonify(constants.api.NONEXISTENT_PASTE_FAILURE), constants.api.NONEXISTENT_PASTE_FAILURE_CODE
+    except AttachmentTooLargeException:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE),
+            constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE,
+        )
+    except AttachmentQuotaExceededException:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE),
+            constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE_CODE,
+        )
+    except:
+        return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
+
+
+@app.route(UploadSessionCreateURI.path, methods=['POST'])
+@require_form_args(['paste_id', 'name', 'size'])
+@optional_login_api
+def create_upload_session():
+    """
+    Endpoint for starting a resumable upload of an attachment to an existing paste. The attachment's chunks are then
+    sent to UploadSessionChunkURI, in any order and with any number of retries, and the upload is completed with
+    UploadSessionFinalizeURI.
+    The user can add an attachment to a paste in two ways:
+    (1) Supply the paste's deactivation token in the request, or
+    (2) Be currently logged in, and own the paste.
+    """
+    data = flask.request.get_json()
+
+    if not config.ENABLE_PASTE_ATTACHMENTS:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE),
+            constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE_CODE,
+        )
+
+    try:
+        file_size = int(data['size'])
+        if file_size < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        return flask.jsonify(constants.api.INCOMPLETE_PARAMS_FAILURE), constants.api.INCOMPLETE_PARAMS_FAILURE_CODE
+    if config.MAX_ATTACHMENT_SIZE > 0 and file_size > config.MAX_ATTACHMENT_SIZE * 1000 * 1000:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE),
+            constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE,
+        )
+
+    try:
+        paste = database.paste.get_paste_by_id(util.cryptography.get_decid(data['paste_id']), active_only=True)
+        is_paste_owner = current_user.is_authenticated and paste.user_id == current_user.user_id
+        if not is_paste_owner and data.get('deactivation_token') != paste.deactivation_token:
+            return flask.jsonify(constants.api.AUTH_FAILURE), constants.api.AUTH_FAILURE_CODE
+
+        upload_session = database.upload_session.create_upload_session(
+            paste_id=paste.paste_id,
+            file_name=data['name'],
+            file_size=file_size,
+            mime_type=data.get('mime_type') or 'application/octet-stream',
+        )
+        return flask.jsonify({
+            constants.api.RESULT: constants.api.RESULT_SUCCESS,
+            constants.api.MESSAGE: None,
+            'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+            'upload_session': upload_session.as_dict(),
+        }), constants.api.SUCCESS_CODE
+    except (PasteDoesNotExistException, InvalidIDException):
+        return flask.jsonify(constants.api.NONEXISTENT_PASTE_FAILURE), constants.api.NONEXISTENT_PASTE_FAILURE_CODE
+    except AttachmentTooLargeException:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE),
+            constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE,
+        )
+    except AttachmentQuotaExceededException:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE),
+            constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE_CODE,
+        )
+    except:
+        return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
+
+
+@app.route(UploadSessionStatusURI.path, methods=['GET', 'POST'])
+def upload_session_status(upload_token):
+    """
+    Endpoint for querying which chunks of a resumable upload have been received, e.g. to resume an interrupted upload.
+    """
+    try:
+        upload_session = database.upload_session.get_upload_session(upload_token)
+        received_chunks = database.upload_session.get_received_chunks(upload_session)
+        return flask.jsonify({
+            constants.api.RESULT: constants.api.RESULT_SUCCESS,
+            constants.api.MESSAGE: None,
+            'upload_session': upload_session.as_dict(),
+            'received_chunks': received_chunks,
+            'received_offsets': [chunk_index * upload_session.chunk_size for chunk_index in received_chunks],
+        }), constants.api.SUCCESS_CODE
+    except UploadSessionDoesNotExistException:
+        return (
+            flask.jsonify(constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE),
+            constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE_CODE,
+        )
+    except:
+        return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
+
+
+@app.route(UploadSessionChunkURI.path, methods=['PUT'])
+def upload_session_chunk(upload_token, chunk_index):
+    """
+    Endpoint for sending one chunk of a resumable upload, with the chunk's raw data as the request body. Sending a
+    chunk that was already received replaces it.
+    """
+    try:
+        upload_session = database.upload_session.get_upload_session(upload_token)
+        received_chunks = database.upload_session.write_upload_chunk(
+            upload_session,
+            int(chunk_index),
+            flask.request.stream,
+        )
+        return flask.jsonify({
+            constants.api.RESULT: constants.api.RESULT_SUCCESS,
+            constants.api.MESSAGE: None,
+            'received_chunks': received_chunks,
+        }), constants.api.SUCCESS_CODE
+    except UploadSessionDoesNotExistException:
+        return (
+            flask.jsonify(constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE),
+            constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE_CODE,
+        )
+    except (InvalidUploadChunkException, ValueError):
+        return flask.jsonify(constants.api.INVALID_UPLOAD_CHUNK_FAILURE), constants.api.INVALID_UPLOAD_CHUNK_FAILURE_CODE
+    except:
+        return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
+
+
+@app.route(UploadSessionFinalizeURI.path, methods=['POST'])
+def finalize_upload_session(upload_token):
+    """
+    Endpoint for completing a resumable upload once all of its chunks have been received, adding the attachment to
+    the paste.
+    """
+    try:
+        upload_session = database.upload_session.get_upload_session(upload_token)
+        attachment = database.upload_session.finalize_upload_session(upload_session)
+        return flask.jsonify({
+            constants.api.RESULT: constants.api.RESULT_SUCCESS,
+            constants.api.MESSAGE: None,
+            'paste_id': util.cryptography.get_id_repr(attachment.paste_id),
+            'attachment': {
+                'name': attachment.file_name,
+                'size': attachment.file_size,
+                'mime_type': attachment.mime_type,
+            },
+        }), constants.api.SUCCESS_CODE
+    except UploadSessionDoesNotExistException:
+        return (
+            flask.jsonify(constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE),
+            constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE_CODE,
+        )
+    except IncompleteUploadException:
+        return flask.jsonify(constants.api.INCOMPLETE_UPLOAD_FAILURE), constants.api.INCOMPLETE_UPLOAD_FAILURE_CODE
+    except PasteDoesNotExistException:
+        return flask.jsonify(constants.api.NONEXISTENT_PASTE_FAILURE), constants.api.NONEXISTENT_PASTE_FAILURE_CODE
+    except AttachmentQuotaExceededException:
+        return (
+            flask.jsonify(constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE),
+            constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE_CODE,
+        )
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
@@ -161,23 +431,33 @@ def paste_details():
     """
     data = flask.request.get_json()
     try:
-        paste = database.paste.get_paste_by_id(util.cryptography.get_decid(data['paste_id']), active_only=True)
-        attachments = database.attachment.get_attachments_for_paste(util.cryptography.get_decid(data['paste_id']), active_only=True)
+        paste, attachments, poster_username = database.paste.get_paste_details(
+            util.cryptography.get_decid(data['paste_id']),
+            active_only=True,
+        )
+        if paste.user_id and poster_username is None:
+            raise UserDoesNotExistException('No user with user_id {user_id} exists'.format(user_id=paste.user_id))
         paste_details_dict = paste.as_dict()
-        paste_details_dict['poster_username'] = 'Anonymous'
+        paste_details_dict['poster_username'] = poster_username or 'Anonymous'
         paste_details_dict['attachments'] = [
-            attachment.as_dict()
+            attachment.as_dict(paste_id_repr=paste_details_dict['paste_id_repr'])
             for attachment in attachments
         ]
-        if paste.user_id:
-            poster = database.user.get_user_by_id(paste.user_id)
-            paste_details_dict['poster_username'] = poster.username
-        if not paste.password_hash or (data.get('password') and paste.password_hash == util.cryptography.secure_hash(data.get('password'))):
-            return flask.jsonify({
+        is_paste_owner = current_user.is_authenticated and paste.user_id == current_user.user_id
+        unlock_token = None
+        if paste.password_hash and not is_paste_owner:
+            # A token from an earlier request saves hashing the password again
+            unlock_token = util.paste_unlock.unlock_paste(paste, data.get('password'))
+        if not paste.password_hash or is_paste_owner or unlock_token:
+            resp = flask.jsonify({
                 constants.api.RESULT: constants.api.RESULT_SUCCESS,
                 constants.api.MESSAGE: None,
                 'details': paste_details_dict,
-            }), constants.api.SUCCESS_CODE
+                'unlock_token': unlock_token,
+            })
+            if unlock_token:
+                util.paste_unlock.set_unlock_cookie(resp, paste, unlock_token)
+            return resp, constants.api.SUCCESS_CODE
         else:
             return flask.jsonify({
                 constants.api.RESULT: constants.api.RESULT_FAULURE,
@@ -198,51 +478,86 @@ def pastes_for_user():
     Get all pastes for the currently logged in user.
     """
     try:
+        include_contents = bool((flask.request.get_json() or {}).get('include_contents'))
         return flask.jsonify({
             constants.api.RESULT: constants.api.RESULT_SUCCESS,
             constants.api.MESSAGE: None,
-            'pastes': [
-                paste.as_dict()
-                for paste in database.paste.get_all_pastes_for_user(current_user.user_id, active_only=True)
-            ],
+            'pastes': _pastes_as_dicts(
+                database.paste.get_all_pastes_for_user(
+                    current_user.user_id,
+                    active_only=True,
+                    summary=not include_contents,
+                ),
+                include_contents,
+            ),
         }), constants.api.SUCCESS_CODE
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
 
 @app.route(RecentPastesURI.path, methods=['POST'])
-@require_form_args(['page_num', 'num_per_page'])
+@require_form_args(['num_per_page'])
 def recent_pastes():
     """
     Get details for the most recent pastes.
     """
     try:
         data = flask.request.get_json()
+        include_contents = bool(data.get('include_contents'))
+        pastes = database.paste.get_recent_pastes(
+            data.get('page_num', 0),
+            data['num_per_page'],
+            summary=not include_contents,
+            after=util.pagination.decode_cursor(data['cursor']) if data.get('cursor') else None,
+        )
         return flask.jsonify({
             constants.api.RESULT: constants.api.RESULT_SUCCESS,
             constants.api.MESSAGE: None,
-            'pastes': [
-                paste.as_dict() for paste in database.paste.get_recent_pastes(data['page_num'], data['num_per_page'])
-            ],
+            'pastes': _pastes_as_dicts(pastes, include_contents),
+            'next_cursor': util.pagination.encode_cursor(pastes[-1].post_time, pastes[-1].paste_id) if pastes else None,
         }), constants.api.SUCCESS_CODE
+    except InvalidCursorException:
+        return flask.jsonify(constants.api.INVALID_CURSOR_FAILURE), constants.api.INVALID_CURSOR_FAILURE_CODE
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
 
 @app.route(TopPastesURI.path, methods=['POST'])
-@require_form_args(['page_num', 'num_per_page'])
+@require_form_args(['num_per_page'])
 def top_pastes():
     """
     Get details for the top pastes.
     """
     try:
         data = flask.request.get_json()
+        include_contents = bool(data.get('include_contents'))
+        pastes = database.paste.get_top_pastes(
+            data.get('page_num', 0),
+            data['num_per_page'],
+            summary=not include_contents,
+            after=util.pagination.decode_cursor(data['cursor']) if data.get('cursor') else None,
+        )
         return flask.jsonify({
             constants.api.RESULT: constants.api.RESULT_SUCCESS,
             constants.api.MESSAGE: None,
-            'pastes': [
-                paste.as_dict() for paste in database.paste.get_top_pastes(data['page_num'], data['num_per_page'])
-            ],
+            'pastes': _pastes_as_dicts(pastes, include_contents),
+            'next_cursor': util.pagination.encode_cursor(pastes[-1].views, pastes[-1].paste_id) if pastes else None,
         }), constants.api.SUCCESS_CODE
+    except InvalidCursorException:
+        return flask.jsonify(constants.api.INVALID_CURSOR_FAILURE), constants.api.INVALID_CURSOR_FAILURE_CODE
     except:
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
+
+
+def _pastes_as_dicts(pastes, include_contents):
+    """
+    Represent a list of pastes as dictionaries, converting all of their IDs in a single batch.
+
+    :param pastes: List of models.Paste instances
+    :param include_contents: True to include the full contents of each paste; False to include only a summary
+    :return: List of dictionaries of paste properties
+    """
+    return [
+        paste.as_dict(include_contents=include_contents, id_repr=id_repr)
+        for paste, id_repr in zip(pastes, util.cryptography.get_id_reprs(paste.paste_id for paste in pastes))
+    ]
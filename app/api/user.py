@@ -132,6 +132,27 @@ def api_key_regenerate():
         return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
 
 
+@app.route(UserAttachmentUsageURI.path, methods=['POST'])
+@require_login_api
+def user_attachment_usage():
+    """
+    Get the total size and number of the attachments of the currently logged-in user's pastes, and the quotas that
+    apply to them.
+    """
+    try:
+        attachments_size, attachments_count = database.user.get_user_attachment_totals(current_user.user_id)
+        return flask.jsonify({
+            constants.api.RESULT: constants.api.RESULT_SUCCESS,
+            constants.api.MESSAGE: None,
+            'attachments_size': attachments_size,
+            'attachments_count': attachments_count,
+            'max_attachments_size': config.MAX_USER_ATTACHMENTS_SIZE * 1000 * 1000 or None,
+            'max_attachments_count': config.MAX_USER_ATTACHMENTS_COUNT or None,
+        }), constants.api.SUCCESS_CODE
+    except:
+        return flask.jsonify(constants.api.UNDEFINED_FAILURE), constants.api.UNDEFINED_FAILURE_CODE
+
+
 @app.route(CheckUsernameAvailabilityURI.path, methods=['POST'])
 @require_form_args(['username'])
 def check_username_availability():
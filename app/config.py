@@ -20,6 +20,14 @@ BUILD_ENVIRONMENT = constants.build_environment.PROD
 # If False, IDs will be displayed as regular, incrementing integers, e.g. 1, 2, 3, etc.
 USE_ENCRYPTED_IDS = False
 
+# Option to use short IDs rather than encrypted or integer IDs
+# Set this to True if you want paste IDs to be displayed as short, non-sequential base62 strings, e.g. 4VfRz0, which are
+# 6 characters long for the first 56 billion pastes, and 8 or 11 characters long beyond that. Short IDs are as hard to
+# enumerate as encrypted IDs, and are derived from ID_ENCRYPTION_KEY below. This takes precedence over
+# USE_ENCRYPTED_IDS; links with encrypted IDs keep working with short IDs, and vice versa, but links with integer IDs
+# stop working when either is enabled.
+USE_SHORT_IDS = False
+
 # Choose to allow paste attachments
 # This will allow for users to attach files and images to pastes. If disabled, the MAX_ATTACHMENT_SIZE and
 # ATTACHMENTS_DIR configuration constants will be ignored.
@@ -29,10 +37,159 @@ ENABLE_PASTE_ATTACHMENTS = True
 # Set this to 0 for an unlimited file size.
 MAX_ATTACHMENT_SIZE = 0
 
+# Attachment quotas per user and per paste, as a total size in MB and a number of attachments
+# Attachments that would take a user's pastes, or a single paste, beyond these totals are rejected. Anonymous pastes are
+# only subject to the per-paste quotas. Set any of these to 0 for no limit. Totals are kept up to date as attachments
+# are added and scrubbed; after upgrading an existing database, run build/recount_attachment_totals.py once to compute
+# the totals of existing attachments.
+MAX_USER_ATTACHMENTS_SIZE = 0
+MAX_USER_ATTACHMENTS_COUNT = 0
+MAX_PASTE_ATTACHMENTS_SIZE = 0
+MAX_PASTE_ATTACHMENTS_COUNT = 0
+
 # Location to store paste attachments
 # Please use an absolute path and ensure that it is writable by www-data.
 ATTACHMENTS_DIR = '/var/www/modern-paste-attachments'
 
+# Backend in which attachment files are stored
+# 'local' stores files in ATTACHMENTS_DIR. 's3' stores them in a bucket of Amazon S3 or an S3-compatible object store,
+# such as MinIO, so that web nodes need not share a filesystem; this requires boto3. Uploads in progress, attachment
+# segments, and attachments stored before the blob store was introduced are always kept in ATTACHMENTS_DIR.
+ATTACHMENT_STORAGE_BACKEND = 'local'
+
+# Bucket, and prefix of the object keys, in which attachment files are stored with the 's3' backend
+ATTACHMENT_S3_BUCKET = None
+ATTACHMENT_S3_PREFIX = ''
+
+# URL of an S3-compatible object store, e.g. 'http://localhost:9000' for MinIO; None for Amazon S3
+ATTACHMENT_S3_ENDPOINT_URL = None
+
+# Region of the bucket, and credentials with which it is accessed
+# Leave the credentials as None to use those of the environment, e.g. an instance profile.
+ATTACHMENT_S3_REGION = None
+ATTACHMENT_S3_ACCESS_KEY_ID = None
+ATTACHMENT_S3_SECRET_ACCESS_KEY = None
+
+# Size, in bytes, from which attachment files are uploaded to S3 in parts, several parts at a time
+# Each part but the last is ATTACHMENT_S3_MULTIPART_CHUNK_SIZE bytes, which S3 requires to be at least 5 MB, and up to
+# ATTACHMENT_S3_MAX_CONCURRENCY parts are uploaded in parallel.
+ATTACHMENT_S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+ATTACHMENT_S3_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+ATTACHMENT_S3_MAX_CONCURRENCY = 8
+
+# Number of levels of hashed subdirectories over which attachment files are spread
+# Each level is named after two hex characters of a hash; e.g. with 2 levels, a paste's files are stored under
+# ATTACHMENTS_DIR/pastes-2/3f/a2/<paste ID>/, so that no directory grows to millions of entries. Set this to 0 to store
+# each paste's directory directly in ATTACHMENTS_DIR. After changing this, run build/migrate_attachment_layout.py to
+# move existing files into the new layout.
+ATTACHMENTS_DIR_LEVELS = 2
+
+# Layouts, as numbers of levels, in which attachment files are looked up if they are missing from the current layout
+# This keeps files stored in an earlier layout available while build/migrate_attachment_layout.py moves them.
+ATTACHMENTS_DIR_FALLBACK_LEVELS = [0, 1]
+
+# Maximum size, in bytes, of an attachment stored inline in the database rather than in a file
+# Tiny attachments are stored in their database row, in the same transaction as the rest of the attachment, and are
+# served without touching the filesystem. Files larger than this are stored in ATTACHMENTS_DIR. Set this to 0 to store
+# every attachment in a file. This must not exceed the database's max_allowed_packet.
+ATTACHMENT_INLINE_MAX_FILE_SIZE = 16 * 1024
+
+# Pack small attachments into shared segment files
+# If True, attachment files of at most ATTACHMENT_SEGMENT_MAX_FILE_SIZE bytes are appended to large, append-only segment
+# files rather than stored in files of their own, which saves inodes and disk blocks and speeds up backups when most
+# attachments are small. Segments are only used with the 'local' ATTACHMENT_STORAGE_BACKEND. Space taken by attachments
+# of scrubbed pastes is reclaimed by database.segment.compact_attachment_segments.
+ENABLE_ATTACHMENT_SEGMENTS = False
+
+# Maximum size, in bytes, of an attachment file stored in a segment
+ATTACHMENT_SEGMENT_MAX_FILE_SIZE = 256 * 1024
+
+# Size, in bytes, beyond which a segment is sealed and appends go to a new segment
+ATTACHMENT_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# Fraction of a sealed segment's bytes that must no longer be referenced for compaction to rewrite the segment
+ATTACHMENT_SEGMENT_COMPACTION_THRESHOLD = 0.5
+
+# Size, in bytes, of the chunks in which attachments are sent with resumable uploads
+# Smaller chunks lose less progress when a connection drops, at the cost of more requests per upload.
+UPLOAD_SESSION_CHUNK_SIZE = 1024 * 1024
+
+# Largest attachment, in MB, that can be sent with a resumable upload when MAX_ATTACHMENT_SIZE is 0 (unlimited)
+# The partial file of a resumable upload is created at the attachment's stated size before any of it is received, so
+# this bounds the disk space that a single request can claim. Set this to 0 for no limit.
+UPLOAD_SESSION_MAX_FILE_SIZE = 1024
+
+# Number of seconds after which resumable uploads that have stopped receiving chunks are considered abandoned
+# Abandoned uploads are deleted by database.upload_session.scrub_abandoned_upload_sessions.
+UPLOAD_SESSION_MAX_IDLE_TIME = 24 * 60 * 60
+
+# Offload attachment downloads to the front-end web server
+# By default, attachment files are streamed to the client by the application. Set this to 'X-Sendfile' (Apache with
+# mod_xsendfile, lighttpd) or 'X-Accel-Redirect' (nginx) to instead respond with only a header naming the file, and let
+# the web server send the file itself. Set this to None to disable.
+ATTACHMENT_SENDFILE_HEADER = None
+
+# Internal location under which nginx serves ATTACHMENTS_DIR, e.g. '/protected-attachments/'
+# This is only relevant if ATTACHMENT_SENDFILE_HEADER above is 'X-Accel-Redirect'. The location should be marked
+# internal in the nginx configuration, so that attachments cannot be requested directly.
+ATTACHMENT_ACCEL_REDIRECT_PREFIX = '/protected-attachments/'
+
+# Buffer paste view counts in memory
+# If True, paste views are accumulated in an in-process buffer and written to the database in batches, rather than
+# with one write transaction per view. This greatly reduces write load for popular pastes, at the cost of view counts
+# lagging behind by up to VIEW_COUNT_FLUSH_INTERVAL seconds.
+ENABLE_VIEW_COUNT_BUFFER = False
+
+# Maximum number of seconds between writes of buffered view counts to the database
+# This is only relevant if ENABLE_VIEW_COUNT_BUFFER above is True.
+VIEW_COUNT_FLUSH_INTERVAL = 5
+
+# Number of buffered views (summed over all pastes) that triggers an early write to the database
+# This is only relevant if ENABLE_VIEW_COUNT_BUFFER above is True.
+VIEW_COUNT_MAX_BUFFERED_DELTA = 1000
+
+# Location of a local file to which buffered view counts are appended if they cannot be written to the database,
+# e.g. when the database is unreachable while a worker is shutting down. The file is replayed the next time a worker
+# starts. Please use an absolute path and ensure that it is writable by www-data. Set this to None to disable.
+# This is only relevant if ENABLE_VIEW_COUNT_BUFFER above is True.
+VIEW_COUNT_SPILL_FILE = None
+
+# Serve top pastes from an in-memory leaderboard
+# If True, each worker keeps a leaderboard of the TOP_PASTES_LEADERBOARD_SIZE most viewed pastes, which is updated as
+# views are counted and rebuilt from the database periodically, rather than sorting all pastes by views on every
+# request for the top pastes. Pages beyond the end of the leaderboard are still queried from the database.
+ENABLE_TOP_PASTES_LEADERBOARD = False
+
+# Number of pastes held in the top pastes leaderboard
+# This is only relevant if ENABLE_TOP_PASTES_LEADERBOARD above is True.
+TOP_PASTES_LEADERBOARD_SIZE = 100
+
+# Maximum number of seconds for which the top pastes leaderboard is served before being rebuilt from the database
+# Views counted by other workers, and pastes deactivated by other workers, are only reflected after a rebuild.
+# This is only relevant if ENABLE_TOP_PASTES_LEADERBOARD above is True.
+TOP_PASTES_LEADERBOARD_MAX_STALENESS = 60
+
+# Deactivate pastes as soon as they expire
+# If True, each worker runs a background thread that deactivates pastes at their expiry time and evicts them from
+# in-memory caches. Expired pastes are hidden by every query regardless of this setting; this only affects how soon
+# they are marked inactive in the database.
+ENABLE_EXPIRY_SCHEDULER = False
+
+# Number of seconds ahead for which the expiry scheduler holds paste expiry times in memory
+# This is only relevant if ENABLE_EXPIRY_SCHEDULER above is True.
+EXPIRY_SCHEDULER_HORIZON = 3600
+
+# Maximum number of pastes the expiry scheduler deactivates per UPDATE statement
+# This is only relevant if ENABLE_EXPIRY_SCHEDULER above is True.
+EXPIRY_SCHEDULER_BATCH_SIZE = 500
+
+# Maximum number of pastes or users deleted per transaction when scrubbing inactive and expired pastes and users
+SCRUB_CHUNK_SIZE = 1000
+
+# Number of seconds to pause between chunks when scrubbing inactive and expired pastes and users
+# Increase this to reduce the load that scrubbing a large backlog places on the database.
+SCRUB_CHUNK_INTERVAL = 0.1
+
 # Database host
 # Optionally change the host on which the MySQL server is running; defaults to the same server hosting the site.
 DATABASE_HOST = 'localhost'
@@ -62,15 +219,30 @@ ENABLE_USER_REGISTRATION = True
 # This is useful for private or internal installations that aren't intended for public use.
 REQUIRE_LOGIN_TO_PASTE = False
 
-# AES key for generating encrypted IDs
-# This is only relevant if USE_ENCRYPTED_IDS above is True. If not, this config parameter can be ignored.
+# Number of PBKDF2-HMAC-SHA256 iterations used to hash user and paste passwords
+# Higher values make stolen password hashes more expensive to crack, at the cost of more CPU time per login and per
+# view of a password-protected paste. Existing user password hashes are upgraded to this setting when the user next
+# logs in.
+PASSWORD_HASH_ITERATIONS = 100000
+
+# Number of seconds for which a password-protected paste stays unlocked once its password has been supplied
+# A correct password is answered with a signed unlock token, which is accepted in place of the password until it
+# expires or the paste's password is changed, so that the password is not hashed again on every request.
+PASTE_UNLOCK_TOKEN_LIFETIME = 3600
+
+# AES key for generating encrypted IDs, from which the key of short IDs is also derived
+# This is only relevant if USE_ENCRYPTED_IDS or USE_SHORT_IDS above is True. If not, this parameter can be ignored.
 # It is recommended, but not strictly required, for you to replace the string below with the output of os.urandom(32),
-# so that the encrypted IDs generated for the app are specific to this installation.
+# so that the encrypted and short IDs generated for the app are specific to this installation.
 ID_ENCRYPTION_KEY = '6\x80\x18\xdc\xcf \xad\x14U\xa7\x05X\x7f\x81\x01\xd5\x19i\xf3S;\xcaL\xcf\xe2\x8d\x82\x1a\x12\xd9}\x8c'
 
 # AES iv for CBC block cipher operation, advice as per key gen above
 ID_ENCRYPTION_IV = '1234567890123456'
 
+# Maximum number of recently converted IDs remembered in each direction, between decrypted and encrypted IDs
+# This is only relevant if USE_ENCRYPTED_IDS above is True. Set this to 0 to encrypt and decrypt every ID anew.
+ID_CACHE_SIZE = 10000
+
 # Flask session secret key
 # IMPORTANT NOTE: Open up a Python terminal, and replace the below with the output of os.urandom(32)
 # This secret key should be different for every installation of Modern Paste.
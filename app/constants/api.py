@@ -10,6 +10,9 @@ MESSAGE = 'message'
 FAILURE = 'failure'
 SUCCESS_CODE = 200
 
+# Request header carrying an API key, for endpoints whose request body is not JSON
+API_KEY_HEADER = 'X-Api-Key'
+
 
 # Predefined JSON responses
 # Ensure that the generic error responses documentation in app/templates/api_documentation.json is updated to reflect
@@ -73,6 +76,41 @@ PASTE_ATTACHMENT_TOO_LARGE_FAILURE = {
 }
 PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE = 414
 
+PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE = {
+    RESULT: RESULT_FAULURE,
+    MESSAGE: 'The attachments would exceed the attachment quota of the paste or of its owner.',
+    FAILURE: 'paste_attachment_quota_exceeded_failure',
+}
+PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE_CODE = 413
+
+NONEXISTENT_UPLOAD_SESSION_FAILURE = {
+    RESULT: RESULT_FAULURE,
+    MESSAGE: 'The requested upload session does not exist, or has already been finalized or expired',
+    FAILURE: 'nonexistent_upload_session_failure',
+}
+NONEXISTENT_UPLOAD_SESSION_FAILURE_CODE = 404
+
+INVALID_UPLOAD_CHUNK_FAILURE = {
+    RESULT: RESULT_FAULURE,
+    MESSAGE: 'The chunk index is out of range, or the chunk is not of the expected size',
+    FAILURE: 'invalid_upload_chunk_failure',
+}
+INVALID_UPLOAD_CHUNK_FAILURE_CODE = 400
+
+INCOMPLETE_UPLOAD_FAILURE = {
+    RESULT: RESULT_FAULURE,
+    MESSAGE: 'Not all chunks of the upload have been received',
+    FAILURE: 'incomplete_upload_failure',
+}
+INCOMPLETE_UPLOAD_FAILURE_CODE = 400
+
+INVALID_CURSOR_FAILURE = {
+    RESULT: RESULT_FAULURE,
+    MESSAGE: 'The pagination cursor is not valid',
+    FAILURE: 'invalid_cursor_failure',
+}
+INVALID_CURSOR_FAILURE_CODE = 400
+
 UNDEFINED_FAILURE = {
     RESULT: RESULT_FAULURE,
     MESSAGE: 'Undefined server-side failure',
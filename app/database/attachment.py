@@ -1,26 +1,48 @@
+import base64
 import errno
+import hashlib
 import os
+import tempfile
 
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import undefer
 from werkzeug.utils import secure_filename
 
 import config
 import database.paste
+import database.segment
 import models
+import util.storage
 from modern_paste import session
 from util.exception import *
 
 
+# Number of bytes read from an upload stream and written to disk at a time
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Number of bytes of a stored attachment read at a time when its contents are streamed
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+# Directory within config.ATTACHMENTS_DIR holding the content-addressed attachment blobs
+BLOBS_DIR = 'blobs'
+# Prefix of the directories within config.ATTACHMENTS_DIR holding the per-paste directories of each hashed layout
+PASTES_DIR = 'pastes'
+
+
 def create_new_attachment(paste_id, file_name, file_size, mime_type, file_data):
     """
     Create a new database entry for an attachment with the given file_name, associated with a particular paste ID.
+    Files of at most config.ATTACHMENT_INLINE_MAX_FILE_SIZE bytes are stored inline in the attachment's row. Other
+    files are stored in the content-addressed blob store, so a file identical to one already stored is not written
+    again; its blob simply gains a reference.
 
     :param paste_id: Paste ID to associate with this attachment
     :param file_name: Raw name of the file
-    :param file_size: Size of the file in bytes
+    :param file_size: Size of the file in bytes; None for the size of the decoded file data
     :param mime_type: MIME type of the file
-    :param file_data: Binary, base64-encoded file data
+    :param file_data: Binary, base64-encoded file data; the file is stored decoded
     :return: An instance of models.Attachment describing this attachment entry
     :raises PasteDoesNotExistException: If the associated paste does not exist
+    :raises AttachmentQuotaExceededException: If the attachment would exceed the quotas of the paste or its owner
     """
     # Add an entry into the database describing this file
     new_attachment = models.Attachment(
@@ -30,7 +52,24 @@ def create_new_attachment(paste_id, file_name, file_size, mime_type, file_data):
         mime_type=mime_type,
     )
 
-    _store_attachment_file(paste_id, file_data, new_attachment.hash_name)
+    attachment_binary_data = base64.b64decode(file_data or '')
+    if new_attachment.file_size is None:
+        new_attachment.file_size = len(attachment_binary_data)
+    try:
+        # The quotas are checked before anything is stored, and count the decoded data rather than the declared size
+        _account_attachment(paste_id, len(attachment_binary_data))
+        if is_inline_candidate(len(attachment_binary_data)):
+            # This will throw PasteDoesNotExistException if the paste ID does not exist or is invalid
+            database.paste.get_paste_by_id(paste_id, active_only=True)
+            new_attachment.data = attachment_binary_data
+        else:
+            new_attachment.blob_digest = hashlib.sha256(attachment_binary_data).hexdigest()
+            # The reference is taken before the file is written, so that the blob cannot be scrubbed in between
+            _acquire_blob(new_attachment.blob_digest, len(attachment_binary_data))
+            _store_attachment_file(paste_id, attachment_binary_data, new_attachment.blob_digest)
+    except:
+        session.rollback()
+        raise
 
     session.add(new_attachment)
     session.commit()
@@ -38,37 +77,702 @@ def create_new_attachment(paste_id, file_name, file_size, mime_type, file_data):
     return new_attachment
 
 
-def _store_attachment_file(paste_id, attachment_binary_data, attachment_hash_name):
+def create_new_attachment_from_stream(paste_id, file_name, mime_type, stream, max_size=None):
     """
-    Store the attachment on disk.
+    Create a new attachment from a stream of raw file data, e.g. the body of an upload request. The stream is copied to
+    disk in chunks of UPLOAD_CHUNK_SIZE bytes, so memory usage does not depend on the size of the file. The data is
+    written to a temporary file, which is only moved into the blob store (and the attachment recorded in the database)
+    once the entire stream has been read.
 
     :param paste_id: Paste ID to associate with this attachment
-    :param attachment_binary_data: Binary, base64-encoded data for this attachment to write to a file
-    :param attachment_hash_name: The hashed name of the attachment corresponding to the name of the attachment file
-                                 on disk
+    :param file_name: Raw name of the file
+    :param mime_type: MIME type of the file
+    :param stream: File-like object from which the raw file data is read
+    :param max_size: Maximum size of the file in bytes; None or 0 for no limit
+    :return: An instance of models.Attachment describing this attachment entry
+    :raises PasteDoesNotExistException: If the associated paste does not exist
+    :raises AttachmentTooLargeException: If the stream holds more than max_size bytes; reading stops as soon as the
+                                         limit is exceeded
+    :raises AttachmentQuotaExceededException: If the attachment would exceed the quotas of the paste or its owner
     """
-    # Create the file paths for storage
-    save_file_dir = '{attachments_dir}/{paste_id}'.format(
-        attachments_dir=config.ATTACHMENTS_DIR,
-        # This will throw PasteDoesNotExistException if the paste ID does not exist or is invalid
-        # This also protects against malicious users who specify an invalid paste ID
+    new_attachment = models.Attachment(
+        # This will throw PasteDoesNotExistException if the paste does not exist or is inactive
         paste_id=database.paste.get_paste_by_id(paste_id, active_only=True).paste_id,
+        file_name=secure_filename(file_name),
+        file_size=0,
+        mime_type=mime_type,
     )
-    save_file_path = '{save_file_dir}/{hash_name}'.format(
-        save_file_dir=save_file_dir,
-        hash_name=attachment_hash_name,
+
+    temp_file_descriptor, temp_file_path = tempfile.mkstemp(
+        prefix='upload-',
+        dir=_make_dir('{attachments_dir}/{blobs_dir}'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+            blobs_dir=BLOBS_DIR,
+        )),
     )
 
-    # Create the directory if it doesn't already exist
     try:
-        os.makedirs(save_file_dir)
+        digest = hashlib.sha256()
+        with os.fdopen(temp_file_descriptor, 'wb') as attachment_file:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                new_attachment.file_size += len(chunk)
+                if max_size and new_attachment.file_size > max_size:
+                    raise AttachmentTooLargeException(
+                        'The attachment exceeds the maximum size of {max_size} bytes'.format(max_size=max_size)
+                    )
+                digest.update(chunk)
+                attachment_file.write(chunk)
+        add_attachment_file(new_attachment, temp_file_path, digest=digest.hexdigest())
+    except:
+        session.rollback()
+        try:
+            os.remove(temp_file_path)
+        except OSError:
+            pass
+        raise
+
+    session.commit()
+
+    return new_attachment
+
+
+def add_attachment_file(new_attachment, file_path, digest=None):
+    """
+    Move a complete file into the blob store as the contents of a new attachment, and add the attachment to the
+    session. If a blob with identical contents already exists, the file is discarded and the existing blob gains a
+    reference instead. Files of at most config.ATTACHMENT_INLINE_MAX_FILE_SIZE bytes are read into the attachment's row
+    instead, and small files are appended to a segment rather than moved, if segments are enabled. The caller is
+    responsible for committing the session, or for rolling it back and removing the file if an exception is raised.
+
+    :param new_attachment: An instance of models.Attachment that has not yet been added to the session
+    :param file_path: Path to the file holding the attachment's raw contents, within config.ATTACHMENTS_DIR
+    :param digest: Hex SHA-256 digest of the file's contents, if already known; the file is hashed otherwise
+    :raises AttachmentQuotaExceededException: If the attachment would exceed the quotas of the paste or its owner
+    """
+    _account_attachment(new_attachment.paste_id, os.path.getsize(file_path))
+
+    if is_inline_candidate(os.path.getsize(file_path)):
+        with open(file_path, 'rb') as attachment_file:
+            new_attachment.data = attachment_file.read()
+        os.remove(file_path)
+        session.add(new_attachment)
+        return
+
+    if digest is None:
+        file_digest = hashlib.sha256()
+        with open(file_path, 'rb') as attachment_file:
+            for chunk in iter(lambda: attachment_file.read(UPLOAD_CHUNK_SIZE), ''):
+                file_digest.update(chunk)
+        digest = file_digest.hexdigest()
+
+    new_attachment.blob_digest = digest
+    file_size = os.path.getsize(file_path)
+    _acquire_blob(digest, file_size)
+
+    blob = _get_blob(digest)
+    storage_backend = util.storage.get_storage_backend()
+    if blob.segment_id is not None or storage_backend.exists(get_blob_file_path(digest)):
+        os.remove(file_path)
+    elif database.segment.is_segment_candidate(file_size):
+        with open(file_path, 'rb') as attachment_file:
+            blob.segment_id, blob.segment_offset = database.segment.append_to_segment(attachment_file.read())
+        os.remove(file_path)
+    else:
+        storage_backend.put_file(get_blob_file_path(digest), file_path)
+
+    session.add(new_attachment)
+
+
+def is_inline_candidate(file_size):
+    """
+    Check whether an attachment file should be stored inline in the database rather than on disk.
+
+    :param file_size: Size of the file in bytes
+    :return: True if inline attachments are enabled and the file is small enough to be stored inline
+    """
+    return bool(config.ATTACHMENT_INLINE_MAX_FILE_SIZE) and file_size <= config.ATTACHMENT_INLINE_MAX_FILE_SIZE
+
+
+def get_decoded_size(file_data):
+    """
+    Get the size of base64-encoded file data once decoded, without decoding it.
+
+    :param file_data: Binary, base64-encoded file data, or None
+    :return: Size of the decoded data in bytes
+    """
+    file_data = (file_data or '').rstrip('=')
+    return len(file_data) * 3 // 4
+
+
+def get_stored_size():
+    """
+    Get a SQL expression of the number of bytes an attachment takes in storage, which is what the attachment totals
+    count: the size of its blob or of its inline data, or, for attachments stored before either existed, its recorded
+    file size. Unlike the recorded file size, which may be declared by the client, this is the size of the data that
+    was actually stored.
+
+    :return: A SQL expression for use in queries of models.Attachment
+    """
+    blob_size = session.query(models.AttachmentBlob.file_size).filter(
+        models.AttachmentBlob.digest == models.Attachment.blob_digest,
+    ).correlate(models.Attachment).as_scalar()
+    return func.coalesce(blob_size, func.length(models.Attachment.data), models.Attachment.file_size)
+
+
+def check_attachment_quota(file_sizes, paste_id=None, user_id=None):
+    """
+    Check whether attachments can be added to a paste without exceeding the configured quotas, e.g. to reject an upload
+    before any of it is received. This only reads the precomputed totals of the paste and its owner; the quotas are
+    enforced again as each attachment is stored.
+
+    :param file_sizes: List of the sizes in bytes of the attachments to add
+    :param paste_id: ID of the paste to which the attachments are added; None for a paste that is yet to be created
+    :param user_id: ID of the user posting a paste that is yet to be created; ignored if paste_id is given
+    :raises AttachmentQuotaExceededException: If the attachments would exceed the quotas of the paste or its owner
+    :raises PasteDoesNotExistException: If the paste does not exist
+    """
+    paste_totals = (0, 0)
+    if paste_id is not None:
+        # The totals are updated without loading the rows, so any copies already loaded in the session may be stale
+        paste = models.Paste.query.filter_by(paste_id=paste_id).populate_existing().first()
+        if paste is None:
+            raise PasteDoesNotExistException('No paste with paste_id {paste_id} exists'.format(paste_id=paste_id))
+        paste_totals = (paste.attachments_size or 0, paste.attachments_count or 0)
+        user_id = paste.user_id
+    _check_totals(paste_totals, file_sizes, config.MAX_PASTE_ATTACHMENTS_SIZE, config.MAX_PASTE_ATTACHMENTS_COUNT, 'paste')
+
+    if user_id is not None:
+        user = models.User.query.filter_by(user_id=user_id).populate_existing().first()
+        if user is not None:
+            _check_totals(
+                (user.attachments_size or 0, user.attachments_count or 0),
+                file_sizes,
+                config.MAX_USER_ATTACHMENTS_SIZE,
+                config.MAX_USER_ATTACHMENTS_COUNT,
+                'user',
+            )
+
+
+def _check_totals(totals, file_sizes, max_size, max_count, owner):
+    """
+    Check whether adding attachments to precomputed totals would exceed a quota.
+
+    :param totals: Tuple of (total size in bytes, number of attachments)
+    :param file_sizes: List of the sizes in bytes of the attachments to add
+    :param max_size: Maximum total size in MB; 0 for no limit
+    :param max_count: Maximum number of attachments; 0 for no limit
+    :param owner: Description of the owner of the totals, for the exception message
+    :raises AttachmentQuotaExceededException: If the quota would be exceeded
+    """
+    total_size, total_count = totals
+    if max_size and total_size + sum(file_sizes) > max_size * 1000 * 1000:
+        raise AttachmentQuotaExceededException(
+            'The {owner}\'s attachments would exceed the quota of {max_size} MB'.format(owner=owner, max_size=max_size)
+        )
+    if max_count and total_count + len(file_sizes) > max_count:
+        raise AttachmentQuotaExceededException(
+            'The {owner}\'s attachments would exceed the quota of {max_count} attachments'.format(
+                owner=owner,
+                max_count=max_count,
+            )
+        )
+
+
+def _account_attachment(paste_id, file_size):
+    """
+    Add an attachment to the precomputed totals of its paste and of the paste's owner, enforcing the configured quotas.
+    Each total is checked and incremented by a single conditional UPDATE, so concurrent uploads cannot together exceed
+    a quota, and the totals are committed or rolled back together with the attachment.
+
+    :param paste_id: ID of the paste to which the attachment is added
+    :param file_size: Size of the attachment in bytes
+    :raises AttachmentQuotaExceededException: If the attachment would exceed the quotas of the paste or its owner
+    """
+    paste = models.Paste.query.filter_by(paste_id=paste_id).first()
+    if paste is None:
+        # The paste's existence is checked when the attachment is stored
+        return
+
+    if not _increment_totals(
+        models.Paste.query.filter_by(paste_id=paste_id),
+        models.Paste,
+        file_size,
+        config.MAX_PASTE_ATTACHMENTS_SIZE,
+        config.MAX_PASTE_ATTACHMENTS_COUNT,
+    ):
+        raise AttachmentQuotaExceededException('The paste\'s attachments would exceed the quota')
+    if paste.user_id is not None and not _increment_totals(
+        models.User.query.filter_by(user_id=paste.user_id),
+        models.User,
+        file_size,
+        config.MAX_USER_ATTACHMENTS_SIZE,
+        config.MAX_USER_ATTACHMENTS_COUNT,
+    ):
+        # Pastes of users that have since been deleted have no user totals to update
+        if models.User.query.filter_by(user_id=paste.user_id).count():
+            raise AttachmentQuotaExceededException('The user\'s attachments would exceed the quota')
+
+
+def _increment_totals(query, model, file_size, max_size, max_count):
+    """
+    Add an attachment to the precomputed totals of a paste or user, unless that would exceed a quota. Totals that have
+    not been computed yet, e.g. of rows created before the totals were introduced, count as zero.
+
+    :param query: Query selecting the row holding the totals
+    :param model: models.Paste or models.User
+    :param file_size: Size of the attachment in bytes
+    :param max_size: Maximum total size in MB; 0 for no limit
+    :param max_count: Maximum number of attachments; 0 for no limit
+    :return: True if the totals were incremented; False if the row does not exist, or the quota would be exceeded
+    """
+    total_size = func.coalesce(model.attachments_size, 0)
+    total_count = func.coalesce(model.attachments_count, 0)
+    if max_size:
+        query = query.filter(total_size + file_size <= max_size * 1000 * 1000)
+    if max_count:
+        query = query.filter(total_count < max_count)
+    return query.update({
+        model.attachments_size: total_size + file_size,
+        model.attachments_count: total_count + 1,
+    }, synchronize_session=False) > 0
+
+
+def recount_attachment_totals(chunk_size=None):
+    """
+    Recompute the precomputed attachment totals of every paste and user from their attachments, e.g. after upgrading a
+    database created before the totals were introduced. The rows are recounted in chunks of at most chunk_size, each
+    with a single UPDATE in its own transaction. This method is not intended to be called from within the application,
+    but rather externally either manually or via build/recount_attachment_totals.py.
+
+    :param chunk_size: Maximum number of pastes or users recounted per transaction; defaults to config.SCRUB_CHUNK_SIZE
+    :return: Dictionary of the number of pastes and users recounted
+    """
+    if chunk_size is None:
+        chunk_size = config.SCRUB_CHUNK_SIZE
+
+    paste_attachments = session.query(models.Attachment).filter(
+        models.Attachment.paste_id == models.Paste.paste_id,
+    ).correlate(models.Paste)
+    user_attachments = session.query(models.Attachment).join(
+        models.Paste,
+        models.Paste.paste_id == models.Attachment.paste_id,
+    ).filter(
+        models.Paste.user_id == models.User.user_id,
+    ).correlate(models.User)
+
+    return {
+        'recounted_pastes': _recount_totals(models.Paste, models.Paste.paste_id, paste_attachments, chunk_size),
+        'recounted_users': _recount_totals(models.User, models.User.user_id, user_attachments, chunk_size),
+    }
+
+
+def _recount_totals(model, key_column, attachments_query, chunk_size):
+    """
+    Recompute the attachment totals of every row of a table, in chunks in primary key order.
+
+    :param model: models.Paste or models.User
+    :param key_column: Primary key column of the model
+    :param attachments_query: Query selecting the attachments of a row, correlated with the model
+    :param chunk_size: Maximum number of rows recounted per transaction
+    :return: Number of rows recounted
+    """
+    recounted = 0
+    last_key = 0
+    while True:
+        keys = [
+            key for key, in session.query(key_column).filter(
+                key_column > last_key,
+            ).order_by(key_column).limit(chunk_size)
+        ]
+        if not keys:
+            return recounted
+
+        recounted += model.query.filter(key_column.in_(keys)).update({
+            model.attachments_size: attachments_query.with_entities(
+                func.coalesce(func.sum(get_stored_size()), 0),
+            ).as_scalar(),
+            model.attachments_count: attachments_query.with_entities(
+                func.count(models.Attachment.attachment_id),
+            ).as_scalar(),
+        }, synchronize_session=False)
+        session.commit()
+        last_key = keys[-1]
+
+
+def convert_legacy_attachment(attachment, file_path):
+    """
+    Move the contents of a legacy attachment, stored base64-encoded in a file of its own, into the blob store as raw
+    data, and point the attachment at the blob. The legacy file is left as it is, and the attachment refers to it until
+    the session is committed, so an interruption at any point leaves the attachment readable, and its file still
+    encoded. The caller is responsible for committing the session, and only then removing the legacy file.
+
+    :param attachment: An instance of models.Attachment whose contents are stored base64-encoded
+    :param file_path: Path to the legacy file holding the attachment's contents
+    """
+    with open(file_path, 'rb') as encoded_file:
+        attachment_binary_data = base64.b64decode(encoded_file.read())
+    blob_digest = hashlib.sha256(attachment_binary_data).hexdigest()
+    # The reference is taken before the file is written, so that the blob cannot be scrubbed in between
+    _acquire_blob(blob_digest, len(attachment_binary_data))
+    _store_blob(attachment_binary_data, blob_digest)
+    attachment.blob_digest = blob_digest
+    attachment.is_raw = True
+
+
+def get_attachment_segment(attachment):
+    """
+    Get the location of an attachment's contents if they are packed into a segment file.
+
+    :param attachment: An instance of models.Attachment
+    :return: Tuple of (path to the segment file, offset of the contents within it, length of the contents), or None if
+             the attachment is stored in a file of its own
+    """
+    if not attachment.blob_digest:
+        return None
+
+    # The blob may be moved to another segment by a concurrent compaction between looking up its location and reading
+    # it; in that case, the new location is looked up again
+    for _ in range(2):
+        blob = _get_blob(attachment.blob_digest)
+        if blob is None or blob.segment_id is None:
+            return None
+        segment_path = database.segment.get_segment_path(blob.segment_id)
+        if os.path.exists(segment_path):
+            break
+
+    return segment_path, blob.segment_offset, blob.file_size
+
+
+def iter_attachment_data(attachment, chunk_size=ATTACHMENT_CHUNK_SIZE):
+    """
+    Read an attachment's contents piece by piece, wherever they are stored: inline in the database, in a segment file,
+    in the storage backend, or in a legacy base64-encoded file. Nothing is read until the generator is first advanced.
+
+    :param attachment: An instance of models.Attachment
+    :param chunk_size: Largest number of bytes read at a time
+    :return: A generator of strings of the attachment's contents
+    """
+    if attachment.data is not None:
+        yield attachment.data
+        return
+
+    relative_file_path = resolve_attachment_file_path(attachment)
+    if not attachment.is_raw:
+        # Legacy files hold base64-encoded data, possibly wrapped across lines. Every 4 encoded bytes decode
+        # independently into 3 bytes, so whitespace is dropped and any incomplete group is carried into the next chunk.
+        with open('{attachments_dir}/{relative_file_path}'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+            relative_file_path=relative_file_path,
+        ), 'rb') as attachment_file:
+            leftover = ''
+            for encoded_chunk in iter(lambda: attachment_file.read(4 * (chunk_size // 3 or 1)), ''):
+                encoded_chunk = leftover + ''.join(encoded_chunk.split())
+                complete_length = len(encoded_chunk) - len(encoded_chunk) % 4
+                leftover = encoded_chunk[complete_length:]
+                if complete_length:
+                    yield base64.b64decode(encoded_chunk[:complete_length])
+            if leftover:
+                yield base64.b64decode(leftover)
+        return
+
+    segment = get_attachment_segment(attachment)
+    if segment is not None:
+        segment_path, segment_offset, remaining = segment
+        with open(segment_path, 'rb') as segment_file:
+            segment_file.seek(segment_offset)
+            while remaining > 0:
+                chunk = segment_file.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        return
+
+    if attachment.blob_digest:
+        attachment_file = util.storage.get_storage_backend().open(relative_file_path)
+    else:
+        # Attachments stored before the blob store was introduced are always kept in ATTACHMENTS_DIR
+        attachment_file = open('{attachments_dir}/{relative_file_path}'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+            relative_file_path=relative_file_path,
+        ), 'rb')
+    try:
+        for chunk in iter(lambda: attachment_file.read(chunk_size), ''):
+            yield chunk
+    finally:
+        attachment_file.close()
+
+
+def make_attachment_dir(paste_id):
+    """
+    Create the directory holding a paste's attachment files, if it doesn't already exist.
+
+    :param paste_id: Paste ID for which to create the attachment directory
+    :return: Path to the attachment directory
+    :raises PasteDoesNotExistException: If the paste does not exist or is inactive
+    """
+    return _make_dir('{attachments_dir}/{paste_dir}'.format(
+        attachments_dir=config.ATTACHMENTS_DIR,
+        # This will throw PasteDoesNotExistException if the paste ID does not exist or is invalid
+        # This also protects against malicious users who specify an invalid paste ID
+        paste_dir=get_paste_attachment_dir(database.paste.get_paste_by_id(paste_id, active_only=True).paste_id),
+    ))
+
+
+def _make_dir(dir_path):
+    """
+    Create a directory and its parents, if it doesn't already exist.
+
+    :param dir_path: Path to the directory
+    :return: Path to the directory
+    """
+    try:
+        os.makedirs(dir_path)
     except OSError as exception:
         if exception.errno != errno.EEXIST:
             raise
 
-    # Write the attachment's base64-encoded data to a file
-    with open(save_file_path, 'w') as attachment_file:
-        attachment_file.write(attachment_binary_data)
+    return dir_path
+
+
+def _acquire_blob(digest, file_size):
+    """
+    Take a reference to the blob with the given digest, creating its database entry if it does not yet exist. The
+    change is flushed, so that the blob's row stays locked against scrubbing until the session is committed.
+
+    :param digest: Hex SHA-256 digest of the file contents
+    :param file_size: Size of the file in bytes
+    """
+    def increment_ref_count():
+        return models.AttachmentBlob.query.filter_by(digest=digest).update(
+            {models.AttachmentBlob.ref_count: models.AttachmentBlob.ref_count + 1},
+            synchronize_session=False,
+        )
+
+    if increment_ref_count():
+        return
+
+    try:
+        # The insert is made within a savepoint, so that a conflict does not roll back the rest of the transaction
+        with session.begin_nested():
+            session.add(models.AttachmentBlob(digest=digest, file_size=file_size))
+    except IntegrityError:
+        # The same file was stored concurrently by another request, which created the blob first
+        increment_ref_count()
+
+
+def _get_blob(digest):
+    """
+    Load the current state of a blob from the database.
+
+    :param digest: Hex SHA-256 digest of the blob
+    :return: An instance of models.AttachmentBlob, or None if no such blob exists
+    """
+    return models.AttachmentBlob.query.filter_by(digest=digest).populate_existing().first()
+
+
+def _store_attachment_file(paste_id, attachment_binary_data, blob_digest):
+    """
+    Store the attachment in the storage backend, unless a file with identical contents is already stored. Small files
+    are packed into a segment file if segments are enabled.
+
+    :param paste_id: Paste ID to associate with this attachment
+    :param attachment_binary_data: Raw binary data for this attachment to write to a file
+    :param blob_digest: Hex SHA-256 digest of the attachment data, which names the blob file in storage
+    :raises PasteDoesNotExistException: If the associated paste does not exist
+    """
+    # This will throw PasteDoesNotExistException if the paste ID does not exist or is invalid
+    database.paste.get_paste_by_id(paste_id, active_only=True)
+    _store_blob(attachment_binary_data, blob_digest)
+
+
+def _store_blob(attachment_binary_data, blob_digest):
+    """
+    Store the contents of a blob in the storage backend or in a segment file, unless they are already stored.
+
+    :param attachment_binary_data: Raw binary data of the blob
+    :param blob_digest: Hex SHA-256 digest of the data, which names the blob file in storage
+    """
+    blob = _get_blob(blob_digest)
+    if blob is not None and blob.segment_id is not None:
+        return
+    storage_backend = util.storage.get_storage_backend()
+    if storage_backend.exists(get_blob_file_path(blob_digest)):
+        return
+
+    if blob is not None and database.segment.is_segment_candidate(len(attachment_binary_data)):
+        # Small files are appended to a segment; the location is committed together with the blob
+        blob.segment_id, blob.segment_offset = database.segment.append_to_segment(attachment_binary_data)
+        return
+
+    storage_backend.put(get_blob_file_path(blob_digest), attachment_binary_data)
+
+
+def get_paste_attachment_dir(paste_id, levels=None):
+    """
+    Get the path of the directory holding a paste's attachment files, relative to config.ATTACHMENTS_DIR.
+
+    :param paste_id: ID of the paste
+    :param levels: Number of levels of hashed subdirectories in the directory layout; defaults to the configured layout
+    :return: Relative path to the paste's attachment directory
+    """
+    if levels is None:
+        levels = config.ATTACHMENTS_DIR_LEVELS
+    if not levels:
+        return str(paste_id)
+
+    # Each layout has its own root directory, so that directories of different layouts never share a path, and
+    # removing a paste's directory in one layout cannot remove files stored in another
+    return '{pastes_dir}-{levels}/{fan_out}{paste_id}'.format(
+        pastes_dir=PASTES_DIR,
+        levels=levels,
+        fan_out=_get_fan_out(hashlib.md5(str(paste_id)).hexdigest(), levels),
+        paste_id=paste_id,
+    )
+
+
+def get_blob_file_path(digest, levels=None):
+    """
+    Get the path of a blob file, relative to config.ATTACHMENTS_DIR.
+
+    :param digest: Hex SHA-256 digest of the blob
+    :param levels: Number of levels of hashed subdirectories in the directory layout; defaults to the configured layout
+    :return: Relative path to the blob file
+    """
+    return '{blobs_dir}/{fan_out}{digest}'.format(
+        blobs_dir=BLOBS_DIR,
+        fan_out=_get_fan_out(digest, levels),
+        digest=digest,
+    )
+
+
+def get_attachment_file_path(attachment, levels=None):
+    """
+    Get the path of the file on disk holding an attachment's data, relative to config.ATTACHMENTS_DIR.
+
+    :param attachment: An instance of models.Attachment
+    :param levels: Number of levels of hashed subdirectories in the directory layout; defaults to the configured layout
+    :return: Relative path to the attachment file
+    """
+    if attachment.blob_digest:
+        return get_blob_file_path(attachment.blob_digest, levels)
+
+    return _get_paste_file_path(attachment.paste_id, attachment.hash_name, levels)
+
+
+def _get_paste_file_path(paste_id, hash_name, levels=None):
+    """
+    Get the path of a legacy attachment file stored in its paste's directory, relative to config.ATTACHMENTS_DIR.
+
+    :param paste_id: ID of the paste
+    :param hash_name: Name of the file within the paste's directory
+    :param levels: Number of levels of hashed subdirectories in the directory layout; defaults to the configured layout
+    :return: Relative path to the attachment file
+    """
+    return '{paste_dir}/{hash_name}'.format(
+        paste_dir=get_paste_attachment_dir(paste_id, levels),
+        hash_name=hash_name,
+    )
+
+
+def get_layout_levels():
+    """
+    Get the directory layouts in which attachment files may be stored, starting with the configured layout and followed
+    by the layouts in which files that have not yet been migrated are looked up.
+
+    :return: List of numbers of levels of hashed subdirectories
+    """
+    return [config.ATTACHMENTS_DIR_LEVELS] + [
+        levels for levels in config.ATTACHMENTS_DIR_FALLBACK_LEVELS
+        if levels != config.ATTACHMENTS_DIR_LEVELS
+    ]
+
+
+def resolve_file_path(get_relative_path):
+    """
+    Find a file that may still be stored in an earlier directory layout.
+
+    :param get_relative_path: Function of a number of levels of hashed subdirectories, returning the path of the file in
+                              that layout, relative to config.ATTACHMENTS_DIR
+    :return: Relative path to the file in the first layout in which it exists, or in the configured layout if it
+             exists in none
+    """
+    for levels in get_layout_levels():
+        relative_file_path = get_relative_path(levels)
+        if _file_exists(relative_file_path):
+            return relative_file_path
+
+    return get_relative_path(config.ATTACHMENTS_DIR_LEVELS)
+
+
+def resolve_attachment_file_path(attachment):
+    """
+    Get the path of the file holding an attachment's data, relative to config.ATTACHMENTS_DIR, looking the file up in
+    earlier directory layouts if it has not yet been migrated to the configured layout. For blobs, this is also the key
+    of the file in the storage backend.
+
+    :param attachment: An instance of models.Attachment
+    :return: Relative path to the attachment file
+    """
+    if attachment.blob_digest and not util.storage.get_storage_backend().is_local:
+        # Blobs in an object store were only ever stored in the configured layout
+        return get_blob_file_path(attachment.blob_digest)
+    relative_file_path = resolve_file_path(lambda levels: get_attachment_file_path(attachment, levels))
+    if attachment.blob_digest or _file_exists(relative_file_path):
+        return relative_file_path
+
+    # The name recorded with a legacy attachment is authoritative, but a file missing under it is also looked up under
+    # the name given by each naming scheme, in case the recorded name was made by the other scheme
+    for get_hash_name in [util.cryptography.hash_file_name, util.cryptography.secure_hash]:
+        hash_name = get_hash_name(attachment.file_name)
+        if hash_name == attachment.hash_name:
+            continue
+        candidate_file_path = resolve_file_path(
+            lambda levels: _get_paste_file_path(attachment.paste_id, hash_name, levels),
+        )
+        if _file_exists(candidate_file_path):
+            return candidate_file_path
+    return relative_file_path
+
+
+def _file_exists(relative_file_path):
+    """
+    Check whether a file exists in config.ATTACHMENTS_DIR.
+
+    :param relative_file_path: Path to the file, relative to config.ATTACHMENTS_DIR
+    :return: True if the file exists
+    """
+    return os.path.exists('{attachments_dir}/{relative_file_path}'.format(
+        attachments_dir=config.ATTACHMENTS_DIR,
+        relative_file_path=relative_file_path,
+    ))
+
+
+def remove_blob_file(digest):
+    """
+    Delete the file holding a blob from the storage backend, in every directory layout in which it may be stored.
+
+    :param digest: Hex SHA-256 digest of the blob
+    """
+    storage_backend = util.storage.get_storage_backend()
+    for levels in get_layout_levels() if storage_backend.is_local else [config.ATTACHMENTS_DIR_LEVELS]:
+        storage_backend.delete(get_blob_file_path(digest, levels))
+
+
+def _get_fan_out(key, levels):
+    """
+    Get the hashed subdirectories under which a file or directory is stored.
+
+    :param key: Hex string from which the subdirectory names are taken
+    :param levels: Number of levels of subdirectories; defaults to the configured layout
+    :return: Relative path of the subdirectories, with a trailing slash, or an empty string for no subdirectories
+    """
+    if levels is None:
+        levels = config.ATTACHMENTS_DIR_LEVELS
+    return ''.join('{prefix}/'.format(prefix=key[2 * level:2 * level + 2]) for level in range(levels))
 
 
 def get_attachment_by_id(attachment_id, active_only=False):
@@ -103,7 +807,8 @@ def get_attachment_by_name(paste_id, file_name, active_only=False):
     :raises PasteDoesNotExistException: If active_only is True and the paste is deactivated or nonexistent
     :raises AttachmentDoesNotExistException: If the attachment does not exist
     """
-    attachment = models.Attachment.query.filter_by(
+    # The contents of inline attachments are loaded with the row, so they can be served without another query
+    attachment = models.Attachment.query.options(undefer('data')).filter_by(
         paste_id=database.paste.get_paste_by_id(paste_id, active_only=active_only).paste_id,
         file_name=file_name,
     ).first()
@@ -0,0 +1,220 @@
+import heapq
+import os
+import threading
+import time
+
+import config
+import database.leaderboard
+import models
+from modern_paste import db
+
+
+class ExpiryScheduler:
+    """
+    In-process scheduler that deactivates pastes as soon as they expire.
+
+    The scheduler keeps a min-heap of (expiry_time, paste_id) pairs for the active pastes that expire within the next
+    horizon seconds, loaded from the database when it starts and extended as time passes. Newly created pastes are
+    pushed onto the heap as they are created. A background thread sleeps until the earliest expiry time, then
+    deactivates all pastes that have expired, at most batch_size per UPDATE statement, and evicts them from in-process
+    caches such as the top pastes leaderboard.
+
+    Deactivated pastes are physically removed later by the scrubber, as before.
+    """
+
+    def __init__(self, horizon, batch_size):
+        """
+        :param horizon: Number of seconds ahead of the current time for which expiry times are held in memory
+        :param batch_size: Maximum number of pastes deactivated per UPDATE statement
+        """
+        self.horizon = horizon
+        self.batch_size = batch_size
+
+        self._condition = threading.Condition()
+        self._heap = []
+        self._loaded_until = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+
+        self.deactivated_pastes = 0
+        self.batch_count = 0
+
+    def schedule(self, paste_id, expiry_time):
+        """
+        Schedule a paste to be deactivated at its expiry time. Expiry times beyond the currently loaded horizon are
+        ignored, since they will be loaded from the database once the horizon reaches them.
+
+        :param paste_id: ID of the paste
+        :param expiry_time: Unix time at which the paste expires, or None if it never expires
+        """
+        if expiry_time is None:
+            return
+        with self._condition:
+            if self._loaded_until is None or expiry_time > self._loaded_until:
+                return
+            heapq.heappush(self._heap, (expiry_time, paste_id))
+            if self._heap[0] == (expiry_time, paste_id):
+                # The new paste expires before everything else in the heap; wake the thread to shorten its sleep
+                self._condition.notify()
+
+    def load(self, until):
+        """
+        Load the expiry times of active pastes from the database onto the heap, up to a given time.
+
+        :param until: Unix time up to which expiry times should be loaded
+        """
+        with self._condition:
+            loaded_until = self._loaded_until
+        query = models.Paste.query.with_entities(
+            models.Paste.expiry_time,
+            models.Paste.paste_id,
+        ).filter(
+            models.Paste.is_active.is_(True),
+            models.Paste.expiry_time <= until,
+        )
+        if loaded_until is not None:
+            query = query.filter(models.Paste.expiry_time > loaded_until)
+        rows = query.all()
+        db.session.commit()
+
+        with self._condition:
+            for row in rows:
+                heapq.heappush(self._heap, tuple(row))
+            self._loaded_until = until
+            self._condition.notify()
+
+    def pop_expired(self, now):
+        """
+        Remove and return the IDs of all pastes in the heap that have expired.
+
+        :param now: Current Unix time
+        :return: List of the IDs of expired pastes
+        """
+        expired_paste_ids = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                expired_paste_ids.append(heapq.heappop(self._heap)[1])
+        return expired_paste_ids
+
+    def deactivate(self, paste_ids):
+        """
+        Deactivate a list of expired pastes in batches, and evict them from in-process caches.
+
+        :param paste_ids: List of IDs of the pastes to deactivate
+        :return: The number of pastes that were deactivated
+        """
+        deactivated_pastes = 0
+        for i in range(0, len(paste_ids), self.batch_size):
+            batch = paste_ids[i:i + self.batch_size]
+            with db.engine.begin() as connection:
+                deactivated_pastes += connection.execute(
+                    models.Paste.__table__.update().where(
+                        models.Paste.paste_id.in_(batch),
+                    ).where(
+                        models.Paste.is_active.is_(True),
+                    ).values(
+                        is_active=False,
+                    )
+                ).rowcount
+            self.batch_count += 1
+
+        if config.ENABLE_TOP_PASTES_LEADERBOARD:
+            leaderboard = database.leaderboard.get_top_pastes_leaderboard()
+            for paste_id in paste_ids:
+                leaderboard.remove(paste_id)
+
+        self.deactivated_pastes += deactivated_pastes
+        return deactivated_pastes
+
+    def run_pending(self):
+        """
+        Deactivate all pastes that have expired, first extending the loaded horizon if less than half of it remains.
+
+        :return: The number of pastes that were deactivated
+        """
+        now = time.time()
+        if self._loaded_until is None or self._loaded_until - now < self.horizon / 2.0:
+            self.load(now + self.horizon)
+        return self.deactivate(self.pop_expired(now))
+
+    def stats(self):
+        """
+        Counters describing the current state of the scheduler.
+
+        :return: Dictionary of heap depth and deactivation counts
+        """
+        with self._condition:
+            scheduled_pastes = len(self._heap)
+            next_expiry_time = self._heap[0][0] if self._heap else None
+        return {
+            'scheduled_pastes': scheduled_pastes,
+            'next_expiry_time': next_expiry_time,
+            'loaded_until': self._loaded_until,
+            'deactivated_pastes': self.deactivated_pastes,
+            'batch_count': self.batch_count,
+        }
+
+    def ensure_started(self):
+        """
+        Start the background thread, if it is not already running in this process. Threads do not survive a fork, so
+        this also detects when the scheduler is used from a forked worker process and reloads the heap in the worker.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._heap = []
+            self._loaded_until = None
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='paste-expiry-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """
+        Stop the background thread.
+        """
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify()
+
+    def _run(self):
+        """
+        Background scheduler loop.
+        """
+        while not self._stopped.is_set():
+            try:
+                self.run_pending()
+            except:
+                # Leave the pastes to the per-query expiry predicates and the scrubber until the next attempt
+                pass
+            with self._condition:
+                timeout = self.horizon / 2.0
+                if self._heap:
+                    timeout = min(timeout, max(self._heap[0][0] - time.time(), 0))
+                if timeout > 0:
+                    self._condition.wait(timeout)
+
+
+_expiry_scheduler = None
+_expiry_scheduler_lock = threading.Lock()
+
+
+def get_expiry_scheduler():
+    """
+    Get the process-wide expiry scheduler, creating it from the application configuration if necessary.
+
+    :return: The ExpiryScheduler instance for this process
+    """
+    global _expiry_scheduler
+    if _expiry_scheduler is None:
+        with _expiry_scheduler_lock:
+            if _expiry_scheduler is None:
+                _expiry_scheduler = ExpiryScheduler(
+                    horizon=config.EXPIRY_SCHEDULER_HORIZON,
+                    batch_size=config.EXPIRY_SCHEDULER_BATCH_SIZE,
+                )
+    return _expiry_scheduler
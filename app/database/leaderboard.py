@@ -0,0 +1,154 @@
+import bisect
+import threading
+import time
+
+from sqlalchemy import or_
+
+import config
+import models
+
+
+class TopPastesLeaderboard:
+    """
+    In-process, materialized leaderboard of the most viewed pastes.
+
+    The leaderboard holds the (views, paste_id) pairs of the top size active, non-expired pastes, sorted in descending
+    order, so that listings of top pastes need not sort the entire paste table on every request. It is kept current
+    incrementally from view counts recorded in this process, and is rebuilt from the database on the next read once it
+    is older than max_staleness seconds, which picks up views counted by other processes and drops pastes that have
+    since been deactivated.
+    """
+
+    def __init__(self, size, max_staleness):
+        """
+        :param size: Maximum number of pastes held in the leaderboard
+        :param max_staleness: Maximum age, in seconds, of the leaderboard before it is rebuilt from the database
+        """
+        self.size = size
+        self.max_staleness = max_staleness
+
+        self._lock = threading.Lock()
+        # Sort keys of (-views, -paste_id), so that the leaderboard can be searched in ascending order with bisect
+        self._keys = []
+        # Maps paste ID to a tuple of (views, expiry_time)
+        self._entries = {}
+        # True if the leaderboard holds every active paste, i.e. no paste has been left out to respect the size limit
+        self._complete = False
+        self._refreshed_at = None
+
+        self.refresh_count = 0
+
+    def refresh(self):
+        """
+        Rebuild the leaderboard from the database.
+        """
+        rows = models.Paste.query.with_entities(
+            models.Paste.paste_id,
+            models.Paste.views,
+            models.Paste.expiry_time,
+        ).filter_by(
+            is_active=True,
+        ).filter(
+            or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
+        ).order_by(
+            models.Paste.views.desc(),
+            models.Paste.paste_id.desc(),
+        ).limit(self.size).all()
+
+        with self._lock:
+            self._keys = [(-views, -paste_id) for paste_id, views, _ in rows]
+            self._entries = dict((paste_id, (views, expiry_time)) for paste_id, views, expiry_time in rows)
+            self._complete = len(rows) < self.size
+            self._refreshed_at = time.time()
+            self.refresh_count += 1
+
+    def is_stale(self):
+        """
+        Check whether the leaderboard needs to be rebuilt from the database.
+
+        :return: True if the leaderboard has never been built, or was last built more than max_staleness seconds ago
+        """
+        return self._refreshed_at is None or time.time() - self._refreshed_at > self.max_staleness
+
+    def record_views(self, paste_id, views, expiry_time=None):
+        """
+        Update the view count of a paste in the leaderboard, adding the paste if it now ranks among the top pastes.
+
+        :param paste_id: ID of the paste that was viewed
+        :param views: The paste's current number of views
+        :param expiry_time: The paste's expiry time, if any
+        """
+        with self._lock:
+            if self._refreshed_at is None:
+                # Nothing to update until the leaderboard is first built
+                return
+            if paste_id in self._entries:
+                self._keys.remove((-self._entries[paste_id][0], -paste_id))
+            elif not self._complete and self._keys and (-views, -paste_id) > self._keys[-1]:
+                # The paste ranks below the last paste in a leaderboard that is already full
+                return
+            bisect.insort(self._keys, (-views, -paste_id))
+            self._entries[paste_id] = (views, expiry_time)
+            while len(self._keys) > self.size:
+                _, evicted_paste_id = self._keys.pop()
+                del self._entries[-evicted_paste_id]
+                self._complete = False
+
+    def remove(self, paste_id):
+        """
+        Remove a paste from the leaderboard, e.g. when it is deactivated or expires.
+
+        :param paste_id: ID of the paste to remove
+        """
+        with self._lock:
+            if paste_id in self._entries:
+                self._keys.remove((-self._entries.pop(paste_id)[0], -paste_id))
+
+    def get_page(self, page_num, num_per_page, after=None):
+        """
+        Get a page of the top pastes from the leaderboard, rebuilding the leaderboard first if it is stale. Pastes that
+        have expired since the leaderboard was built are skipped.
+
+        :param page_num: The page number. Indexes from 0. Ignored if after is specified.
+        :param num_per_page: The number of pastes in this page
+        :param after: Tuple of (views, paste_id) of the last paste in the previous page (optional)
+        :return: A list of (paste_id, views) tuples sorted by number of views (descending), or None if the requested
+                 page extends past the end of the leaderboard and must be queried from the database instead
+        """
+        if self.is_stale():
+            self.refresh()
+
+        now = time.time()
+        with self._lock:
+            live_keys = [
+                key for key in self._keys
+                if self._entries[-key[1]][1] is None or self._entries[-key[1]][1] > now
+            ]
+            if after is not None:
+                start = bisect.bisect_right(live_keys, (-after[0], -after[1]))
+            else:
+                start = page_num * num_per_page
+            if start + num_per_page > len(live_keys) and not self._complete:
+                return None
+            return [(-neg_paste_id, -neg_views) for neg_views, neg_paste_id in live_keys[start:start + num_per_page]]
+
+
+_top_pastes_leaderboard = None
+_top_pastes_leaderboard_lock = threading.Lock()
+
+
+def get_top_pastes_leaderboard():
+    """
+    Get the process-wide top pastes leaderboard, creating it from the application configuration if necessary.
+
+    :return: The TopPastesLeaderboard instance for this process
+    """
+    global _top_pastes_leaderboard
+    if _top_pastes_leaderboard is None:
+        with _top_pastes_leaderboard_lock:
+            if _top_pastes_leaderboard is None:
+                _top_pastes_leaderboard = TopPastesLeaderboard(
+                    size=config.TOP_PASTES_LEADERBOARD_SIZE,
+                    max_staleness=config.TOP_PASTES_LEADERBOARD_MAX_STALENESS,
+                )
+    return _top_pastes_leaderboard
@@ -1,10 +1,16 @@
-import errno
-import shutil
 import time
 
+from sqlalchemy import and_
 from sqlalchemy import or_
+from sqlalchemy.orm import defer
+from sqlalchemy.orm import undefer_group
+from sqlalchemy.orm.attributes import set_committed_value
 
 import config
+import database.expiry
+import database.leaderboard
+import database.scrubber
+import database.view_buffer
 import models
 import util.cryptography
 from modern_paste import session
@@ -30,34 +36,40 @@ def create_new_paste(contents, user_id=None, expiry_time=None, title=None, langu
         expiry_time=int(expiry_time) if expiry_time is not None else None,
         title=title if title else 'Untitled',
         language=language or 'text',
-        password_hash=util.cryptography.secure_hash(password) if password is not None else None,
+        password_hash=util.cryptography.hash_password(password) if password is not None else None,
         is_api_post=is_api_post,
     )
     session.add(new_paste)
     session.commit()
+    if config.ENABLE_EXPIRY_SCHEDULER:
+        database.expiry.get_expiry_scheduler().schedule(new_paste.paste_id, new_paste.expiry_time)
     return new_paste
 
 
-def get_paste_by_id(paste_id, active_only=False):
+def get_paste_by_id(paste_id, active_only=False, refresh=False):
     """
     Get the specified paste by ID.
 
     :param paste_id: Paste ID to look up
     :param active_only: Set this flag to True to only query for active and non-expired pastes
+    :param refresh: Set this flag to True to overwrite an instance already in the session with the stored row
     :return: An instance of models.Paste representing the requested paste
     :raises PasteDoesNotExistException: If the paste does not exist
     """
     if active_only:
-        paste = models.Paste.query.filter_by(
+        query = models.Paste.query.filter_by(
             paste_id=paste_id,
             is_active=True,
         ).filter(
             or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
-        ).first()
+        )
     else:
-        paste = models.Paste.query.filter_by(
+        query = models.Paste.query.filter_by(
             paste_id=paste_id,
-        ).first()
+        )
+    if refresh:
+        query = query.populate_existing()
+    paste = query.first()
     if not paste:
         raise PasteDoesNotExistException(
             'No paste with paste_id {paste_id} exists, or is no longer active due to deactivation or expiry'.format(
@@ -67,6 +79,44 @@ def get_paste_by_id(paste_id, active_only=False):
     return paste
 
 
+def get_paste_details(paste_id, active_only=False):
+    """
+    Eagerly load everything needed to present a paste: the paste itself, its attachments, and the username of its
+    poster. The paste and poster are fetched together with a single outer join, and the attachments with one
+    additional query, rather than looking up the paste once per related entity.
+
+    :param paste_id: Paste ID to look up
+    :param active_only: Set this flag to True to only query for active and non-expired pastes
+    :return: A tuple of (models.Paste, list of models.Attachment, poster username). The poster username is None if the
+             paste was posted anonymously or if its poster no longer exists.
+    :raises PasteDoesNotExistException: If the paste does not exist
+    """
+    query = session.query(
+        models.Paste,
+        models.User.username,
+    ).outerjoin(
+        models.User,
+        models.User.user_id == models.Paste.user_id,
+    ).filter(
+        models.Paste.paste_id == paste_id,
+    )
+    if active_only:
+        query = query.filter(
+            models.Paste.is_active.is_(True),
+            or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
+        )
+    result = query.first()
+    if not result:
+        raise PasteDoesNotExistException(
+            'No paste with paste_id {paste_id} exists, or is no longer active due to deactivation or expiry'.format(
+                paste_id=paste_id
+            )
+        )
+    paste, poster_username = result
+    attachments = models.Attachment.query.filter_by(paste_id=paste.paste_id).all()
+    return paste, attachments, poster_username
+
+
 def is_paste_active(paste_id):
     """
     Check if this paste is active. The paste is considered active if it exists, has not been deactivated, and has not
@@ -90,7 +140,7 @@ def set_paste_password(paste_id, password):
     :raises PasteDoesNotExistException: If the paste does not exist
     """
     paste = get_paste_by_id(paste_id, active_only=True)
-    paste.password_hash = util.cryptography.secure_hash(password) if password is not None else None
+    paste.password_hash = util.cryptography.hash_password(password) if password is not None else None
     session.commit()
     return paste
 
@@ -106,6 +156,8 @@ def deactivate_paste(paste_id):
     paste = get_paste_by_id(paste_id)
     paste.is_active = False
     session.commit()
+    if config.ENABLE_TOP_PASTES_LEADERBOARD:
+        database.leaderboard.get_top_pastes_leaderboard().remove(paste.paste_id)
     return paste
 
 
@@ -117,67 +169,167 @@ def increment_paste_views(paste_id):
     :return: The models.Paste object representing the paste whose view was incremented
     :raises PasteDoesNotExistException: If the paste does not exist
     """
-    paste = get_paste_by_id(paste_id)
-    paste.views += 1
-    session.commit()
+    return count_paste_view(get_paste_by_id(paste_id, refresh=True))
+
+
+def view_paste(paste_id):
+    """
+    Hot path for displaying a paste: retrieve an active, non-expired paste and count a view on it. The active and
+    expiry checks are folded into the single SELECT of the paste row, and the view is counted against the row that was
+    just loaded, rather than fetching it again.
+
+    :param paste_id: ID of the paste being viewed
+    :return: An instance of models.Paste representing the viewed paste, including this view in its view count
+    :raises PasteDoesNotExistException: If the paste does not exist, is deactivated, or has expired
+    """
+    return count_paste_view(get_paste_by_id(paste_id, active_only=True, refresh=True))
+
+
+def count_paste_view(paste):
+    """
+    Count a view on a paste that has already been loaded, without fetching it again.
+
+    If config.ENABLE_VIEW_COUNT_BUFFER is set, the view is recorded in the in-process write-behind buffer and no
+    statement is issued at all; the paste's view count is then its stored count plus all views still buffered for it,
+    including this one. Otherwise, the view count is incremented in the database with a single atomic
+    UPDATE paste SET views = views + 1. In both cases, the paste's view count reflects this view without the row being
+    marked as modified, so that a later commit cannot overwrite the stored count with a stale absolute value.
+
+    :param paste: An instance of models.Paste representing the viewed paste, as loaded from the database
+    :return: The same models.Paste instance
+    """
+    if config.ENABLE_VIEW_COUNT_BUFFER:
+        buffered_views = database.view_buffer.buffer_paste_view(paste.paste_id)
+        set_committed_value(paste, 'views', paste.views + buffered_views)
+    else:
+        models.Paste.query.filter_by(
+            paste_id=paste.paste_id,
+        ).update({
+            models.Paste.views: models.Paste.views + 1,
+        }, synchronize_session=False)
+        session.commit()
+        set_committed_value(paste, 'views', paste.views + 1)
+    if config.ENABLE_TOP_PASTES_LEADERBOARD:
+        database.leaderboard.get_top_pastes_leaderboard().record_views(paste.paste_id, paste.views, paste.expiry_time)
     return paste
 
 
-def get_recent_pastes(page_num, num_per_page):
+def get_recent_pastes(page_num, num_per_page, summary=False, after=None):
     """
-    Get recently posted pastes that are active and not expired. This query is intended to be used in chunks,
-    indexed by page: e.g., results 0-4 appear on page 0, 5-9 appear on page 1, etc.
+    Get recently posted pastes that are active and not expired. This query is intended to be used in chunks, either
+    indexed by page (e.g., results 0-4 appear on page 0, 5-9 appear on page 1, etc.), or resuming after the last paste
+    of the previous chunk. The latter uses a range predicate rather than an offset, so it does not slow down as the
+    page number grows.
 
-    :param page_num: The page number. Indexes from 0.
+    :param page_num: The page number. Indexes from 0. Ignored if after is specified.
     :param num_per_page: The number of results to query for in this chunk (e.g., to display on this page).
+    :param summary: True to load only a summary of each paste's contents rather than the full contents
+    :param after: Tuple of (post_time, paste_id) of the last paste in the previous chunk (optional)
     :return: A list of models.Paste objects sorted by post time (descending) that are active and not expired.
     """
-    return models.Paste.query.filter_by(
+    query = _summary_query(summary).filter_by(
         is_active=True,
     ).filter(
         or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
     ).order_by(
         models.Paste.post_time.desc(),
-    ).offset(
-        page_num * num_per_page,
-    ).limit(
-        num_per_page,
-    ).all()
+        models.Paste.paste_id.desc(),
+    )
+    if after is not None:
+        return query.filter(_keyset_predicate(models.Paste.post_time, after)).limit(num_per_page).all()
+    return query.offset(page_num * num_per_page).limit(num_per_page).all()
 
 
-def get_top_pastes(page_num, num_per_page):
+def get_top_pastes(page_num, num_per_page, summary=False, after=None):
     """
     Get the top (most viewed) pastes that are active and not expired. This query is intended to be used in chunks,
-    indexed by page: e.g., results 0-4 appear on page 0, 5-9 appear on page 1, etc.
+    either indexed by page (e.g., results 0-4 appear on page 0, 5-9 appear on page 1, etc.), or resuming after the last
+    paste of the previous chunk. The latter uses a range predicate rather than an offset, so it does not slow down as
+    the page number grows.
 
-    :param page_num: The page number. Indexes from 0.
+    :param page_num: The page number. Indexes from 0. Ignored if after is specified.
     :param num_per_page: The number of results to query for in this chunk (e.g., to display on this page).
+    :param summary: True to load only a summary of each paste's contents rather than the full contents
+    :param after: Tuple of (views, paste_id) of the last paste in the previous chunk (optional)
     :return: A list of models.Paste objects sorted by number of views (descending) that are active and not expired.
     """
-    return models.Paste.query.filter_by(
+    if config.ENABLE_TOP_PASTES_LEADERBOARD:
+        top_paste_views = database.leaderboard.get_top_pastes_leaderboard().get_page(
+            page_num,
+            num_per_page,
+            after=after,
+        )
+        if top_paste_views is not None:
+            return _get_leaderboard_pastes(top_paste_views, summary)
+
+    query = _summary_query(summary).filter_by(
         is_active=True,
     ).filter(
         or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
     ).order_by(
         models.Paste.views.desc(),
-    ).offset(
-        page_num * num_per_page,
-    ).limit(
-        num_per_page,
-    ).all()
+        models.Paste.paste_id.desc(),
+    )
+    if after is not None:
+        return query.filter(_keyset_predicate(models.Paste.views, after)).limit(num_per_page).all()
+    return query.offset(page_num * num_per_page).limit(num_per_page).all()
+
+
+def _get_leaderboard_pastes(top_paste_views, summary):
+    """
+    Load the pastes listed in a page of the top pastes leaderboard, in leaderboard order. Pastes deactivated since the
+    leaderboard was built are left out, and the view count of each paste is taken from the leaderboard, so that it is
+    consistent with the order of the page.
+
+    :param top_paste_views: List of (paste_id, views) tuples from the leaderboard
+    :param summary: True to load only a summary of each paste's contents rather than the full contents
+    :return: A list of models.Paste objects sorted by number of views (descending)
+    """
+    if not top_paste_views:
+        return []
+    pastes_by_id = dict(
+        (paste.paste_id, paste)
+        for paste in _summary_query(summary).filter(
+            models.Paste.paste_id.in_([paste_id for paste_id, _ in top_paste_views]),
+        ).filter_by(
+            is_active=True,
+        )
+    )
+    top_pastes = []
+    for paste_id, views in top_paste_views:
+        if paste_id in pastes_by_id:
+            set_committed_value(pastes_by_id[paste_id], 'views', views)
+            top_pastes.append(pastes_by_id[paste_id])
+    return top_pastes
 
 
-def get_all_pastes_for_user(user_id, active_only=False):
+def _keyset_predicate(sort_column, after):
+    """
+    Range predicate selecting the pastes that follow a given paste in descending (sort_column, paste_id) order.
+
+    :param sort_column: Column by which the pastes are primarily sorted
+    :param after: Tuple of (sort column value, paste_id) of the paste after which to resume
+    :return: A SQLAlchemy filter expression
+    """
+    sort_value, paste_id = after
+    return or_(
+        sort_column < sort_value,
+        and_(sort_column == sort_value, models.Paste.paste_id < paste_id),
+    )
+
+
+def get_all_pastes_for_user(user_id, active_only=False, summary=False):
     """
     Gets all pastes for the specified user ID. Only return pastes that have not expired, and optionally filter by
     whether the paste is active.
 
     :param user_id: User ID for which to retrieve all the pastes
     :param active_only: Set this flag to True to only query for active and non-expired pastes
+    :param summary: True to load only a summary of each paste's contents rather than the full contents
     :return: A list of models.Paste objects belonging to the user ID (can be an empty list)
     """
     if active_only:
-        return models.Paste.query.filter_by(
+        return _summary_query(summary).filter_by(
             user_id=user_id,
             is_active=True,
         ).filter(
@@ -186,7 +338,7 @@ def get_all_pastes_for_user(user_id, active_only=False):
             models.Paste.post_time.desc(),
         ).all()
     else:
-        return models.Paste.query.filter_by(
+        return _summary_query(summary).filter_by(
             user_id=user_id,
         ).filter(
             or_(models.Paste.expiry_time.is_(None), models.Paste.expiry_time > time.time()),
@@ -195,36 +347,36 @@ def get_all_pastes_for_user(user_id, active_only=False):
         ).all()
 
 
-def scrub_inactive_pastes():
+def _summary_query(summary):
+    """
+    Base query for listings of pastes. In summary mode, the contents column is deferred, and the database computes a
+    bounded preview, line count, and byte size of the contents instead, so that the contents themselves are never
+    transferred.
+
+    :param summary: True to query for paste summaries; False to query for full pastes
+    :return: A query over models.Paste
+    """
+    if summary:
+        return models.Paste.query.options(defer('contents'), undefer_group('summary'))
+    return models.Paste.query
+
+
+def scrub_inactive_pastes(progress_callback=None):
     """
     Goes through the database and deletes all pastes that are either inactive or have expired. This method is not
     intended to be called from within the application, but rather externally either manually or via a script/cron job.
+    Pastes are deleted in chunks of config.SCRUB_CHUNK_SIZE, pausing for config.SCRUB_CHUNK_INTERVAL seconds between
+    chunks.
 
     For example, in a Python shell:
         > import database.paste
         > database.paste.scrub_inactive_pastes()
-    """
-    inactive_pastes = models.Paste.query.filter(or_(
-        models.Paste.is_active.is_(False),
-        models.Paste.expiry_time < time.time(),
-    ))
-    inactive_paste_ids = [paste.paste_id for paste in inactive_pastes]
-    if not inactive_paste_ids:
-        # No inactive pastes to scrub; quit without taking further action
-        return
-    inactive_attachments = models.Attachment.query.filter(
-        models.Attachment.paste_id.in_(inactive_paste_ids)
-    )
 
-    # Attempt to remove the attachment files, if they exist
-    for paste_id in inactive_paste_ids:
-        try:
-            shutil.rmtree('{attachment_dir}/{paste_id}'.format(attachment_dir=config.ATTACHMENTS_DIR, paste_id=paste_id))
-        except OSError as err:
-            if err.errno != errno.ENOENT:
-                raise
-
-    # Then, delete the database entries
-    inactive_pastes.delete(synchronize_session='fetch')
-    inactive_attachments.delete(synchronize_session='fetch')
-    session.commit()
+    :param progress_callback: Function called with the scrub's progress statistics after each chunk (optional)
+    :return: Dictionary of progress and throughput statistics; see database.scrubber.Scrubber.stats
+    """
+    return database.scrubber.Scrubber(
+        chunk_size=config.SCRUB_CHUNK_SIZE,
+        chunk_interval=config.SCRUB_CHUNK_INTERVAL,
+        progress_callback=progress_callback,
+    ).scrub_inactive_pastes()
@@ -0,0 +1,244 @@
+import errno
+import shutil
+import time
+
+from sqlalchemy import func
+from sqlalchemy import or_
+
+import config
+import database.attachment
+import database.leaderboard
+import models
+from modern_paste import session
+
+
+class Scrubber:
+    """
+    Batched deletion of inactive and expired pastes, and of inactive users.
+
+    Rather than loading every row to be deleted at once and removing them all in a single transaction, the IDs of the
+    rows to delete are streamed from the database in chunks of at most chunk_size, in primary key order. Each chunk is
+    deleted (together with its attachments) in its own short transaction, and the scrubber sleeps for chunk_interval
+    seconds between chunks, so that a large backlog of expired pastes can be scrubbed without holding long locks or
+    saturating the database.
+    """
+
+    def __init__(self, chunk_size, chunk_interval, progress_callback=None):
+        """
+        :param chunk_size: Maximum number of rows deleted per transaction
+        :param chunk_interval: Number of seconds to sleep between chunks
+        :param progress_callback: Function called with the scrubber's stats() after each chunk (optional)
+        """
+        self.chunk_size = chunk_size
+        self.chunk_interval = chunk_interval
+        self.progress_callback = progress_callback
+
+        self.chunk_count = 0
+        self.deleted_pastes = 0
+        self.deleted_attachments = 0
+        self.deleted_blobs = 0
+        self.deleted_users = 0
+        self.start_time = None
+        self.end_time = None
+
+    def scrub_inactive_pastes(self):
+        """
+        Delete all pastes that are either inactive or have expired, along with their attachments.
+
+        :return: Dictionary of progress and throughput statistics; see stats()
+        """
+        now = time.time()
+        self._start()
+        for paste_ids in self._iter_id_chunks(models.Paste.paste_id, or_(
+            models.Paste.is_active.is_(False),
+            models.Paste.expiry_time < now,
+        )):
+            self._delete_pastes(paste_ids)
+            self._end_chunk()
+        return self._finish()
+
+    def scrub_inactive_users(self):
+        """
+        Delete all users that are inactive, along with all of their pastes and the pastes' attachments.
+
+        :return: Dictionary of progress and throughput statistics; see stats()
+        """
+        self._start()
+        for user_ids in self._iter_id_chunks(models.User.user_id, models.User.is_active.is_(False)):
+            for paste_ids in self._iter_id_chunks(models.Paste.paste_id, models.Paste.user_id.in_(user_ids)):
+                self._delete_pastes(paste_ids)
+                self._end_chunk()
+            self.deleted_users += models.User.query.filter(
+                models.User.user_id.in_(user_ids),
+            ).delete(synchronize_session=False)
+            session.commit()
+            self._end_chunk()
+        return self._finish()
+
+    def stats(self):
+        """
+        Counters describing the progress and throughput of the current or most recent scrub.
+
+        :return: Dictionary of deletion counts, elapsed time, and deletion rate
+        """
+        if self.start_time is None:
+            elapsed_time = 0.0
+        else:
+            elapsed_time = (self.end_time or time.time()) - self.start_time
+        return {
+            'chunk_count': self.chunk_count,
+            'deleted_pastes': self.deleted_pastes,
+            'deleted_attachments': self.deleted_attachments,
+            'deleted_blobs': self.deleted_blobs,
+            'deleted_users': self.deleted_users,
+            'elapsed_time': elapsed_time,
+            'pastes_per_second': self.deleted_pastes / elapsed_time if elapsed_time else 0.0,
+        }
+
+    def _iter_id_chunks(self, id_column, criterion):
+        """
+        Stream the IDs of rows matching a criterion in ascending chunks. Each chunk is fetched with a range predicate on
+        the primary key, so that no more than one chunk of IDs is held in memory at a time, and so that each fetch is
+        an index range scan regardless of how many rows have already been deleted.
+
+        :param id_column: Primary key column of the table to scan
+        :param criterion: Filter expression selecting the rows of interest
+        :return: Generator of lists of at most chunk_size IDs, pausing for chunk_interval seconds between chunks
+        """
+        last_id = 0
+        while True:
+            ids = [
+                row_id for row_id, in session.query(id_column).filter(
+                    criterion,
+                    id_column > last_id,
+                ).order_by(
+                    id_column,
+                ).limit(self.chunk_size)
+            ]
+            # End the read transaction, so that the scan does not hold a snapshot open between chunks
+            session.commit()
+            if not ids:
+                return
+            yield ids
+            if len(ids) < self.chunk_size:
+                return
+            last_id = ids[-1]
+            if self.chunk_interval:
+                time.sleep(self.chunk_interval)
+
+    def _delete_pastes(self, paste_ids):
+        """
+        Delete a chunk of pastes and their attachments in a single transaction. Attachment files are removed first, so
+        that an error leaves the database rows in place for the next scrub to retry. Attachment blobs are shared between
+        pastes, so they are only removed once their last reference is deleted.
+
+        :param paste_ids: List of IDs of the pastes to delete
+        """
+        for paste_id in paste_ids:
+            # Attachment files may still be stored in an earlier directory layout
+            for levels in database.attachment.get_layout_levels():
+                try:
+                    shutil.rmtree('{attachments_dir}/{paste_dir}'.format(
+                        attachments_dir=config.ATTACHMENTS_DIR,
+                        paste_dir=database.attachment.get_paste_attachment_dir(paste_id, levels),
+                    ))
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+
+        blob_refs = session.query(
+            models.Attachment.blob_digest,
+            func.count(models.Attachment.attachment_id),
+        ).filter(
+            models.Attachment.paste_id.in_(paste_ids),
+            models.Attachment.blob_digest.isnot(None),
+        ).group_by(
+            models.Attachment.blob_digest,
+        ).all()
+        # The attachment totals of the pastes are deleted with them, but those of their owners must be decremented
+        user_totals = session.query(
+            models.Paste.user_id,
+            func.sum(database.attachment.get_stored_size()),
+            func.count(models.Attachment.attachment_id),
+        ).join(
+            models.Attachment,
+            models.Attachment.paste_id == models.Paste.paste_id,
+        ).filter(
+            models.Paste.paste_id.in_(paste_ids),
+            models.Paste.user_id.isnot(None),
+        ).group_by(
+            models.Paste.user_id,
+        ).all()
+        for user_id, attachments_size, attachments_count in user_totals:
+            models.User.query.filter_by(user_id=user_id).update({
+                models.User.attachments_size: func.coalesce(models.User.attachments_size, 0) - (attachments_size or 0),
+                models.User.attachments_count: func.coalesce(models.User.attachments_count, 0) - attachments_count,
+            }, synchronize_session=False)
+
+        self.deleted_attachments += models.Attachment.query.filter(
+            models.Attachment.paste_id.in_(paste_ids),
+        ).delete(synchronize_session=False)
+        self.deleted_pastes += models.Paste.query.filter(
+            models.Paste.paste_id.in_(paste_ids),
+        ).delete(synchronize_session=False)
+        self._release_blobs(blob_refs)
+        session.commit()
+
+        if config.ENABLE_TOP_PASTES_LEADERBOARD:
+            leaderboard = database.leaderboard.get_top_pastes_leaderboard()
+            for paste_id in paste_ids:
+                leaderboard.remove(paste_id)
+
+    def _release_blobs(self, blob_refs):
+        """
+        Drop references to attachment blobs, and delete the blobs that are no longer referenced by any attachment. The
+        blob rows stay locked by the reference count updates until the transaction is committed, so a blob cannot gain
+        a new reference between the check and the removal of its file.
+
+        :param blob_refs: List of (digest, number of references to drop) tuples
+        """
+        if not blob_refs:
+            return
+
+        for digest, ref_count in blob_refs:
+            models.AttachmentBlob.query.filter_by(digest=digest).update(
+                {models.AttachmentBlob.ref_count: models.AttachmentBlob.ref_count - ref_count},
+                synchronize_session=False,
+            )
+
+        unreferenced_digests = [
+            digest for digest, in session.query(models.AttachmentBlob.digest).filter(
+                models.AttachmentBlob.digest.in_([digest for digest, _ in blob_refs]),
+                models.AttachmentBlob.ref_count <= 0,
+            )
+        ]
+        for digest in unreferenced_digests:
+            database.attachment.remove_blob_file(digest)
+        if unreferenced_digests:
+            self.deleted_blobs += models.AttachmentBlob.query.filter(
+                models.AttachmentBlob.digest.in_(unreferenced_digests),
+            ).delete(synchronize_session=False)
+
+    def _start(self):
+        """
+        Reset the timer at the start of a scrub.
+        """
+        self.start_time = time.time()
+        self.end_time = None
+
+    def _end_chunk(self):
+        """
+        Record the completion of a chunk, and report progress.
+        """
+        self.chunk_count += 1
+        if self.progress_callback:
+            self.progress_callback(self.stats())
+
+    def _finish(self):
+        """
+        Stop the timer at the end of a scrub.
+
+        :return: Dictionary of progress and throughput statistics; see stats()
+        """
+        self.end_time = time.time()
+        return self.stats()
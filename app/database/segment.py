@@ -0,0 +1,208 @@
+import errno
+import fcntl
+import os
+import re
+import time
+
+from sqlalchemy import func
+
+import config
+import models
+import util.storage
+from modern_paste import session
+
+
+# Directory within config.ATTACHMENTS_DIR holding the attachment segment files
+SEGMENTS_DIR = 'segments'
+# Name of the file locked while appending to a segment, shared by all processes
+SEGMENTS_LOCK_FILE_NAME = '.lock'
+SEGMENT_FILE_NAME_PATTERN = re.compile(r'^(\d+)\.seg$')
+
+
+def is_segment_candidate(file_size):
+    """
+    Check whether an attachment file should be packed into a segment rather than stored in a file of its own.
+
+    :param file_size: Size of the file in bytes
+    :return: True if segments are enabled and the file is small enough to be packed
+    """
+    return (
+        config.ENABLE_ATTACHMENT_SEGMENTS and
+        # Segments are appended to in place, which object stores do not support
+        util.storage.get_storage_backend().is_local and
+        file_size <= config.ATTACHMENT_SEGMENT_MAX_FILE_SIZE
+    )
+
+
+def get_segment_path(segment_id):
+    """
+    Get the path of a segment file.
+
+    :param segment_id: ID of the segment
+    :return: Path to the segment file
+    """
+    return '{attachments_dir}/{segments_dir}/{segment_id:08d}.seg'.format(
+        attachments_dir=config.ATTACHMENTS_DIR,
+        segments_dir=SEGMENTS_DIR,
+        segment_id=segment_id,
+    )
+
+
+def get_segment_ids():
+    """
+    List the segments that exist on disk.
+
+    :return: Sorted list of segment IDs; the last one is the active segment, to which data is appended
+    """
+    try:
+        file_names = os.listdir('{attachments_dir}/{segments_dir}'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+            segments_dir=SEGMENTS_DIR,
+        ))
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return []
+
+    return sorted(
+        int(match.group(1))
+        for match in map(SEGMENT_FILE_NAME_PATTERN.match, file_names)
+        if match
+    )
+
+
+def append_to_segment(data):
+    """
+    Append data to the active segment, starting a new segment if the active one would grow beyond
+    config.ATTACHMENT_SEGMENT_SIZE. Appends are serialized across processes with an exclusive lock, and the data is
+    synced to disk before its location is returned, so that the location can safely be committed to the database.
+    Data that is appended but never committed is simply reclaimed by the next compaction.
+
+    :param data: String of bytes to append
+    :return: Tuple of (segment ID, offset of the data within the segment)
+    """
+    segments_dir = '{attachments_dir}/{segments_dir}'.format(
+        attachments_dir=config.ATTACHMENTS_DIR,
+        segments_dir=SEGMENTS_DIR,
+    )
+    try:
+        os.makedirs(segments_dir)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+    with open('{segments_dir}/{lock_file_name}'.format(
+        segments_dir=segments_dir,
+        lock_file_name=SEGMENTS_LOCK_FILE_NAME,
+    ), 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            segment_ids = get_segment_ids()
+            segment_id = segment_ids[-1] if segment_ids else 1
+            if segment_ids:
+                segment_size = os.path.getsize(get_segment_path(segment_id))
+                if segment_size > 0 and segment_size + len(data) > config.ATTACHMENT_SEGMENT_SIZE:
+                    segment_id += 1
+
+            with open(get_segment_path(segment_id), 'ab') as segment_file:
+                segment_file.seek(0, os.SEEK_END)
+                offset = segment_file.tell()
+                segment_file.write(data)
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    return segment_id, offset
+
+
+def read_segment(segment_id, offset, length):
+    """
+    Read data stored in a segment.
+
+    :param segment_id: ID of the segment
+    :param offset: Offset of the data within the segment
+    :param length: Number of bytes to read
+    :return: String of bytes
+    """
+    with open(get_segment_path(segment_id), 'rb') as segment_file:
+        segment_file.seek(offset)
+        return segment_file.read(length)
+
+
+def compact_attachment_segments(threshold=None, chunk_size=None):
+    """
+    Reclaim the space taken in segment files by blobs that are no longer referenced, e.g. the attachments of scrubbed
+    pastes. Each sealed segment in which at least a threshold fraction of the bytes is no longer referenced is
+    rewritten: its live blobs are appended to the active segment, and their locations updated, one chunk of blobs per
+    transaction, after which the old segment file is deleted. This method is not intended to be called from within the
+    application, but rather externally either manually or via a script/cron job.
+
+    For example, in a Python shell:
+        > import database.segment
+        > database.segment.compact_attachment_segments()
+
+    :param threshold: Fraction of unreferenced bytes beyond which a segment is rewritten; defaults to
+                      config.ATTACHMENT_SEGMENT_COMPACTION_THRESHOLD
+    :param chunk_size: Maximum number of blobs moved per transaction; defaults to config.SCRUB_CHUNK_SIZE
+    :return: Dictionary of the number of segments compacted, blobs moved, and bytes reclaimed
+    """
+    if threshold is None:
+        threshold = config.ATTACHMENT_SEGMENT_COMPACTION_THRESHOLD
+    if chunk_size is None:
+        chunk_size = config.SCRUB_CHUNK_SIZE
+
+    stats = {
+        'compacted_segments': 0,
+        'moved_blobs': 0,
+        'reclaimed_bytes': 0,
+        'elapsed_time': 0.0,
+    }
+    start_time = time.time()
+
+    live_bytes = dict(
+        session.query(
+            models.AttachmentBlob.segment_id,
+            func.sum(models.AttachmentBlob.file_size),
+        ).filter(
+            models.AttachmentBlob.segment_id.isnot(None),
+        ).group_by(
+            models.AttachmentBlob.segment_id,
+        ).all()
+    )
+    session.commit()
+
+    # The active segment is never compacted, since data is still being appended to it
+    for segment_id in get_segment_ids()[:-1]:
+        segment_size = os.path.getsize(get_segment_path(segment_id))
+        segment_live_bytes = int(live_bytes.get(segment_id) or 0)
+        if segment_size == 0 or (segment_size - segment_live_bytes) < threshold * segment_size:
+            continue
+
+        while True:
+            blobs = models.AttachmentBlob.query.filter_by(segment_id=segment_id).limit(chunk_size).all()
+            if not blobs:
+                break
+            for blob in blobs:
+                new_segment_id, new_segment_offset = append_to_segment(
+                    read_segment(segment_id, blob.segment_offset, blob.file_size)
+                )
+                # The blob may have been scrubbed in the meantime, in which case the copy is garbage for a later run
+                stats['moved_blobs'] += models.AttachmentBlob.query.filter_by(
+                    digest=blob.digest,
+                    segment_id=segment_id,
+                    segment_offset=blob.segment_offset,
+                ).update({
+                    models.AttachmentBlob.segment_id: new_segment_id,
+                    models.AttachmentBlob.segment_offset: new_segment_offset,
+                }, synchronize_session=False)
+            session.commit()
+            # Blobs loaded in this chunk now have stale locations
+            session.expire_all()
+
+        os.remove(get_segment_path(segment_id))
+        stats['compacted_segments'] += 1
+        stats['reclaimed_bytes'] += segment_size - segment_live_bytes
+
+    stats['elapsed_time'] = time.time() - start_time
+    return stats
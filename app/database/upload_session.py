@@ -0,0 +1,250 @@
+import errno
+import os
+import time
+
+from werkzeug.utils import secure_filename
+
+import config
+import database.attachment
+import database.paste
+import models
+from modern_paste import session
+from util.exception import *
+
+
+def create_upload_session(paste_id, file_name, file_size, mime_type):
+    """
+    Start a resumable upload of an attachment to a paste. The attachment is uploaded in chunks of
+    config.UPLOAD_SESSION_CHUNK_SIZE bytes, which may be sent in any order and retried any number of times, and is
+    written into a partial file alongside the paste's other attachments. The attachment only becomes visible once the
+    upload session is finalized.
+
+    :param paste_id: Paste ID to associate with the uploaded attachment
+    :param file_name: Raw name of the file
+    :param file_size: Size of the file in bytes
+    :param mime_type: MIME type of the file
+    :return: An instance of models.UploadSession describing the new upload session
+    :raises PasteDoesNotExistException: If the associated paste does not exist
+    :raises AttachmentTooLargeException: If the file is larger than an attachment or a resumable upload may be
+    :raises AttachmentQuotaExceededException: If the file would exceed the quotas of the paste or its owner
+    """
+    # The stated size is checked before anything is written, since the partial file is created at that size
+    max_size = config.MAX_ATTACHMENT_SIZE or config.UPLOAD_SESSION_MAX_FILE_SIZE
+    if max_size > 0 and file_size > max_size * 1000 * 1000:
+        raise AttachmentTooLargeException(
+            'The file is larger than the maximum upload size of {max_size} MB'.format(max_size=max_size)
+        )
+    database.attachment.check_attachment_quota([file_size], paste_id=paste_id)
+
+    upload_session = models.UploadSession(
+        paste_id=paste_id,
+        file_name=secure_filename(file_name),
+        file_size=file_size,
+        mime_type=mime_type,
+        chunk_size=config.UPLOAD_SESSION_CHUNK_SIZE,
+    )
+
+    # This will throw PasteDoesNotExistException if the paste does not exist or is inactive
+    database.attachment.make_attachment_dir(paste_id)
+    # Create the partial file at its full size, so that chunks can be written at their offsets in any order
+    with open(_resolve_partial_file_path(upload_session), 'wb') as partial_file:
+        partial_file.truncate(file_size)
+
+    session.add(upload_session)
+    session.commit()
+
+    return upload_session
+
+
+def get_upload_session(upload_token):
+    """
+    Get an upload session by its token.
+
+    :param upload_token: Token identifying the upload session
+    :return: An instance of models.UploadSession
+    :raises UploadSessionDoesNotExistException: If no upload session exists with this token, e.g. because it has been
+                                                finalized or garbage-collected
+    """
+    upload_session = models.UploadSession.query.filter_by(upload_token=upload_token).first()
+    if not upload_session:
+        raise UploadSessionDoesNotExistException(
+            'No upload session with upload_token {upload_token} exists'.format(upload_token=upload_token)
+        )
+    return upload_session
+
+
+def write_upload_chunk(upload_session, chunk_index, stream):
+    """
+    Write a chunk of an upload, read from a stream, at its offset in the partial file. Chunks that were already received
+    are overwritten, so that a chunk can safely be retried.
+
+    :param upload_session: An instance of models.UploadSession
+    :param chunk_index: Index of the chunk, from 0
+    :param stream: File-like object from which the chunk's data is read
+    :return: List of the indexes of all chunks received so far
+    :raises InvalidUploadChunkException: If the chunk index is out of range, or the stream does not hold exactly the
+                                         expected number of bytes for this chunk
+    """
+    if chunk_index < 0 or chunk_index >= upload_session.num_chunks:
+        raise InvalidUploadChunkException(
+            'Chunk index {chunk_index} is out of range for an upload of {num_chunks} chunks'.format(
+                chunk_index=chunk_index,
+                num_chunks=upload_session.num_chunks,
+            )
+        )
+
+    expected_length = upload_session.get_chunk_length(chunk_index)
+    written_length = 0
+    with open(_resolve_partial_file_path(upload_session), 'r+b') as partial_file:
+        partial_file.seek(chunk_index * upload_session.chunk_size)
+        while True:
+            data = stream.read(min(database.attachment.UPLOAD_CHUNK_SIZE, expected_length - written_length + 1))
+            if not data:
+                break
+            written_length += len(data)
+            if written_length > expected_length:
+                break
+            partial_file.write(data)
+    if written_length != expected_length:
+        raise InvalidUploadChunkException(
+            'Chunk {chunk_index} must be exactly {expected_length} bytes'.format(
+                chunk_index=chunk_index,
+                expected_length=expected_length,
+            )
+        )
+
+    session.merge(models.UploadChunk(
+        upload_session_id=upload_session.upload_session_id,
+        chunk_index=chunk_index,
+    ))
+    upload_session.last_activity_time = int(time.time())
+    session.commit()
+
+    return get_received_chunks(upload_session)
+
+
+def get_received_chunks(upload_session):
+    """
+    Get the indexes of the chunks of an upload that have been received.
+
+    :param upload_session: An instance of models.UploadSession
+    :return: Sorted list of chunk indexes
+    """
+    return [
+        chunk_index for chunk_index, in session.query(models.UploadChunk.chunk_index).filter_by(
+            upload_session_id=upload_session.upload_session_id,
+        ).order_by(
+            models.UploadChunk.chunk_index,
+        )
+    ]
+
+
+def finalize_upload_session(upload_session):
+    """
+    Complete an upload, once all of its chunks have been received. The partial file is moved into the blob store as
+    the attachment file, the attachment is recorded in the database, and the upload session is removed.
+
+    :param upload_session: An instance of models.UploadSession
+    :return: An instance of models.Attachment describing the uploaded attachment
+    :raises IncompleteUploadException: If any chunks of the upload have not yet been received
+    :raises PasteDoesNotExistException: If the associated paste no longer exists
+    :raises AttachmentQuotaExceededException: If the attachment would exceed the quotas of the paste or its owner
+    """
+    if len(get_received_chunks(upload_session)) < upload_session.num_chunks:
+        raise IncompleteUploadException(
+            'Only {num_received} of {num_chunks} chunks have been received'.format(
+                num_received=len(get_received_chunks(upload_session)),
+                num_chunks=upload_session.num_chunks,
+            )
+        )
+
+    new_attachment = models.Attachment(
+        paste_id=database.paste.get_paste_by_id(upload_session.paste_id, active_only=True).paste_id,
+        file_name=upload_session.file_name,
+        file_size=upload_session.file_size,
+        mime_type=upload_session.mime_type,
+    )
+    try:
+        database.attachment.add_attachment_file(new_attachment, _resolve_partial_file_path(upload_session))
+    except:
+        # The partial file is kept, and removed with the upload session once it is abandoned
+        session.rollback()
+        raise
+    _delete_upload_sessions([upload_session.upload_session_id])
+    session.commit()
+
+    return new_attachment
+
+
+def scrub_abandoned_upload_sessions():
+    """
+    Goes through the database and deletes all upload sessions that have not received a chunk in the last
+    config.UPLOAD_SESSION_MAX_IDLE_TIME seconds, along with their partial files. This method is not intended to be
+    called from within the application, but rather externally either manually or via a script/cron job.
+
+    For example, in a Python shell:
+        > import database.upload_session
+        > database.upload_session.scrub_abandoned_upload_sessions()
+
+    :return: The number of upload sessions that were deleted
+    """
+    abandoned_upload_sessions = models.UploadSession.query.filter(
+        models.UploadSession.last_activity_time < time.time() - config.UPLOAD_SESSION_MAX_IDLE_TIME,
+    ).all()
+    for upload_session in abandoned_upload_sessions:
+        try:
+            os.remove(_resolve_partial_file_path(upload_session))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    _delete_upload_sessions([upload_session.upload_session_id for upload_session in abandoned_upload_sessions])
+    session.commit()
+
+    return len(abandoned_upload_sessions)
+
+
+def _delete_upload_sessions(upload_session_ids):
+    """
+    Delete upload sessions and their chunk records, without committing.
+
+    :param upload_session_ids: List of IDs of the upload sessions to delete
+    """
+    if not upload_session_ids:
+        return
+    models.UploadChunk.query.filter(
+        models.UploadChunk.upload_session_id.in_(upload_session_ids),
+    ).delete(synchronize_session=False)
+    models.UploadSession.query.filter(
+        models.UploadSession.upload_session_id.in_(upload_session_ids),
+    ).delete(synchronize_session=False)
+
+
+def _resolve_partial_file_path(upload_session):
+    """
+    Get the path of the file into which an upload's chunks are written. Uploads started before a change of the
+    directory layout keep their partial files in the earlier layout.
+
+    :param upload_session: An instance of models.UploadSession
+    :return: Path to the partial file
+    """
+    return '{attachments_dir}/{relative_file_path}'.format(
+        attachments_dir=config.ATTACHMENTS_DIR,
+        relative_file_path=database.attachment.resolve_file_path(
+            lambda levels: get_partial_file_path(upload_session, levels),
+        ),
+    )
+
+
+def get_partial_file_path(upload_session, levels=None):
+    """
+    Get the path of the file into which an upload's chunks are written, relative to config.ATTACHMENTS_DIR.
+
+    :param upload_session: An instance of models.UploadSession
+    :param levels: Number of levels of hashed subdirectories in the directory layout; defaults to the configured layout
+    :return: Relative path to the partial file
+    """
+    return '{paste_dir}/upload-{upload_token}'.format(
+        paste_dir=database.attachment.get_paste_attachment_dir(upload_session.paste_id, levels),
+        upload_token=upload_session.upload_token,
+    )
@@ -1,4 +1,6 @@
+import config
 import database.paste
+import database.scrubber
 import models
 import util.cryptography
 import util.testing
@@ -29,7 +31,7 @@ def create_new_user(username, password, signup_ip, name=None, email=None):
     new_user = models.User(
         signup_ip=signup_ip,
         username=username,
-        password_hash=util.cryptography.secure_hash(password),
+        password_hash=util.cryptography.hash_password(password),
         name=name,
         email=email,
     )
@@ -57,7 +59,7 @@ def update_user_details(user_id, name, email, new_password):
     user.name = name
     user.email = email
     if new_password:
-        user.password_hash = util.cryptography.secure_hash(new_password)
+        user.password_hash = util.cryptography.hash_password(new_password)
     session.commit()
     return user
 
@@ -80,6 +82,21 @@ def get_user_by_id(user_id, active_only=False):
     return user
 
 
+def get_user_attachment_totals(user_id):
+    """
+    Get the precomputed totals of the attachments of a user's pastes. The totals are updated without loading the user's
+    row, so the row is read again rather than taken from the session, where a copy may be stale.
+
+    :param user_id: User ID to query by
+    :return: Tuple of (total size in bytes, number of attachments)
+    :raises UserDoesNotExistException: If no user exists with the given user_id
+    """
+    user = models.User.query.filter_by(user_id=user_id).populate_existing().first()
+    if not user:
+        raise UserDoesNotExistException('No user with user_id {user_id} exists'.format(user_id=user_id))
+    return user.attachments_size or 0, user.attachments_count or 0
+
+
 def get_user_by_username(username, active_only=False):
     """
     Get a User object by username, whose attributes match those in the database.
@@ -133,7 +150,8 @@ def generate_new_api_key(user_id):
 def authenticate_user(username, password):
     """
     Authenticate a user with a username and password. This function only checks if the
-    credentials are correct.
+    credentials are correct. If they are, and the user's password hash is a legacy hash or was made with other
+    parameters than those configured, it is replaced with a new hash of the password.
 
     :param username: Username to check
     :param password: Plain text password to authenticate against
@@ -141,7 +159,12 @@ def authenticate_user(username, password):
     :raises UserDoesNotExistException: If no user exists with the given username
     """
     user = get_user_by_username(username)
-    return user.is_active and util.cryptography.secure_hash(password) == user.password_hash
+    if not user.is_active or not util.cryptography.verify_password(password, user.password_hash):
+        return False
+    if util.cryptography.password_needs_rehash(user.password_hash):
+        user.password_hash = util.cryptography.hash_password(password)
+        session.commit()
+    return True
 
 
 def deactivate_user(user_id):
@@ -204,13 +227,22 @@ def load_user(user_id):
         return None
 
 
-def scrub_inactive_users():
+def scrub_inactive_users(progress_callback=None):
     """
-    Goes through the database and deletes all users that are inactive. This method is not intended to be called from
-    within the application, but rather externally either manually or via a script/cron job.
+    Goes through the database and deletes all users that are inactive, along with all of their pastes. This method is
+    not intended to be called from within the application, but rather externally either manually or via a script/cron
+    job. Users and pastes are deleted in chunks of config.SCRUB_CHUNK_SIZE, pausing for config.SCRUB_CHUNK_INTERVAL
+    seconds between chunks.
 
     For example, in a Python shell:
         > import database.user
-        > database.paste.scrub_inactive_users()
+        > database.user.scrub_inactive_users()
+
+    :param progress_callback: Function called with the scrub's progress statistics after each chunk (optional)
+    :return: Dictionary of progress and throughput statistics; see database.scrubber.Scrubber.stats
     """
-    models.User.query.filter_by(is_active=False).delete()
+    return database.scrubber.Scrubber(
+        chunk_size=config.SCRUB_CHUNK_SIZE,
+        chunk_interval=config.SCRUB_CHUNK_INTERVAL,
+        progress_callback=progress_callback,
+    ).scrub_inactive_users()
@@ -0,0 +1,298 @@
+import atexit
+import os
+import threading
+import time
+
+import config
+import models
+from modern_paste import db
+
+
+class ViewCountBuffer:
+    """
+    In-process, write-behind accumulator for paste view counts.
+
+    Rather than issuing one write transaction per paste view, view deltas are accumulated in memory per paste ID
+    and periodically written to the database in batches of UPDATE paste SET views = views + n statements. A flush is
+    triggered every flush_interval seconds by a background thread, or immediately once the total number of buffered
+    views exceeds max_buffered_delta. Any remaining deltas are drained when the process exits; deltas that cannot be
+    written to the database are appended to an optional local spill file, which is replayed on the next start.
+    """
+
+    def __init__(self, flush_interval, max_buffered_delta, spill_file=None):
+        """
+        :param flush_interval: Maximum number of seconds between flushes to the database
+        :param max_buffered_delta: Total number of buffered views that triggers an early flush
+        :param spill_file: Path to a local append-only file to which unflushable deltas are written (optional)
+        """
+        self.flush_interval = flush_interval
+        self.max_buffered_delta = max_buffered_delta
+        self.spill_file = spill_file
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._pending = {}
+        self._pending_total = 0
+        self._thread = None
+        self._pid = None
+
+        self.flush_count = 0
+        self.failed_flush_count = 0
+        self.flushed_views = 0
+        self.spilled_views = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def increment(self, paste_id, delta=1):
+        """
+        Buffer a view count increment for a paste.
+
+        :param paste_id: ID of the paste that was viewed
+        :param delta: Number of views to add (defaults to 1)
+        :return: The number of views currently buffered for this paste
+        """
+        self._ensure_started()
+        with self._lock:
+            buffered_views = self._pending.get(paste_id, 0) + delta
+            self._pending[paste_id] = buffered_views
+            self._pending_total += delta
+            should_flush = self._pending_total >= self.max_buffered_delta
+        if should_flush:
+            self._wakeup.set()
+        return buffered_views
+
+    def pending_views(self, paste_id):
+        """
+        Get the number of views buffered for a paste that have not yet been written to the database.
+
+        :param paste_id: ID of the paste to check
+        :return: Number of buffered views for this paste
+        """
+        with self._lock:
+            return self._pending.get(paste_id, 0)
+
+    def flush(self):
+        """
+        Write all buffered view deltas to the database. Pastes with the same delta are grouped into a single UPDATE
+        statement, and all statements are issued in one transaction. If the write fails, the deltas are returned to
+        the buffer so that they are retried on the next flush.
+
+        :return: The number of views written to the database
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._pending_total = 0
+            if not pending:
+                return 0
+
+            paste_ids_by_delta = {}
+            for paste_id, delta in pending.items():
+                paste_ids_by_delta.setdefault(delta, []).append(paste_id)
+
+            start_time = time.time()
+            try:
+                with db.engine.begin() as connection:
+                    for delta, paste_ids in paste_ids_by_delta.items():
+                        connection.execute(
+                            models.Paste.__table__.update().where(
+                                models.Paste.paste_id.in_(paste_ids),
+                            ).values(
+                                views=models.Paste.views + delta,
+                            )
+                        )
+            except:
+                self.failed_flush_count += 1
+                self._restore(pending)
+                raise
+            latency = time.time() - start_time
+
+            self.flush_count += 1
+            self.flushed_views += sum(pending.values())
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.total_flush_latency += latency
+            return sum(pending.values())
+
+    def drain(self):
+        """
+        Stop the background flusher and write out all remaining buffered deltas. If the final flush fails, the
+        deltas are appended to the spill file, if one is configured. This is registered to run at process exit.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(self.flush_interval)
+        try:
+            self.flush()
+        except:
+            self.spill()
+
+    def spill(self):
+        """
+        Append all buffered deltas to the spill file, as one "paste_id delta" line per paste, and clear the buffer.
+        This is a no-op if no spill file is configured.
+
+        :return: The number of views written to the spill file
+        """
+        if not self.spill_file:
+            return 0
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_total = 0
+        if not pending:
+            return 0
+        with open(self.spill_file, 'a') as spill_file:
+            for paste_id, delta in pending.items():
+                spill_file.write('{paste_id} {delta}\n'.format(paste_id=paste_id, delta=delta))
+            spill_file.flush()
+            os.fsync(spill_file.fileno())
+        self.spilled_views += sum(pending.values())
+        return sum(pending.values())
+
+    def replay_spill_file(self):
+        """
+        Load deltas left in the spill file by a previous process back into the buffer. The spill file is atomically
+        renamed before it is read, so that concurrently starting workers never replay the same deltas twice.
+
+        :return: The number of views loaded from the spill file
+        """
+        if not self.spill_file:
+            return 0
+        replay_file = '{spill_file}.{pid}'.format(spill_file=self.spill_file, pid=os.getpid())
+        try:
+            os.rename(self.spill_file, replay_file)
+        except OSError:
+            # No spill file exists, or another worker has already claimed it
+            return 0
+
+        replayed = {}
+        with open(replay_file) as spill_file:
+            for line in spill_file:
+                try:
+                    paste_id, delta = map(int, line.split())
+                except ValueError:
+                    # Partially written line from an interrupted spill
+                    continue
+                replayed[paste_id] = replayed.get(paste_id, 0) + delta
+        self._restore(replayed)
+        os.remove(replay_file)
+        return sum(replayed.values())
+
+    def stats(self):
+        """
+        Counters describing the current state of the buffer and the history of its flushes.
+
+        :return: Dictionary of buffer depth and flush latency statistics
+        """
+        with self._lock:
+            buffered_pastes = len(self._pending)
+            buffered_views = self._pending_total
+        return {
+            'buffered_pastes': buffered_pastes,
+            'buffered_views': buffered_views,
+            'flush_count': self.flush_count,
+            'failed_flush_count': self.failed_flush_count,
+            'flushed_views': self.flushed_views,
+            'spilled_views': self.spilled_views,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+            'mean_flush_latency': self.total_flush_latency / self.flush_count if self.flush_count else 0.0,
+        }
+
+    def _restore(self, deltas):
+        """
+        Merge deltas back into the buffer, e.g. after a failed flush.
+
+        :param deltas: Dictionary mapping paste IDs to view deltas
+        """
+        with self._lock:
+            for paste_id, delta in deltas.items():
+                self._pending[paste_id] = self._pending.get(paste_id, 0) + delta
+                self._pending_total += delta
+
+    def _ensure_started(self):
+        """
+        Lazily start the background flusher thread. Threads (and the state of held locks) do not survive a fork, so
+        this also detects when the buffer is used from a forked worker process and resets any state inherited from
+        the parent; the parent remains responsible for flushing its own deltas.
+        """
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            self._lock = threading.Lock()
+            self._flush_lock = threading.Lock()
+            self._start_lock = threading.Lock()
+            self._wakeup = threading.Event()
+            self._pending = {}
+            self._pending_total = 0
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._stopped.clear()
+            self.replay_spill_file()
+            self._thread = threading.Thread(target=self._run, name='view-count-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.drain)
+            self._pid = os.getpid()
+
+    def _run(self):
+        """
+        Background flusher loop.
+        """
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except:
+                # The deltas have been returned to the buffer; spill them if they can no longer be held in memory
+                if self.stats()['buffered_views'] >= self.max_buffered_delta:
+                    self.spill()
+
+
+_view_count_buffer = None
+_view_count_buffer_lock = threading.Lock()
+
+
+def get_view_count_buffer():
+    """
+    Get the process-wide view count buffer, creating it from the application configuration if necessary.
+
+    :return: The ViewCountBuffer instance for this process
+    """
+    global _view_count_buffer
+    if _view_count_buffer is None:
+        with _view_count_buffer_lock:
+            if _view_count_buffer is None:
+                _view_count_buffer = ViewCountBuffer(
+                    flush_interval=config.VIEW_COUNT_FLUSH_INTERVAL,
+                    max_buffered_delta=config.VIEW_COUNT_MAX_BUFFERED_DELTA,
+                    spill_file=config.VIEW_COUNT_SPILL_FILE,
+                )
+    return _view_count_buffer
+
+
+def buffer_paste_view(paste_id, delta=1):
+    """
+    Record a paste view in the process-wide view count buffer.
+
+    :param paste_id: ID of the paste that was viewed
+    :param delta: Number of views to add (defaults to 1)
+    :return: The number of views currently buffered for this paste
+    """
+    return get_view_count_buffer().increment(paste_id, delta)
+
+
+def flush_buffered_views():
+    """
+    Write all buffered paste views to the database.
+
+    :return: The number of views written to the database
+    """
+    return get_view_count_buffer().flush()
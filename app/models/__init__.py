@@ -1,3 +1,4 @@
 from attachment import *
 from paste import *
+from upload_session import *
 from user import *
@@ -4,13 +4,26 @@ from modern_paste import db
 
 class Attachment(db.Model):
     __tablename__ = 'attachment'
+    __table_args__ = (
+        # Lookup of an attachment by name; file_name is a TEXT column, so only a prefix of it can be indexed
+        db.Index('ix_attachment_paste_id_file_name', 'paste_id', 'file_name', mysql_length={'file_name': 191}),
+    )
 
     attachment_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     paste_id = db.Column(db.Integer, index=True)
     file_name = db.Column(db.Text)
+    # Name of the attachment's file in its paste's directory, for legacy files stored per paste. Older attachments are
+    # named by util.cryptography.secure_hash of their file name, and newer ones by util.cryptography.hash_file_name.
     hash_name = db.Column(db.Text)
     file_size = db.Column(db.Integer)
     mime_type = db.Column(db.Text)
+    # True if the attachment file holds the raw file contents; NULL for legacy files holding base64-encoded contents
+    is_raw = db.Column(db.Boolean, default=None)
+    # Digest of the attachment blob holding the file contents; NULL for legacy files stored per paste
+    blob_digest = db.Column(db.String(64), index=True, default=None)
+    # Raw contents of an attachment stored inline in the database; NULL for attachments stored in files. The column is
+    # deferred, so that it is only loaded when the contents are needed.
+    data = db.deferred(db.Column(db.LargeBinary(length=2 ** 24 - 1), default=None))
 
     def __init__(
         self,
@@ -21,19 +34,46 @@ class Attachment(db.Model):
     ):
         self.paste_id = paste_id
         self.file_name = file_name
-        self.hash_name = util.cryptography.secure_hash(file_name)
+        self.hash_name = util.cryptography.hash_file_name(file_name)
         self.file_size = file_size
         self.mime_type = mime_type
+        self.is_raw = True
 
-    def as_dict(self):
+    def as_dict(self, paste_id_repr=None):
         """
         Represent this attachment as an easily JSON-serializable dictionary.
 
+        :param paste_id_repr: Representation of the paste's ID, if already known
         :return: Dictionary of attachment properties
         """
         return {
-            'paste_id_repr': util.cryptography.get_id_repr(self.paste_id),
+            'paste_id_repr': util.cryptography.get_id_repr(self.paste_id) if paste_id_repr is None else paste_id_repr,
             'file_name': self.file_name,
             'file_size': self.file_size,
             'mime_type': self.mime_type,
         }
+
+
+class AttachmentBlob(db.Model):
+    """
+    A file in the content-addressed attachment store, shared by every attachment with identical contents.
+    """
+    __tablename__ = 'attachment_blob'
+
+    # Hex SHA-256 digest of the file contents
+    digest = db.Column(db.String(64), primary_key=True)
+    file_size = db.Column(db.BigInteger)
+    # Number of attachments referencing this blob; the blob is deleted once this drops to zero
+    ref_count = db.Column(db.Integer)
+    # Segment file holding the blob's contents, and their offset within it; NULL if the blob is stored in its own file
+    segment_id = db.Column(db.Integer, index=True, default=None)
+    segment_offset = db.Column(db.BigInteger, default=None)
+
+    def __init__(
+        self,
+        digest,
+        file_size,
+    ):
+        self.digest = digest
+        self.file_size = file_size
+        self.ref_count = 1
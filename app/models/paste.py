@@ -1,14 +1,29 @@
 import time
 
+from sqlalchemy import func
+
 import util.cryptography
 import util.testing
 from modern_paste import db
 from uri.paste import *
 
 
+# Maximum number of characters of a paste's contents included in its summary representation
+CONTENTS_PREVIEW_LENGTH = 200
+
+
 class Paste(db.Model):
     __tablename__ = 'paste'
-    __table_args__ = {'mysql_collate': 'utf8mb4_general_ci'}
+    __table_args__ = (
+        # Archive listings of active pastes, sorted by recency or popularity
+        db.Index('ix_paste_is_active_post_time', 'is_active', 'post_time'),
+        db.Index('ix_paste_is_active_views', 'is_active', 'views'),
+        # A user's pastes, sorted by recency
+        db.Index('ix_paste_user_id_is_active_post_time', 'user_id', 'is_active', 'post_time'),
+        # Scrubbing of expired pastes
+        db.Index('ix_paste_expiry_time', 'expiry_time'),
+        {'mysql_collate': 'utf8mb4_general_ci'},
+    )
 
     paste_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     is_active = db.Column(db.Boolean)
@@ -22,6 +37,28 @@ class Paste(db.Model):
     deactivation_token = db.Column(db.Text)
     views = db.Column(db.Integer)
     is_api_post = db.Column(db.Boolean)
+    # Precomputed total size in bytes and number of the paste's attachments, maintained as attachments are added and
+    # removed, so that quotas can be checked without summing over the attachments
+    attachments_size = db.Column(db.BigInteger, default=0)
+    attachments_count = db.Column(db.Integer, default=0)
+
+    # Summary projections of the contents, computed by the database so that listings need not transfer the contents
+    # themselves. These are deferred, and are loaded only when a query undefers the 'summary' group.
+    contents_preview = db.column_property(
+        func.substring(contents, 1, CONTENTS_PREVIEW_LENGTH),
+        deferred=True,
+        group='summary',
+    )
+    contents_size = db.column_property(
+        func.length(contents),
+        deferred=True,
+        group='summary',
+    )
+    contents_num_lines = db.column_property(
+        func.length(contents) - func.length(func.replace(contents, '\n', '')) + 1,
+        deferred=True,
+        group='summary',
+    )
 
     def __init__(
         self,
@@ -45,22 +82,34 @@ class Paste(db.Model):
         self.views = 0
         self.is_api_post = is_api_post
 
-    def as_dict(self):
+    def as_dict(self, include_contents=True, id_repr=None):
         """
         Represent this paste as an easily JSON-serializable dictionary. This method is intended to present the paste
         for consumption at the highest level of the stack, so it should exclude all sensitive information.
 
+        :param include_contents: True to include the full contents of the paste; False to include only a summary of
+                                 the contents (a bounded preview, the number of lines, and the size in bytes)
+        :param id_repr: Representation of the paste's ID, if already known, e.g. from util.cryptography.get_id_reprs
         :return: Dictionary of paste properties
         """
-        return {
-            'paste_id_repr': util.cryptography.get_id_repr(self.paste_id),
+        if id_repr is None:
+            id_repr = util.cryptography.get_id_repr(self.paste_id)
+        paste_dict = {
+            'paste_id_repr': id_repr,
             'is_active': self.is_active,
             'post_time': self.post_time,
             'expiry_time': self.expiry_time,
-            'contents': self.contents,
             'title': self.title,
             'language': self.language,
             'views': self.views,
             'is_password_protected': self.password_hash is not None,
-            'url': PasteViewInterfaceURI.full_uri(paste_id=util.cryptography.get_id_repr(self.paste_id)),
+            'url': PasteViewInterfaceURI.full_uri(paste_id=id_repr),
         }
+        if include_contents:
+            paste_dict['contents'] = self.contents
+        else:
+            # Don't leak the beginning of a password-protected paste
+            paste_dict['contents_preview'] = self.contents_preview if self.password_hash is None else None
+            paste_dict['contents_size'] = self.contents_size
+            paste_dict['contents_num_lines'] = self.contents_num_lines
+        return paste_dict
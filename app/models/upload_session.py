@@ -0,0 +1,79 @@
+import time
+
+import util.testing
+from modern_paste import db
+
+
+class UploadSession(db.Model):
+    __tablename__ = 'upload_session'
+
+    upload_session_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    upload_token = db.Column(db.String(64), index=True)
+    paste_id = db.Column(db.Integer, index=True)
+    file_name = db.Column(db.Text)
+    file_size = db.Column(db.BigInteger)
+    mime_type = db.Column(db.Text)
+    chunk_size = db.Column(db.Integer)
+    start_time = db.Column(db.Integer)
+    # Time at which a chunk was last received, used to garbage-collect abandoned sessions
+    last_activity_time = db.Column(db.Integer, index=True)
+
+    def __init__(
+        self,
+        paste_id,
+        file_name,
+        file_size,
+        mime_type,
+        chunk_size,
+    ):
+        self.upload_token = util.testing.random_alphanumeric_string(length=64)
+        self.paste_id = paste_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.mime_type = mime_type
+        self.chunk_size = chunk_size
+        self.start_time = int(time.time())
+        self.last_activity_time = self.start_time
+
+    @property
+    def num_chunks(self):
+        """
+        The number of chunks in which the file is uploaded. Every chunk is chunk_size bytes, except for the last
+        chunk, which holds the remainder of the file.
+        """
+        return max((self.file_size + self.chunk_size - 1) // self.chunk_size, 1)
+
+    def get_chunk_length(self, chunk_index):
+        """
+        Get the expected length of a chunk.
+
+        :param chunk_index: Index of the chunk, from 0
+        :return: Length of the chunk in bytes
+        """
+        return min(self.chunk_size, self.file_size - chunk_index * self.chunk_size)
+
+    def as_dict(self):
+        """
+        Represent this upload session as an easily JSON-serializable dictionary.
+
+        :return: Dictionary of upload session properties
+        """
+        return {
+            'upload_token': self.upload_token,
+            'file_name': self.file_name,
+            'file_size': self.file_size,
+            'mime_type': self.mime_type,
+            'chunk_size': self.chunk_size,
+            'num_chunks': self.num_chunks,
+        }
+
+
+class UploadChunk(db.Model):
+    __tablename__ = 'upload_chunk'
+
+    upload_session_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    chunk_index = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    def __init__(self, upload_session_id, chunk_index):
+        self.upload_session_id = upload_session_id
+        self.chunk_index = chunk_index
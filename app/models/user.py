@@ -16,6 +16,9 @@ class User(db.Model):
     name = db.Column(db.Text, default=None)
     email = db.Column(db.Text, default=None)
     api_key = db.Column(db.String(64), index=True)
+    # Precomputed total size in bytes and number of the attachments of all of the user's pastes
+    attachments_size = db.Column(db.BigInteger, default=0)
+    attachments_count = db.Column(db.Integer, default=0)
 
     def __init__(
         self,
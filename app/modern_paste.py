@@ -13,9 +13,18 @@ login_manager = flask_login.LoginManager()
 login_manager.init_app(app)
 
 
+import config
+import database.expiry
 import models
 from views import *
 
 
+@app.before_request
+def start_expiry_scheduler():
+    # Started on the first request rather than at import time, so that each forked worker runs its own scheduler
+    if config.ENABLE_EXPIRY_SCHEDULER:
+        database.expiry.get_expiry_scheduler().ensure_started()
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=config.BUILD_ENVIRONMENT == constants.build_environment.DEV)
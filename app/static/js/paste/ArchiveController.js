@@ -25,6 +25,8 @@ modernPaste.paste.ArchiveController = function() {
 
     this.currentPage = 0;
     this.numPerPage = 20;
+    // Cursor from which each page is resumed, indexed by page number; the first page needs no cursor
+    this.pageCursors = [null];
 
     modernPaste.paste.ArchiveController.loadPastes.bind(this)();
 
@@ -41,13 +43,15 @@ modernPaste.paste.ArchiveController = function() {
  */
 modernPaste.paste.ArchiveController.changeMode = function(mode) {
     this.currentPage = 0;
+    this.pageCursors = [null];
     this.currentArchiveMode = mode;
     modernPaste.paste.ArchiveController.loadPastes.bind(this)();
 };
 
 /**
  * Load pastes for the current page number and the predefined number of results per page.
- * These constants are global variables that are modified outside this function.
+ * These constants are global variables that are modified outside this function. Each page is requested with the
+ * cursor returned along with the previous page.
  */
 modernPaste.paste.ArchiveController.loadPastes = function() {
     var url = modernPaste.universal.URIController.uris.RecentPastesURI;
@@ -60,7 +64,7 @@ modernPaste.paste.ArchiveController.loadPastes = function() {
         'url': url,
         'contentType': 'application/json',
         'data': JSON.stringify({
-            'page_num': this.currentPage,
+            'cursor': this.pageCursors[this.currentPage],
             'num_per_page': this.numPerPage
         })
     })
@@ -81,6 +85,9 @@ modernPaste.paste.ArchiveController.loadPastesIntoList = function(data) {
         return;
     }
 
+    // Remember where the next page starts
+    this.pageCursors[this.currentPage + 1] = data.next_cursor;
+
     // Hide or show the previous button accordingly
     this.currentPage <= 0 ? this.previousButton.fadeOut('fast') : this.previousButton.fadeIn('fast');
 
@@ -35,6 +35,7 @@ modernPaste.paste.ViewController = function() {
     this.pastePasswordField = $('.password-protected .paste-password-field');
     this.passwordSubmitButton = $('.password-protected .password-submit-button');
     this.pasteAttachmentsText = $('.paste-attachments .paste-attachments-text');
+    this.pasteAttachmentsArchiveLink = $('.paste-attachments .paste-attachments-archive-link');
 
     // Paste header links
     this.pasteDownloadLink = $('.paste-header .paste-download-link');
@@ -106,6 +107,15 @@ modernPaste.paste.ViewController.initializePasteDetails = function(data) {
         this.attachmentsList.hide();
     } else {
         this.pasteAttachmentsText.text(numAttachments + ' ATTACHMENT' + (numAttachments === 1 ? '' : 'S'));
+        // Password-protected pastes are unlocked with the token returned for the password, rather than the password
+        var archiveParams = {'paste_id': this.metadata.pasteId};
+        if (data.unlock_token) {
+            archiveParams.unlock_token = data.unlock_token;
+        }
+        this.pasteAttachmentsArchiveLink.prop('href', modernPaste.universal.URIController.formatURI(
+            modernPaste.universal.URIController.uris.PasteAttachmentsArchiveURI,
+            archiveParams
+        ));
         data.details.attachments.forEach(function(attachment) {
             var attachmentLinkItem = $(this.attachmentLinkTemplate.html());
             var attachmentLink = attachmentLinkItem.find('.attachment-link');
@@ -129,7 +129,8 @@ modernPaste.user.account.AccountPastesController.showPasteLoadError = function()
 };
 
 /**
- * Download the requested paste.
+ * Download the requested paste. The list of the user's pastes only includes a summary of each paste's contents, so
+ * the full contents are retrieved from the server first.
  *
  * @param pasteDetails An object describing the paste's details as returned by the API.
  * @param pasteDownloadContents A JQuery object representing a hidden link to temporarily store the
@@ -138,9 +139,29 @@ modernPaste.user.account.AccountPastesController.showPasteLoadError = function()
 modernPaste.user.account.AccountPastesController.downloadPaste = function(pasteDetails, pasteDownloadContents, evt) {
     evt.preventDefault();
 
-    var fileExtension = modernPaste.universal.CommonController.getFileExtensionForType(pasteDetails.language);
-    pasteDownloadContents.attr('download', pasteDetails.title + fileExtension);
-    pasteDownloadContents.attr('href', 'data:text/plain;base64,' + window.btoa(pasteDetails.contents));
+    $.ajax({
+        'method': 'POST',
+        'url': modernPaste.universal.URIController.uris.PasteDetailsURI,
+        'contentType': 'application/json',
+        'data': JSON.stringify({
+            'paste_id': pasteDetails.paste_id_repr
+        })
+    })
+    .done(modernPaste.user.account.AccountPastesController.savePasteContents.bind(this, pasteDownloadContents))
+    .fail(modernPaste.user.account.AccountPastesController.showPasteLoadError.bind(this));
+};
+
+/**
+ * Save the full contents of a paste, as returned by the server, to a file.
+ *
+ * @param pasteDownloadContents A JQuery object representing a hidden link to temporarily store the
+ *                              contents of the paste for download.
+ * @param data The response of the paste details endpoint.
+ */
+modernPaste.user.account.AccountPastesController.savePasteContents = function(pasteDownloadContents, data) {
+    var fileExtension = modernPaste.universal.CommonController.getFileExtensionForType(data.details.language);
+    pasteDownloadContents.attr('download', data.details.title + fileExtension);
+    pasteDownloadContents.attr('href', 'data:text/plain;base64,' + window.btoa(data.details.contents));
     pasteDownloadContents[0].click();
 };
 
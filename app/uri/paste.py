@@ -17,6 +17,10 @@ class PasteAttachmentURI(URI):
     path = '/paste/<paste_id>/attachment/<file_name>'
 
 
+class PasteAttachmentsArchiveURI(URI):
+    path = '/paste/<paste_id>/attachments.zip'
+
+
 class PasteDeactivateInterfaceURI(URI):
     path = '/paste/<paste_id>/deactivate/<deactivation_token>'
 
@@ -30,6 +34,31 @@ class PasteSubmitURI(URI):
     path = '/api/paste/submit'
 
 
+class PasteAttachmentUploadURI(URI):
+    api_endpoint = True
+    path = '/api/paste/attachment/upload'
+
+
+class UploadSessionCreateURI(URI):
+    api_endpoint = True
+    path = '/api/paste/attachment/upload_session'
+
+
+class UploadSessionStatusURI(URI):
+    api_endpoint = True
+    path = '/api/paste/attachment/upload_session/<upload_token>'
+
+
+class UploadSessionChunkURI(URI):
+    api_endpoint = True
+    path = '/api/paste/attachment/upload_session/<upload_token>/chunk/<chunk_index>'
+
+
+class UploadSessionFinalizeURI(URI):
+    api_endpoint = True
+    path = '/api/paste/attachment/upload_session/<upload_token>/finalize'
+
+
 class PasteDeactivateURI(URI):
     api_endpoint = True
     path = '/api/paste/deactivate'
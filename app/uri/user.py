@@ -37,6 +37,11 @@ class UserAPIKeyRegenerateURI(URI):
     path = '/api/user/api_key/regenerate'
 
 
+class UserAttachmentUsageURI(URI):
+    api_endpoint = True
+    path = '/api/user/attachment_usage'
+
+
 class CheckUsernameAvailabilityURI(URI):
     api_endpoint = True
     path = '/api/user/check_username_availability'
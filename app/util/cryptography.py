@@ -1,6 +1,13 @@
 import base64
+import collections
+import hashlib
+import hmac
+import os
+import struct
+import threading
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256
+from Crypto.Util.strxor import strxor
 
 import config
 from util.exception import InvalidIDException
@@ -12,6 +19,16 @@ from util.exception import InvalidIDException
 BLOCK_SIZE = 16
 PADDING_CHAR = '*'
 ALTCHARS = '~-'
+# Algorithm of password hashes in the format algorithm$iterations$salt$hash
+PASSWORD_HASH_ALGORITHM = 'pbkdf2_sha256'
+# Number of random bytes in the salt of each password hash
+PASSWORD_SALT_SIZE = 16
+# Digits of short IDs, in order of value
+SHORT_ID_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+# Possible lengths of short IDs; each ID takes the shortest length whose range of values contains it
+SHORT_ID_WIDTHS = (6, 8, 11)
+# Number of Feistel rounds of the short ID permutation
+SHORT_ID_ROUNDS = 10
 
 
 def _pad(s):
@@ -26,6 +43,386 @@ def _base64_decode(data):
     return base64.b64decode(data, ALTCHARS)
 
 
+class IdCodec(object):
+    """
+    Converts between decrypted and encrypted IDs. IDs are encrypted with AES in CBC mode, one block for IDs of up to 15
+    digits. Since a CBC cipher object carries chaining state from one message to the next, it cannot be reused across
+    IDs; instead, a single ECB cipher object, which holds nothing but the expanded key, is created once and the CBC
+    chaining is applied to it by hand, which gives the same encrypted IDs. The most recently converted IDs are also
+    kept in a bounded LRU cache in each direction, since the same IDs tend to be converted again and again.
+    """
+
+    def __init__(self, key, iv, cache_size=0):
+        """
+        :param key: AES key
+        :param iv: AES initialization vector for CBC mode
+        :param cache_size: Maximum number of IDs remembered in each direction; 0 to disable caching
+        """
+        self.key = key
+        self.iv = iv
+        self.cache_size = cache_size
+        self._cipher = AES.new(key, AES.MODE_ECB)
+        self._encids = _LRUCache(cache_size)
+        self._decids = _LRUCache(cache_size)
+
+    def encode(self, decid):
+        """
+        Generate an encrypted ID from a decrypted ID.
+
+        :param decid: Decrypted ID, type int
+        :return: Encrypted ID, type str
+        :raises InvalidIDException: If the decrypted ID is not int-castable
+        """
+        return self.encode_many([decid])[0]
+
+    def decode(self, encid):
+        """
+        Generate a decrypted ID from an encrypted ID.
+
+        :param encid: Encrypted ID, type str
+        :return: Decrypted ID, type int
+        :raises InvalidIDException: If the encrypted ID is not valid
+        """
+        return self.decode_many([encid])[0]
+
+    def encode_many(self, decids):
+        """
+        Generate encrypted IDs from several decrypted IDs at once, looking them all up in the cache with a single
+        acquisition of its lock.
+
+        :param decids: Iterable of decrypted IDs
+        :return: List of encrypted IDs, in the same order
+        :raises InvalidIDException: If any decrypted ID is not int-castable
+        """
+        keys = []
+        for decid in decids:
+            try:
+                int(decid)
+            except:
+                raise InvalidIDException('Decrypted ID must be int-castable')
+            keys.append(str(decid))
+        encids, converted = self._convert_many(keys, self._encids, self._encrypt)
+        # Each encrypted ID decrypts back to its decrypted ID, so the reverse conversions are cached as well
+        self._decids.put_many((encid, int(decid)) for decid, encid in converted)
+        return encids
+
+    def decode_many(self, encids):
+        """
+        Generate decrypted IDs from several encrypted IDs at once, looking them all up in the cache with a single
+        acquisition of its lock.
+
+        :param encids: Iterable of encrypted IDs
+        :return: List of decrypted IDs, in the same order
+        :raises InvalidIDException: If any encrypted ID is not valid
+        """
+        keys = []
+        for encid in encids:
+            try:
+                keys.append(str(encid))
+            except:
+                raise InvalidIDException('The encrypted ID is not valid')
+        # Several encrypted IDs may decrypt to the same decrypted ID, e.g. with different padding, so the reverse
+        # conversions are not cached
+        decids, _ = self._convert_many(keys, self._decids, self._decrypt)
+        return decids
+
+    def _convert_many(self, keys, cache, convert):
+        """
+        Convert several IDs, taking them from the cache where possible.
+
+        :param keys: List of string IDs to convert
+        :param cache: _LRUCache of the conversions
+        :param convert: Function converting a single string ID
+        :return: Tuple of (list of converted IDs, in the same order; list of (ID, converted ID) tuples of the IDs that
+                 were not cached)
+        """
+        results = cache.get_many(keys)
+        converted = []
+        for index, result in enumerate(results):
+            if result is None:
+                results[index] = convert(keys[index])
+                converted.append((keys[index], results[index]))
+        cache.put_many(converted)
+        return results, converted
+
+    def _encrypt(self, decid):
+        """
+        Encrypt a decrypted ID with AES in CBC mode.
+
+        :param decid: Decrypted ID, type str
+        :return: Encrypted ID, type str
+        """
+        plaintext = _pad(decid)
+        ciphertext = []
+        previous_block = self.iv
+        for offset in range(0, len(plaintext), BLOCK_SIZE):
+            previous_block = self._cipher.encrypt(strxor(plaintext[offset:offset + BLOCK_SIZE], previous_block))
+            ciphertext.append(previous_block)
+        # Slashes are not URL-friendly; replace them with dashes
+        # Also strip the base64 padding: it can be recovered.
+        return base64.b64encode(''.join(ciphertext), ALTCHARS).rstrip('=')
+
+    def _decrypt(self, encid):
+        """
+        Decrypt an encrypted ID with AES in CBC mode.
+
+        :param encid: Encrypted ID, type str
+        :return: Decrypted ID, type int
+        :raises InvalidIDException: If the encrypted ID is not valid
+        """
+        try:
+            ciphertext = _base64_decode(encid)
+            if not ciphertext or len(ciphertext) % BLOCK_SIZE:
+                raise ValueError('Ciphertext is not a whole number of blocks')
+            plaintext = []
+            previous_block = self.iv
+            for offset in range(0, len(ciphertext), BLOCK_SIZE):
+                block = ciphertext[offset:offset + BLOCK_SIZE]
+                plaintext.append(strxor(self._cipher.decrypt(block), previous_block))
+                previous_block = block
+            return int(''.join(plaintext).rstrip(PADDING_CHAR))
+        except:
+            raise InvalidIDException('The encrypted ID is not valid')
+
+
+class _LRUCache(object):
+    """
+    A thread-safe mapping holding at most max_size entries, evicting the least recently used entry first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """
+        Look up several keys, marking those found as recently used.
+
+        :param keys: List of keys
+        :return: List of the values of the keys, with None for keys not in the cache
+        """
+        results = []
+        with self._lock:
+            for key in keys:
+                value = self._entries.pop(key, None)
+                if value is not None:
+                    # Reinserting the entry moves it to the most recently used end
+                    self._entries[key] = value
+                results.append(value)
+        return results
+
+    def put_many(self, items):
+        """
+        Add several entries, evicting the least recently used entries beyond max_size.
+
+        :param items: Iterable of (key, value) tuples
+        """
+        if not self.max_size:
+            return
+        with self._lock:
+            for key, value in items:
+                self._entries.pop(key, None)
+                self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+_id_codec = None
+_id_codec_lock = threading.Lock()
+
+
+def get_id_codec():
+    """
+    Get the process-wide ID codec, creating it from the application configuration if necessary.
+
+    :return: The IdCodec instance for this process
+    """
+    global _id_codec
+    # The codec is created again if the configuration changes, e.g. between tests
+    if not _is_id_codec_current(_id_codec):
+        with _id_codec_lock:
+            if not _is_id_codec_current(_id_codec):
+                _id_codec = IdCodec(config.ID_ENCRYPTION_KEY, config.ID_ENCRYPTION_IV, config.ID_CACHE_SIZE)
+    return _id_codec
+
+
+def _is_id_codec_current(codec):
+    """
+    Check whether an ID codec matches the application configuration.
+
+    :param codec: An IdCodec instance, or None
+    :return: True if the codec uses the configured key, IV, and cache size
+    """
+    return codec is not None and (codec.key, codec.iv, codec.cache_size) == (
+        config.ID_ENCRYPTION_KEY,
+        config.ID_ENCRYPTION_IV,
+        config.ID_CACHE_SIZE,
+    )
+
+
+class ShortIdCodec(object):
+    """
+    Converts between decrypted IDs and short IDs. A short ID is a keyed permutation of the decrypted ID within the range
+    of base62 strings of a fixed length, rendered in base62, so short IDs are as compact as the decrypted IDs they stand
+    for, but do not reveal how many pastes there are. The permutation is a Feistel network over the two halves of the
+    base62 digits, with modular addition in each round as in NIST SP 800-38G's FF1, and a keyed SHA-256 round function;
+    it takes a handful of hashes per ID, and no cipher setup.
+    """
+
+    def __init__(self, key):
+        """
+        :param key: Secret key of the permutation
+        """
+        self.key = key
+        # Round function hashes all start with the key; copying this hash object saves hashing it again in every round
+        self._hash = hashlib.sha256(hmac.new(key, 'short-id', hashlib.sha256).digest())
+
+    def encode(self, decid):
+        """
+        Generate a short ID from a decrypted ID.
+
+        :param decid: Decrypted ID, type int
+        :return: Short ID, type str
+        :raises InvalidIDException: If the decrypted ID is not int-castable, is negative, or is too large
+        """
+        try:
+            decid = int(decid)
+        except:
+            raise InvalidIDException('Decrypted ID must be int-castable')
+        for width in SHORT_ID_WIDTHS:
+            if 0 <= decid < len(SHORT_ID_ALPHABET) ** width:
+                return self._to_base62(self._permute(decid, width), width)
+        raise InvalidIDException('Decrypted ID is out of the range of short IDs')
+
+    def decode(self, short_id):
+        """
+        Generate a decrypted ID from a short ID.
+
+        :param short_id: Short ID, type str
+        :return: Decrypted ID, type int
+        :raises InvalidIDException: If the short ID is not valid
+        """
+        if not is_short_id(short_id):
+            raise InvalidIDException('The short ID is not valid')
+        width = len(short_id)
+        decid = self._unpermute(self._from_base62(short_id), width)
+        # Each ID has a single short ID, of the shortest possible length
+        shorter_widths = [shorter_width for shorter_width in SHORT_ID_WIDTHS if shorter_width < width]
+        if shorter_widths and decid < len(SHORT_ID_ALPHABET) ** max(shorter_widths):
+            raise InvalidIDException('The short ID is not valid')
+        return decid
+
+    def _permute(self, value, width):
+        """
+        Apply the permutation of the range of base62 numbers of a given width.
+
+        :param value: Number to permute, in the range [0, 62 ** width)
+        :param width: Number of base62 digits
+        :return: The permuted number, in the same range
+        """
+        left_width = width // 2
+        right_width = width - left_width
+        left, right = divmod(value, len(SHORT_ID_ALPHABET) ** right_width)
+        for round_num in range(SHORT_ID_ROUNDS):
+            # The halves swap places every round, so the modulus alternates between the widths of the two halves
+            modulus = len(SHORT_ID_ALPHABET) ** (left_width if round_num % 2 == 0 else right_width)
+            left, right = right, (left + self._round(width, round_num, right)) % modulus
+        return left * len(SHORT_ID_ALPHABET) ** right_width + right
+
+    def _unpermute(self, value, width):
+        """
+        Invert _permute.
+
+        :param value: Permuted number, in the range [0, 62 ** width)
+        :param width: Number of base62 digits
+        :return: The original number
+        """
+        left_width = width // 2
+        right_width = width - left_width
+        left, right = divmod(value, len(SHORT_ID_ALPHABET) ** right_width)
+        for round_num in reversed(range(SHORT_ID_ROUNDS)):
+            modulus = len(SHORT_ID_ALPHABET) ** (left_width if round_num % 2 == 0 else right_width)
+            left, right = (right - self._round(width, round_num, left)) % modulus, left
+        return left * len(SHORT_ID_ALPHABET) ** right_width + right
+
+    def _round(self, width, round_num, value):
+        """
+        Compute the round function of the permutation.
+
+        :param width: Number of base62 digits of the permuted number
+        :param round_num: Index of the round
+        :param value: Half of the permuted number
+        :return: A pseudorandom 128-bit integer, depending on the key and all of the parameters
+        """
+        round_hash = self._hash.copy()
+        round_hash.update(struct.pack('>BBQ', width, round_num, value))
+        high, low = struct.unpack('>QQ', round_hash.digest()[:16])
+        return (high << 64) | low
+
+    @staticmethod
+    def _to_base62(value, width):
+        """Render a number as a fixed number of base62 digits."""
+        digits = []
+        for _ in range(width):
+            value, digit = divmod(value, len(SHORT_ID_ALPHABET))
+            digits.append(SHORT_ID_ALPHABET[digit])
+        return ''.join(reversed(digits))
+
+    @staticmethod
+    def _from_base62(short_id):
+        """Parse a string of base62 digits."""
+        value = 0
+        for char in short_id:
+            value = value * len(SHORT_ID_ALPHABET) + SHORT_ID_ALPHABET.index(char)
+        return value
+
+
+_short_id_codec = None
+_short_id_codec_lock = threading.Lock()
+
+
+def get_short_id_codec():
+    """
+    Get the process-wide short ID codec, creating it from the application configuration if necessary. Its key is
+    derived from config.ID_ENCRYPTION_KEY.
+
+    :return: The ShortIdCodec instance for this process
+    """
+    global _short_id_codec
+    # The codec is created again if the configuration changes, e.g. between tests
+    if _short_id_codec is None or _short_id_codec.key != config.ID_ENCRYPTION_KEY:
+        with _short_id_codec_lock:
+            if _short_id_codec is None or _short_id_codec.key != config.ID_ENCRYPTION_KEY:
+                _short_id_codec = ShortIdCodec(config.ID_ENCRYPTION_KEY)
+    return _short_id_codec
+
+
+def is_short_id(raw_id):
+    """
+    Check whether an ID has the form of a short ID. Encrypted IDs are longer than any short ID, and decrypted IDs of
+    the same length as a short ID are treated as short IDs.
+
+    :param raw_id: ID of any form
+    :return: True if the ID is a string of base62 digits of one of the lengths of short IDs
+    """
+    return (
+        isinstance(raw_id, basestring) and
+        len(raw_id) in SHORT_ID_WIDTHS and
+        all(char in SHORT_ID_ALPHABET for char in raw_id)
+    )
+
+
+def get_short_id(decid):
+    """
+    Generate a short ID from a decrypted ID
+
+    :param decid: Decrypted ID, type int
+    :return: Short ID, type str
+    """
+    return get_short_id_codec().encode(decid)
+
+
 def get_encid(decid):
     """
     Generate an encrypted ID from a decrypted ID
@@ -33,15 +430,7 @@ def get_encid(decid):
     :param decid: Decrypted ID, type int
     :return: Encrypted ID, type str
     """
-    try:
-        int(decid)
-    except:
-        raise InvalidIDException('Decrypted ID must be int-castable')
-
-    # Slashes are not URL-friendly; replace them with dashes
-    # Also strip the base64 padding: it can be recovered.
-    cipher = AES.new(config.ID_ENCRYPTION_KEY, AES.MODE_CBC, config.ID_ENCRYPTION_IV)
-    return base64.b64encode(cipher.encrypt(_pad(str(decid))), ALTCHARS).rstrip('=')
+    return get_id_codec().encode(decid)
 
 
 def get_decid(encid, force=False):
@@ -54,37 +443,46 @@ def get_decid(encid, force=False):
     configured to expect only decrypted IDs, but encounters a (potentially valid) encrypted ID.
     The compromise solution here is to throw exceptions depending on the application's current configuration setting.
     Note that this will cause this function to exhibit different behavior depending on the application's configuration.
+    Short IDs are handled the same way as encrypted IDs, and either is accepted whichever of the two is configured.
 
-    :param encid: Encrypted ID, type str
+    :param encid: Encrypted ID or short ID, type str
     :param force: Forcefully decrypt the encid, regardless of the current configuration
     :return: Decrypted ID, type int
     """
+    use_decids = not config.USE_SHORT_IDS and not config.USE_ENCRYPTED_IDS
     try:
         assert int(encid) > 0
-        if not config.USE_ENCRYPTED_IDS:
+        if use_decids:
             # If we're not configured to use encids, we can assume the passed encid is already decrypted
             return encid
     except:
-        if not config.USE_ENCRYPTED_IDS and not force:
+        if use_decids and not force:
             # We expected a decid (e.g., an int-castable one)
             raise InvalidIDException('The encrypted ID is not valid')
 
-    try:
-        str(encid)
-        cipher = AES.new(config.ID_ENCRYPTION_KEY, AES.MODE_CBC, config.ID_ENCRYPTION_IV)
-        return int(cipher.decrypt(_base64_decode(str(encid))).rstrip(PADDING_CHAR))
-    except:
-        raise InvalidIDException('The encrypted ID is not valid')
+    # Short IDs are shorter than any encrypted ID, so links with either keep working when switching between the two
+    if is_short_id(encid):
+        return get_short_id_codec().decode(encid)
+    return get_id_codec().decode(encid)
 
 
 def get_id_repr(raw_id):
     """
-    Get either an encrypted ID or decrypted ID from the input ID given the application configuration
+    Get either a short ID, an encrypted ID, or a decrypted ID from the input ID given the application configuration
 
     :param id: ID to adapt to the current configuration
-    :return: Either an encrypted version of the ID or a decrypted version of the ID
+    :return: Either a short ID, an encrypted version of the ID, or a decrypted version of the ID
     """
-    if config.USE_ENCRYPTED_IDS:
+    if config.USE_SHORT_IDS:
+        if is_short_id(raw_id):
+            # Short IDs may consist of digits only, so a string of the form of a short ID is taken to be one already
+            return raw_id
+        try:
+            return get_short_id(raw_id)
+        except InvalidIDException:
+            # As below, assume that an ID that can't be shortened is already an ID representation
+            return raw_id
+    elif config.USE_ENCRYPTED_IDS:
         try:
             return get_encid(raw_id)
         except InvalidIDException:
@@ -95,9 +493,112 @@ def get_id_repr(raw_id):
         return get_decid(raw_id, force=True)
 
 
+def get_id_reprs(raw_ids):
+    """
+    Get the representations of several IDs at once, as get_id_repr would for each. With encrypted IDs, all IDs are
+    looked up in the ID codec's cache together, and only those not found are encrypted.
+
+    :param raw_ids: Iterable of decrypted IDs
+    :return: List of ID representations, in the same order
+    """
+    raw_ids = list(raw_ids)
+    if config.USE_SHORT_IDS or not config.USE_ENCRYPTED_IDS:
+        return [get_id_repr(raw_id) for raw_id in raw_ids]
+    try:
+        return get_id_codec().encode_many(raw_ids)
+    except InvalidIDException:
+        return [get_id_repr(raw_id) for raw_id in raw_ids]
+
+
+def hash_password(password, iterations=None):
+    """
+    Hash a password for storage, with PBKDF2-HMAC-SHA256 and a random salt. The result records the algorithm, the number
+    of iterations, and the salt alongside the hash, as algorithm$iterations$salt$hash, so that hashes made with other
+    parameters can still be verified and recognized as due for an upgrade.
+
+    :param password: Plain-text password to hash
+    :param iterations: Number of PBKDF2 iterations; defaults to config.PASSWORD_HASH_ITERATIONS
+    :return: A string of the versioned password hash
+    """
+    iterations = iterations or config.PASSWORD_HASH_ITERATIONS
+    salt = base64.b64encode(os.urandom(PASSWORD_SALT_SIZE))
+    return '{algorithm}${iterations}${salt}${hash}'.format(
+        algorithm=PASSWORD_HASH_ALGORITHM,
+        iterations=iterations,
+        salt=salt,
+        hash=_pbkdf2(password, salt, iterations),
+    )
+
+
+def verify_password(password, password_hash):
+    """
+    Check a password against a stored hash, in constant time. Both versioned hashes and legacy hashes made by
+    secure_hash are accepted.
+
+    :param password: Plain-text password to check
+    :param password_hash: Stored password hash
+    :return: True if the password matches the hash; False otherwise
+    """
+    if password is None or not password_hash:
+        return False
+
+    if '$' not in password_hash:
+        return hmac.compare_digest(secure_hash(password), str(password_hash))
+
+    try:
+        algorithm, iterations, salt, expected_hash = str(password_hash).split('$')
+        iterations = int(iterations)
+    except ValueError:
+        return False
+    if algorithm != PASSWORD_HASH_ALGORITHM:
+        return False
+    return hmac.compare_digest(_pbkdf2(password, salt, iterations), expected_hash)
+
+
+def password_needs_rehash(password_hash):
+    """
+    Check whether a stored password hash was made with other parameters than those currently configured, such that it
+    should be replaced the next time the password is known, e.g. on a successful login.
+
+    :param password_hash: Stored password hash
+    :return: True if the hash is a legacy hash, or uses another algorithm or number of iterations
+    """
+    parts = password_hash.split('$')
+    return len(parts) != 4 or parts[0] != PASSWORD_HASH_ALGORITHM or parts[1] != str(config.PASSWORD_HASH_ITERATIONS)
+
+
+def _pbkdf2(password, salt, iterations):
+    """
+    Derive the hash of a password with PBKDF2-HMAC-SHA256, computed natively by hashlib.
+
+    :param password: Plain-text password
+    :param salt: Salt string
+    :param iterations: Number of iterations
+    :return: Base64-encoded hash
+    """
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    return base64.b64encode(hashlib.pbkdf2_hmac('sha256', str(password), salt, iterations))
+
+
+def hash_file_name(file_name):
+    """
+    Derive the name under which an attachment file is stored from the attachment's file name. This is a single SHA-256
+    digest: the name only needs to be deterministic, safe to use on disk, and free of collisions, not slow to compute.
+
+    :param file_name: Name of the attachment file
+    :return: Hex SHA-256 digest of the file name
+    """
+    if isinstance(file_name, unicode):
+        file_name = file_name.encode('utf-8')
+    return hashlib.sha256(str(file_name)).hexdigest()
+
+
 def secure_hash(s, iterations=10000):
     """
-    Performs several iterations of a SHA256 hash of a plain-text string to generate a secure hash.
+    Performs several iterations of a SHA256 hash of a plain-text string to generate a secure hash. Passwords and
+    attachment file names are no longer hashed this way, but password hashes and attachment file names made before
+    hash_password and hash_file_name were introduced are still verified and looked up with it.
 
     :param s: Input string to hash
     :param iterations: Number of hash iterations to use
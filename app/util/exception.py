@@ -20,6 +20,10 @@ class PasteDoesNotExistException(Exception):
     pass
 
 
+class InvalidCursorException(Exception):
+    pass
+
+
 # Attachment
 
 
@@ -27,6 +31,26 @@ class AttachmentDoesNotExistException(Exception):
     pass
 
 
+class AttachmentTooLargeException(Exception):
+    pass
+
+
+class AttachmentQuotaExceededException(Exception):
+    pass
+
+
+class UploadSessionDoesNotExistException(Exception):
+    pass
+
+
+class InvalidUploadChunkException(Exception):
+    pass
+
+
+class IncompleteUploadException(Exception):
+    pass
+
+
 # Cryptography
 
 
@@ -0,0 +1,319 @@
+import binascii
+import calendar
+import mmap
+import os
+
+import flask
+from werkzeug.http import http_date
+from werkzeug.http import quote_etag
+from werkzeug.wsgi import wrap_file
+
+
+# Number of bytes of a memory-mapped or streamed file sent to the client at a time
+RANGE_CHUNK_SIZE = 64 * 1024
+# Maximum number of ranges served in a single response; requests for more ranges are answered with the entire file
+MAX_RANGES = 20
+
+
+def make_file_response(file_path, mime_type, etag=None, offset=0, length=None, last_modified=None):
+    """
+    Create a response for downloading a file, honoring conditional and byte range requests. A request whose
+    If-None-Match or If-Modified-Since validators match the file is answered with 304 Not Modified. A request with a
+    Range header is answered with 206 Partial Content, holding either a single range or a multipart/byteranges body for
+    several ranges, read from a memory-mapped copy of the file. Other requests receive the entire file.
+
+    The file may also be a region of a larger file, such as an attachment packed into a segment file, in which case only
+    that region is mapped and sent. The modification time of the larger file changes whenever another region is written
+    to it, so it is not used to validate the region; the caller may supply one that belongs to the region instead.
+
+    :param file_path: Path to the file to send
+    :param mime_type: MIME type of the file
+    :param etag: Strong entity tag identifying the file's contents, e.g. a digest of the contents (optional)
+    :param offset: Offset within the file at which the contents to send start
+    :param length: Number of bytes to send from offset; None to send the entire file
+    :param last_modified: Unix time at which the contents were last modified; defaults to the file's modification time
+                          when the entire file is sent (optional)
+    :return: A flask.Response for the current request
+    """
+    file_stat = os.stat(file_path)
+    file_size = file_stat.st_size if length is None else length
+    if last_modified is None and length is None:
+        last_modified = int(file_stat.st_mtime)
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    if etag:
+        headers['ETag'] = quote_etag(etag)
+
+    if _is_not_modified(etag, last_modified):
+        return flask.Response(status=304, headers=headers)
+
+    ranges = None
+    if _is_range_current(etag, last_modified):
+        ranges = parse_range_header(flask.request.headers.get('Range'), file_size)
+
+    if ranges is None:
+        headers['Content-Length'] = str(file_size)
+        if length is None:
+            return flask.Response(
+                # Stream the file rather than reading it into memory; WSGI servers can send it with sendfile(2)
+                wrap_file(flask.request.environ, open(file_path, 'rb')),
+                mimetype=mime_type,
+                headers=headers,
+                direct_passthrough=True,
+            )
+        if not file_size:
+            return flask.Response('', mimetype=mime_type, headers=headers)
+        ranges = [(0, file_size - 1)]
+        status = 200
+    elif not ranges:
+        headers['Content-Range'] = 'bytes */{file_size}'.format(file_size=file_size)
+        return flask.Response(status=416, headers=headers)
+    else:
+        status = 206
+
+    # Only the pages holding the contents are mapped; mappings must start at a multiple of the allocation granularity
+    map_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(file_path, 'rb') as range_file:
+        file_map = mmap.mmap(
+            range_file.fileno(),
+            offset - map_offset + ranges[-1][1] + 1,
+            access=mmap.ACCESS_READ,
+            offset=map_offset,
+        )
+
+    return _make_ranges_response(file_map, offset - map_offset, file_size, ranges, status, mime_type, headers)
+
+
+def make_data_response(data, mime_type, etag=None, last_modified=None):
+    """
+    Create a response for downloading a file whose contents are held in memory, e.g. an attachment stored in the
+    database, honoring conditional and byte range requests in the same way as make_file_response.
+
+    :param data: String of the file's contents
+    :param mime_type: MIME type of the file
+    :param etag: Strong entity tag identifying the file's contents, e.g. a digest of the contents (optional)
+    :param last_modified: Unix time at which the file was last modified (optional)
+    :return: A flask.Response for the current request
+    """
+    headers = {
+        'Accept-Ranges': 'bytes',
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    if etag:
+        headers['ETag'] = quote_etag(etag)
+
+    if _is_not_modified(etag, last_modified):
+        return flask.Response(status=304, headers=headers)
+
+    ranges = None
+    if _is_range_current(etag, last_modified):
+        ranges = parse_range_header(flask.request.headers.get('Range'), len(data))
+
+    if ranges is None:
+        headers['Content-Length'] = str(len(data))
+        return flask.Response(data, mimetype=mime_type, headers=headers)
+    if not ranges:
+        headers['Content-Range'] = 'bytes */{file_size}'.format(file_size=len(data))
+        return flask.Response(status=416, headers=headers)
+
+    return _make_ranges_response(data, 0, len(data), ranges, 206, mime_type, headers)
+
+
+def make_stream_response(stream, mime_type, etag=None):
+    """
+    Create a response streaming a file from a file-like object, e.g. the body of an object downloaded from an object
+    store. A request whose If-None-Match validator matches the file is answered with 304 Not Modified; since the stream
+    can only be read in order, Range headers are ignored and the entire file is sent.
+
+    :param stream: File-like object from which the file's contents are read; it is closed once the response is sent
+    :param mime_type: MIME type of the file
+    :param etag: Strong entity tag identifying the file's contents, e.g. a digest of the contents (optional)
+    :return: A flask.Response for the current request
+    """
+    headers = {
+        'Accept-Ranges': 'none',
+    }
+    if etag:
+        headers['ETag'] = quote_etag(etag)
+
+    if _is_not_modified(etag, None):
+        stream.close()
+        return flask.Response(status=304, headers=headers)
+
+    return flask.Response(
+        wrap_file(flask.request.environ, stream, buffer_size=RANGE_CHUNK_SIZE),
+        mimetype=mime_type,
+        headers=headers,
+        direct_passthrough=True,
+    )
+
+
+def _make_ranges_response(contents, base, file_size, ranges, status, mime_type, headers):
+    """
+    Create a response holding byte ranges of a file, either as a single range or as a multipart/byteranges body.
+
+    :param contents: Sliceable object holding the file's contents, e.g. an mmap.mmap of the file or a string
+    :param base: Offset within contents at which the file starts
+    :param file_size: Size of the file in bytes
+    :param ranges: Non-empty, sorted list of (first byte, last byte) tuples to send, inclusive
+    :param status: HTTP status code of the response; 200 if the ranges make up the entire file, 206 otherwise
+    :param mime_type: MIME type of the file
+    :param headers: Dictionary of headers to send with the response
+    :return: A flask.Response
+    """
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        if status == 206:
+            headers['Content-Range'] = _content_range(start, end, file_size)
+        headers['Content-Length'] = str(end - start + 1)
+        return flask.Response(
+            _iter_ranges(contents, [('', base + start, base + end)], ''),
+            status=status,
+            mimetype=mime_type,
+            headers=headers,
+            direct_passthrough=True,
+        )
+
+    boundary = binascii.hexlify(os.urandom(16))
+    parts = [
+        (
+            '\r\n--{boundary}\r\nContent-Type: {mime_type}\r\nContent-Range: {content_range}\r\n\r\n'.format(
+                boundary=boundary,
+                mime_type=mime_type,
+                content_range=_content_range(range_start, range_end, file_size),
+            ),
+            base + range_start,
+            base + range_end,
+        )
+        for range_start, range_end in ranges
+    ]
+    trailer = '\r\n--{boundary}--\r\n'.format(boundary=boundary)
+    headers['Content-Length'] = str(
+        sum(len(part_header) + part_end - part_start + 1 for part_header, part_start, part_end in parts) + len(trailer)
+    )
+    return flask.Response(
+        _iter_ranges(contents, parts, trailer),
+        status=206,
+        content_type='multipart/byteranges; boundary={boundary}'.format(boundary=boundary),
+        headers=headers,
+        direct_passthrough=True,
+    )
+
+
+def parse_range_header(range_header, file_size):
+    """
+    Parse the value of a Range header into the byte ranges of a file to send. Ranges are clamped to the end of the file,
+    and overlapping or adjacent ranges are merged.
+
+    :param range_header: Value of the Range header, or None if the request has none
+    :param file_size: Size of the file in bytes
+    :return: Sorted list of (first byte, last byte) tuples, inclusive; an empty list if none of the ranges can be
+             satisfied; or None if the entire file should be sent, because the header is absent, malformed, or asks for
+             more than MAX_RANGES ranges
+    """
+    if not range_header:
+        return None
+    units, _, range_set = range_header.partition('=')
+    if units.strip() != 'bytes':
+        return None
+
+    ranges = []
+    range_specs = range_set.split(',')
+    if len(range_specs) > MAX_RANGES:
+        return None
+    for range_spec in range_specs:
+        first, dash, last = range_spec.strip().partition('-')
+        if not dash or not (first + last).isdigit():
+            return None
+        if not first:
+            # Suffix range, holding the last bytes of the file
+            if int(last) > 0 and file_size > 0:
+                ranges.append((max(file_size - int(last), 0), file_size - 1))
+            continue
+        if last and int(last) < int(first):
+            return None
+        if int(first) < file_size:
+            ranges.append((int(first), min(int(last), file_size - 1) if last else file_size - 1))
+
+    merged_ranges = []
+    for start, end in sorted(ranges):
+        if merged_ranges and start <= merged_ranges[-1][1] + 1:
+            merged_ranges[-1] = (merged_ranges[-1][0], max(merged_ranges[-1][1], end))
+        else:
+            merged_ranges.append((start, end))
+    return merged_ranges
+
+
+def _is_not_modified(etag, last_modified):
+    """
+    Evaluate the If-None-Match and If-Modified-Since headers of the current request. If-Modified-Since is only
+    considered if the request has no If-None-Match header.
+
+    :param etag: Entity tag of the file, or None
+    :param last_modified: Unix time at which the file was last modified, or None
+    :return: True if the client's cached copy of the file is current
+    """
+    if flask.request.headers.get('If-None-Match'):
+        return etag is not None and flask.request.if_none_match.contains_weak(etag)
+    if_modified_since = flask.request.if_modified_since
+    return (
+        if_modified_since is not None and
+        last_modified is not None and
+        last_modified <= calendar.timegm(if_modified_since.utctimetuple())
+    )
+
+
+def _is_range_current(etag, last_modified):
+    """
+    Evaluate the If-Range header of the current request, which asks for a range only if the file is unchanged.
+
+    :param etag: Entity tag of the file, or None
+    :param last_modified: Unix time at which the file was last modified, or None
+    :return: True if the Range header should be honored
+    """
+    if not flask.request.headers.get('If-Range'):
+        return True
+    if_range = flask.request.if_range
+    if if_range.etag:
+        return etag is not None and if_range.etag == etag
+    return if_range.date is not None and calendar.timegm(if_range.date.utctimetuple()) == last_modified
+
+
+def _content_range(start, end, file_size):
+    """
+    Format the value of a Content-Range header.
+
+    :param start: First byte of the range
+    :param end: Last byte of the range, inclusive
+    :param file_size: Size of the file in bytes
+    :return: Content-Range header value
+    """
+    return 'bytes {start}-{end}/{file_size}'.format(start=start, end=end, file_size=file_size)
+
+
+def _iter_ranges(contents, parts, trailer):
+    """
+    Generate the body of a partial content response. A memory-mapped file is unmapped once the body has been sent, or
+    the response is closed.
+
+    :param contents: Sliceable object holding the file's contents, e.g. an mmap.mmap of the file or a string
+    :param parts: List of (part header, first byte, last byte) tuples for each range, as offsets within contents
+    :param trailer: String sent after the last range
+    :return: Generator of strings
+    """
+    try:
+        for part_header, start, end in parts:
+            if part_header:
+                yield part_header
+            for offset in xrange(start, end + 1, RANGE_CHUNK_SIZE):
+                yield contents[offset:min(offset + RANGE_CHUNK_SIZE, end + 1)]
+        if trailer:
+            yield trailer
+    finally:
+        if isinstance(contents, mmap.mmap):
+            contents.close()
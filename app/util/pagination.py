@@ -0,0 +1,38 @@
+import base64
+
+import util.cryptography
+from util.exception import InvalidCursorException
+from util.exception import InvalidIDException
+
+
+def encode_cursor(sort_value, paste_id):
+    """
+    Encode the position of a paste within a sorted listing as an opaque cursor, from which the next page of the listing
+    can be resumed. The paste ID is represented as required by the application configuration, so that a cursor never
+    reveals a decrypted ID when encrypted IDs are in use.
+
+    :param sort_value: Value of the column by which the listing is sorted, e.g. post time or number of views
+    :param paste_id: ID of the paste
+    :return: URL-safe cursor string
+    """
+    return base64.urlsafe_b64encode('{sort_value}:{paste_id}'.format(
+        sort_value=int(sort_value),
+        paste_id=util.cryptography.get_id_repr(paste_id),
+    )).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor generated by encode_cursor.
+
+    :param cursor: Cursor string
+    :return: Tuple of (sort value, paste ID)
+    :raises InvalidCursorException: If the cursor is malformed or contains an invalid ID
+    """
+    try:
+        cursor = str(cursor)
+        sort_value, paste_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).split(':', 1)
+        return int(sort_value), int(util.cryptography.get_decid(paste_id))
+    except (TypeError, ValueError, UnicodeError, InvalidIDException):
+        # The cursor is not interpolated as it is, since it may be unicode that cannot be encoded as ASCII
+        raise InvalidCursorException('The cursor {cursor} is not valid'.format(cursor=repr(cursor)))
@@ -0,0 +1,124 @@
+import base64
+import hashlib
+import hmac
+import time
+
+import flask
+
+import config
+import util.cryptography
+
+
+# Request header, GET or JSON parameter, and cookie from which an unlock token is read, in that order
+UNLOCK_TOKEN_HEADER = 'X-Paste-Unlock-Token'
+UNLOCK_TOKEN_PARAM = 'unlock_token'
+UNLOCK_TOKEN_COOKIE = 'paste_unlock_token'
+
+
+def make_unlock_token(paste, expiry_time=None):
+    """
+    Create a token unlocking a password-protected paste, once its password has been verified. The token is an HMAC,
+    keyed with config.FLASK_SECRET_KEY, of the paste's ID, the token's expiry time, and the paste's current password
+    hash, so it is only valid for that paste, until it expires or the paste's password is changed.
+
+    :param paste: An instance of models.Paste with a password
+    :param expiry_time: UNIX timestamp at which the token expires; defaults to config.PASTE_UNLOCK_TOKEN_LIFETIME
+                        seconds from now
+    :return: A string of the token, of the form <expiry time>.<signature>
+    """
+    if expiry_time is None:
+        expiry_time = int(time.time()) + config.PASTE_UNLOCK_TOKEN_LIFETIME
+    return '{expiry_time}.{signature}'.format(
+        expiry_time=expiry_time,
+        signature=_sign(paste, expiry_time),
+    )
+
+
+def verify_unlock_token(paste, token):
+    """
+    Check whether a token unlocks a password-protected paste. This takes a single HMAC, rather than a hash of the
+    password.
+
+    :param paste: An instance of models.Paste with a password
+    :param token: Token string, as returned by make_unlock_token, or None
+    :return: True if the token was issued for this paste and its current password, and has not expired
+    """
+    if not token or not paste.password_hash:
+        return False
+    try:
+        expiry_time, signature = str(token).split('.')
+        expiry_time = int(expiry_time)
+    except (ValueError, UnicodeEncodeError):
+        return False
+    if expiry_time <= time.time():
+        return False
+    return hmac.compare_digest(_sign(paste, expiry_time), signature)
+
+
+def get_request_unlock_token():
+    """
+    Get the unlock token supplied with the current request, if any.
+
+    :return: The token string, or None
+    """
+    data = flask.request.get_json(silent=True)
+    return (
+        flask.request.headers.get(UNLOCK_TOKEN_HEADER) or
+        flask.request.args.get(UNLOCK_TOKEN_PARAM) or
+        (data.get(UNLOCK_TOKEN_PARAM) if isinstance(data, dict) else None) or
+        flask.request.cookies.get(UNLOCK_TOKEN_COOKIE)
+    )
+
+
+def unlock_paste(paste, password=None):
+    """
+    Unlock a password-protected paste for the current request, with either an unlock token supplied with the request,
+    or the paste's password. The password is only hashed if no valid token is supplied.
+
+    :param paste: An instance of models.Paste with a password
+    :param password: Plain-text password supplied with the request, if any
+    :return: An unlock token for the paste if it is unlocked, to be returned to the client; None otherwise
+    """
+    token = get_request_unlock_token()
+    if verify_unlock_token(paste, token):
+        return token
+    if password and util.cryptography.verify_password(password, paste.password_hash):
+        return make_unlock_token(paste)
+    return None
+
+
+def set_unlock_cookie(resp, paste, token):
+    """
+    Store an unlock token in a cookie, scoped to the web interface paths of its paste, such as the raw view and
+    attachment downloads, so that later requests for them need not carry the password.
+
+    :param resp: A flask.Response to set the cookie on
+    :param paste: An instance of models.Paste that the token unlocks
+    :param token: Token string
+    :return: The response
+    """
+    resp.set_cookie(
+        UNLOCK_TOKEN_COOKIE,
+        token,
+        max_age=config.PASTE_UNLOCK_TOKEN_LIFETIME,
+        path='/paste/{paste_id}/'.format(paste_id=util.cryptography.get_id_repr(paste.paste_id)),
+        httponly=True,
+    )
+    return resp
+
+
+def _sign(paste, expiry_time):
+    """
+    Compute the signature of an unlock token.
+
+    :param paste: An instance of models.Paste with a password
+    :param expiry_time: UNIX timestamp at which the token expires
+    :return: URL-safe base64-encoded HMAC-SHA256 signature, without padding
+    """
+    message = 'paste-unlock:{paste_id}:{expiry_time}:{password_hash}'.format(
+        paste_id=paste.paste_id,
+        expiry_time=expiry_time,
+        password_hash=paste.password_hash,
+    )
+    digest = hmac.new(config.FLASK_SECRET_KEY, message.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip('=')
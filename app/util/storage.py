@@ -0,0 +1,313 @@
+import errno
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+import config
+
+
+class StorageBackend(object):
+    """
+    Storage for attachment files, addressed by keys that are relative paths, e.g. 'blobs/3f/a2/<digest>'.
+    """
+
+    # Name of the backend, as set in config.ATTACHMENT_STORAGE_BACKEND
+    name = None
+    # True if files are stored on the local filesystem, so they can be memory-mapped or served by the web server
+    is_local = False
+
+    def exists(self, key):
+        """
+        Check whether a file is stored under a key.
+
+        :param key: Key of the file
+        :return: True if the file exists
+        """
+        raise NotImplementedError
+
+    def put(self, key, data):
+        """
+        Store a file, replacing any file already stored under the same key. A partially stored file is never visible.
+
+        :param key: Key of the file
+        :param data: String of the file's contents
+        """
+        raise NotImplementedError
+
+    def put_file(self, key, file_path):
+        """
+        Store the contents of a local file, replacing any file already stored under the same key. The local file is
+        consumed: it is moved into storage, or deleted once its contents are stored.
+
+        :param key: Key of the file
+        :param file_path: Path to the local file
+        """
+        raise NotImplementedError
+
+    def open(self, key):
+        """
+        Open a stored file for reading. The contents are streamed, rather than read into memory at once.
+
+        :param key: Key of the file
+        :return: A file-like object with read() and close() methods
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """
+        Delete a stored file, if it exists.
+
+        :param key: Key of the file
+        """
+        raise NotImplementedError
+
+    def get_local_path(self, key):
+        """
+        Get the path to a stored file on the local filesystem.
+
+        :param key: Key of the file
+        :return: Path to the file, or None if files are not stored locally
+        """
+        return None
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Storage of attachment files under config.ATTACHMENTS_DIR.
+    """
+
+    name = 'local'
+    is_local = True
+
+    def exists(self, key):
+        return os.path.exists(self.get_local_path(key))
+
+    def put(self, key, data):
+        file_path = self.get_local_path(key)
+        _make_parent_dir(file_path)
+        # Write to a temporary file first, so that a partially written file is never visible
+        temp_file_path = '{file_path}.{pid}.{thread}.tmp'.format(
+            file_path=file_path,
+            pid=os.getpid(),
+            thread=threading.current_thread().ident,
+        )
+        with open(temp_file_path, 'wb') as temp_file:
+            temp_file.write(data)
+        os.rename(temp_file_path, file_path)
+
+    def put_file(self, key, file_path):
+        dest_file_path = self.get_local_path(key)
+        _make_parent_dir(dest_file_path)
+        # mkstemp creates files readable only by their owner
+        os.chmod(file_path, 0o644)
+        os.rename(file_path, dest_file_path)
+
+    def open(self, key):
+        return open(self.get_local_path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(self.get_local_path(key))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def get_local_path(self, key):
+        return '{attachments_dir}/{key}'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+            key=key,
+        )
+
+
+class S3StorageBackend(StorageBackend):
+    """
+    Storage of attachment files in a bucket of Amazon S3 or an S3-compatible object store, such as MinIO. Files larger
+    than multipart_threshold are uploaded in parts of multipart_chunk_size bytes, max_concurrency parts at a time.
+    """
+
+    name = 's3'
+    is_local = False
+
+    def __init__(
+        self,
+        bucket,
+        prefix='',
+        endpoint_url=None,
+        region_name=None,
+        access_key_id=None,
+        secret_access_key=None,
+        multipart_threshold=16 * 1024 * 1024,
+        multipart_chunk_size=8 * 1024 * 1024,
+        max_concurrency=8,
+    ):
+        """
+        :param bucket: Name of the bucket holding the files
+        :param prefix: Prefix of the keys of all files in the bucket, e.g. 'attachments/'
+        :param endpoint_url: URL of an S3-compatible object store; None for Amazon S3
+        :param region_name: Region of the bucket (optional)
+        :param access_key_id: Access key ID; None to use the default credentials of the environment
+        :param secret_access_key: Secret access key; None to use the default credentials of the environment
+        :param multipart_threshold: Size in bytes from which files are uploaded in parts
+        :param multipart_chunk_size: Size in bytes of each part but the last; S3 requires at least 5 MB
+        :param max_concurrency: Maximum number of parts uploaded at a time
+        """
+        # boto3 is only required if attachments are stored in S3
+        import boto3
+        import botocore.config
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunk_size = multipart_chunk_size
+        self.max_concurrency = max_concurrency
+        # boto3 clients are thread-safe, so a single client is shared by all requests and upload threads
+        self.client = boto3.session.Session().client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region_name,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            config=botocore.config.Config(max_pool_connections=max(10, max_concurrency)),
+        )
+
+    def exists(self, key):
+        import botocore.exceptions
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._get_object_key(key))
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._get_object_key(key), Body=data)
+
+    def put_file(self, key, file_path):
+        file_size = os.path.getsize(file_path)
+        if file_size < self.multipart_threshold:
+            with open(file_path, 'rb') as upload_file:
+                self.put(key, upload_file.read())
+        else:
+            self._put_file_multipart(key, file_path, file_size)
+        os.remove(file_path)
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self._get_object_key(key))['Body']
+
+    def delete(self, key):
+        # Deleting a nonexistent object is not an error in S3
+        self.client.delete_object(Bucket=self.bucket, Key=self._get_object_key(key))
+
+    def _put_file_multipart(self, key, file_path, file_size):
+        """
+        Upload a local file in parts, several parts at a time from a pool of threads. Each thread reads its own part
+        from the file, so at most max_concurrency parts are held in memory. The upload is aborted if any part fails,
+        so that the parts uploaded so far do not linger in the bucket.
+
+        :param key: Key of the file
+        :param file_path: Path to the local file
+        :param file_size: Size of the file in bytes
+        """
+        object_key = self._get_object_key(key)
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=object_key)['UploadId']
+
+        def upload_part(part_number):
+            with open(file_path, 'rb') as upload_file:
+                upload_file.seek((part_number - 1) * self.multipart_chunk_size)
+                body = upload_file.read(self.multipart_chunk_size)
+            resp = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=object_key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body,
+            )
+            return {'PartNumber': part_number, 'ETag': resp['ETag']}
+
+        part_count = max(1, (file_size + self.multipart_chunk_size - 1) // self.multipart_chunk_size)
+        pool = ThreadPool(min(self.max_concurrency, part_count))
+        try:
+            parts = pool.map(upload_part, range(1, part_count + 1))
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=object_key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+            )
+        except:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=object_key, UploadId=upload_id)
+            raise
+        finally:
+            pool.close()
+            pool.join()
+
+    def _get_object_key(self, key):
+        """
+        Get the key of a file's object in the bucket.
+
+        :param key: Key of the file
+        :return: Object key, including the configured prefix
+        """
+        return '{prefix}{key}'.format(prefix=self.prefix, key=key)
+
+
+def _make_parent_dir(file_path):
+    """
+    Create the directory holding a file, if it doesn't already exist.
+
+    :param file_path: Path to the file
+    """
+    try:
+        os.makedirs(os.path.dirname(file_path))
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+_storage_backend = None
+_storage_backend_lock = threading.Lock()
+
+
+def get_storage_backend():
+    """
+    Get the process-wide storage backend for attachment files, creating it from the application configuration if
+    necessary.
+
+    :return: The StorageBackend instance for this process
+    :raises ValueError: If config.ATTACHMENT_STORAGE_BACKEND names an unknown backend
+    """
+    global _storage_backend
+    # The backend is created again if the configuration changes, e.g. between tests
+    if _storage_backend is None or _storage_backend.name != config.ATTACHMENT_STORAGE_BACKEND:
+        with _storage_backend_lock:
+            if _storage_backend is None or _storage_backend.name != config.ATTACHMENT_STORAGE_BACKEND:
+                _storage_backend = _create_storage_backend()
+    return _storage_backend
+
+
+def _create_storage_backend():
+    """
+    Create the storage backend named by config.ATTACHMENT_STORAGE_BACKEND.
+
+    :return: A new StorageBackend instance
+    :raises ValueError: If the backend is unknown
+    """
+    if config.ATTACHMENT_STORAGE_BACKEND == LocalStorageBackend.name:
+        return LocalStorageBackend()
+    if config.ATTACHMENT_STORAGE_BACKEND == S3StorageBackend.name:
+        return S3StorageBackend(
+            bucket=config.ATTACHMENT_S3_BUCKET,
+            prefix=config.ATTACHMENT_S3_PREFIX,
+            endpoint_url=config.ATTACHMENT_S3_ENDPOINT_URL,
+            region_name=config.ATTACHMENT_S3_REGION,
+            access_key_id=config.ATTACHMENT_S3_ACCESS_KEY_ID,
+            secret_access_key=config.ATTACHMENT_S3_SECRET_ACCESS_KEY,
+            multipart_threshold=config.ATTACHMENT_S3_MULTIPART_THRESHOLD,
+            multipart_chunk_size=config.ATTACHMENT_S3_MULTIPART_CHUNK_SIZE,
+            max_concurrency=config.ATTACHMENT_S3_MAX_CONCURRENCY,
+        )
+    raise ValueError('Unknown attachment storage backend {backend}'.format(
+        backend=config.ATTACHMENT_STORAGE_BACKEND,
+    ))
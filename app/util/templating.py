@@ -95,7 +95,7 @@ def get_uri_path():
 def get_id_repr():
     """
     Templating utility to encode any ID in the form required by the application, as specified by
-    config.USE_ENCRYPTED_IDS. This function simply exports util.cryptography.get_id_repr.
+    config.USE_SHORT_IDS and config.USE_ENCRYPTED_IDS. This function simply exports util.cryptography.get_id_repr.
     """
     return dict(id_repr=util.cryptography.get_id_repr)
 
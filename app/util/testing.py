@@ -7,6 +7,7 @@ import mock
 from flask_login import login_user
 from flask_login import logout_user
 from flask_testing import TestCase
+from sqlalchemy import event
 
 import config
 import constants.api
@@ -31,6 +32,31 @@ def random_alphanumeric_string(length=64):
     return ''.join([random.choice(list(alphabet) + list(alphabet.upper()) + list(numbers)) for i in range(length)])
 
 
+class QueryCounter:
+    """
+    Context manager that counts the SQL statements issued against the application database while it is active.
+
+        with QueryCounter() as counter:
+            database.paste.view_paste(paste_id)
+        print counter.count
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+
 class Factory:
     def __init__(self):
         pass
@@ -128,10 +154,28 @@ class DatabaseTestCase(TestCase):
         Initializes the test Flask application by setting the app config parameters appropriately.
         """
         # Default config parameters for test environment
+        config.USE_ENCRYPTED_IDS = False
+        config.USE_SHORT_IDS = False
         config.REQUIRE_LOGIN_TO_PASTE = False
         config.ENABLE_USER_REGISTRATION = True
         config.ENABLE_PASTE_ATTACHMENTS = True
         config.MAX_ATTACHMENT_SIZE = 0
+        config.MAX_USER_ATTACHMENTS_SIZE = 0
+        config.MAX_USER_ATTACHMENTS_COUNT = 0
+        config.MAX_PASTE_ATTACHMENTS_SIZE = 0
+        config.MAX_PASTE_ATTACHMENTS_COUNT = 0
+        config.ATTACHMENTS_DIR_LEVELS = 2
+        config.ATTACHMENT_INLINE_MAX_FILE_SIZE = 0
+        config.ATTACHMENT_STORAGE_BACKEND = 'local'
+        config.ENABLE_ATTACHMENT_SEGMENTS = False
+        config.ATTACHMENT_SENDFILE_HEADER = None
+        config.UPLOAD_SESSION_CHUNK_SIZE = 1024 * 1024
+        config.UPLOAD_SESSION_MAX_FILE_SIZE = 1024
+        config.ENABLE_VIEW_COUNT_BUFFER = False
+        config.ENABLE_TOP_PASTES_LEADERBOARD = False
+        config.ENABLE_EXPIRY_SCHEDULER = False
+        # Password hashing is kept cheap, since most tests create users and pastes with passwords
+        config.PASSWORD_HASH_ITERATIONS = 1000
 
         app.config['TESTING'] = True
         app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
@@ -0,0 +1,235 @@
+import struct
+import time
+import zlib
+
+
+# Compression level of deflated entries; lower levels trade a slightly larger archive for less CPU per request
+DEFLATE_LEVEL = 6
+# Largest size or offset that fits in the 32-bit fields of a ZIP archive; larger values require ZIP64 extensions
+ZIP64_LIMIT = 0xFFFFFFFF
+# Largest number of entries that fits in the 16-bit fields of the end of central directory record
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+# Types whose contents are already compressed, and would only waste CPU being deflated again
+COMPRESSED_MIME_TYPE_PREFIXES = ('image/', 'video/', 'audio/')
+UNCOMPRESSED_MIME_TYPES = frozenset([
+    'image/bmp',
+    'image/svg+xml',
+    'image/tiff',
+    'image/x-icon',
+    'image/x-ms-bmp',
+    'audio/wav',
+    'audio/x-wav',
+])
+COMPRESSED_MIME_TYPES = frozenset([
+    'application/epub+zip',
+    'application/gzip',
+    'application/java-archive',
+    'application/pdf',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/x-7z-compressed',
+    'application/x-bzip2',
+    'application/x-gzip',
+    'application/x-rar-compressed',
+    'application/x-xz',
+    'application/zip',
+])
+
+_LOCAL_FILE_HEADER = struct.Struct('<IHHHHHIIIHH')
+_DATA_DESCRIPTOR = struct.Struct('<IIII')
+_DATA_DESCRIPTOR_64 = struct.Struct('<IIQQ')
+_CENTRAL_DIRECTORY_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_OF_CENTRAL_DIRECTORY = struct.Struct('<IHHHHIIH')
+_END_OF_CENTRAL_DIRECTORY_64 = struct.Struct('<IQHHIIQQQQ')
+_END_OF_CENTRAL_DIRECTORY_64_LOCATOR = struct.Struct('<IIQI')
+
+# Flags of each entry: sizes and CRC follow the data in a data descriptor, and the file name is UTF-8
+_FLAGS = 0x08 | 0x800
+_STORED = 0
+_DEFLATED = 8
+# Entries are marked as made on Unix, so that the external attributes carry the file mode
+_MADE_BY_UNIX = 3 << 8
+_FILE_MODE = 0o100644
+
+
+def is_compressed_mime_type(mime_type):
+    """
+    Check whether files of a MIME type are already compressed, such that they should be stored in an archive as they
+    are rather than deflated.
+
+    :param mime_type: MIME type of the file
+    :return: True if the file should be stored without compression
+    """
+    mime_type = (mime_type or '').split(';')[0].strip().lower()
+    if mime_type in COMPRESSED_MIME_TYPES:
+        return True
+    return mime_type.startswith(COMPRESSED_MIME_TYPE_PREFIXES) and mime_type not in UNCOMPRESSED_MIME_TYPES
+
+
+def iter_zip(entries, modified_time=None):
+    """
+    Generate a ZIP archive piece by piece, without ever holding more than one chunk of an entry in memory or seeking
+    back into the output. Each entry's CRC and sizes are only known once its contents have been written, so they follow
+    the contents in a data descriptor, and are repeated in the central directory at the end of the archive. ZIP64
+    extensions are used for entries, offsets, and counts that do not fit in the original format.
+
+    :param entries: Iterable of tuples of (file name, file size in bytes or None if unknown, True to deflate the
+                    contents or False to store them as they are, iterable of strings of the file's contents)
+    :param modified_time: UNIX timestamp recorded as the modification time of every entry; defaults to now
+    :return: A generator of strings making up the archive
+    """
+    dos_time, dos_date = _get_dos_date_time(modified_time)
+    central_directory = []
+    offset = 0
+
+    for file_name, file_size, compress, chunks in entries:
+        if isinstance(file_name, unicode):
+            file_name = file_name.encode('utf-8')
+        method = _DEFLATED if compress else _STORED
+        # The sizes are not known before the contents are read, so whether an entry needs ZIP64 fields is decided from
+        # the largest size it could have
+        zip64 = file_size is None or _get_max_compressed_size(file_size, compress) >= ZIP64_LIMIT
+        version = 45 if zip64 else 20
+        # A ZIP64 extra field with zero sizes tells readers to expect 64-bit sizes in the data descriptor
+        extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0) if zip64 else ''
+
+        header = _LOCAL_FILE_HEADER.pack(
+            0x04034b50,
+            version,
+            _FLAGS,
+            method,
+            dos_time,
+            dos_date,
+            0,
+            ZIP64_LIMIT if zip64 else 0,
+            ZIP64_LIMIT if zip64 else 0,
+            len(file_name),
+            len(extra),
+        ) + file_name + extra
+        yield header
+
+        crc = 0
+        uncompressed_size = 0
+        compressed_size = 0
+        compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS) if compress else None
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            uncompressed_size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                compressed_size += len(chunk)
+                yield chunk
+        if compressor:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            yield chunk
+
+        if not zip64 and max(compressed_size, uncompressed_size) >= ZIP64_LIMIT:
+            raise ValueError('Entry {file_name} is larger than its stated size'.format(file_name=file_name))
+        crc &= 0xFFFFFFFF
+        data_descriptor = _DATA_DESCRIPTOR_64 if zip64 else _DATA_DESCRIPTOR
+        yield data_descriptor.pack(0x08074b50, crc, compressed_size, uncompressed_size)
+
+        central_directory.append((
+            file_name, version, method, crc, compressed_size, uncompressed_size, offset,
+        ))
+        offset += len(header) + compressed_size + data_descriptor.size
+
+    central_directory_offset = offset
+    for file_name, version, method, crc, compressed_size, uncompressed_size, header_offset in central_directory:
+        # Values too large for their 32-bit fields are moved to the ZIP64 extra field, in this order
+        zip64_values = [
+            value for value in (uncompressed_size, compressed_size, header_offset)
+            if value >= ZIP64_LIMIT
+        ]
+        extra = ''
+        if zip64_values:
+            version = 45
+            extra = struct.pack(
+                '<HH{count}Q'.format(count=len(zip64_values)),
+                0x0001,
+                8 * len(zip64_values),
+                *zip64_values
+            )
+        record = _CENTRAL_DIRECTORY_HEADER.pack(
+            0x02014b50,
+            _MADE_BY_UNIX | version,
+            version,
+            _FLAGS,
+            method,
+            dos_time,
+            dos_date,
+            crc,
+            min(compressed_size, ZIP64_LIMIT),
+            min(uncompressed_size, ZIP64_LIMIT),
+            len(file_name),
+            len(extra),
+            0,
+            0,
+            0,
+            _FILE_MODE << 16,
+            min(header_offset, ZIP64_LIMIT),
+        ) + file_name + extra
+        offset += len(record)
+        yield record
+
+    count = len(central_directory)
+    central_directory_size = offset - central_directory_offset
+    if count >= ZIP64_COUNT_LIMIT or central_directory_size >= ZIP64_LIMIT or central_directory_offset >= ZIP64_LIMIT:
+        yield _END_OF_CENTRAL_DIRECTORY_64.pack(
+            0x06064b50,
+            _END_OF_CENTRAL_DIRECTORY_64.size - 12,
+            _MADE_BY_UNIX | 45,
+            45,
+            0,
+            0,
+            count,
+            count,
+            central_directory_size,
+            central_directory_offset,
+        )
+        yield _END_OF_CENTRAL_DIRECTORY_64_LOCATOR.pack(0x07064b50, 0, offset, 1)
+    yield _END_OF_CENTRAL_DIRECTORY.pack(
+        0x06054b50,
+        0,
+        0,
+        min(count, ZIP64_COUNT_LIMIT),
+        min(count, ZIP64_COUNT_LIMIT),
+        min(central_directory_size, ZIP64_LIMIT),
+        min(central_directory_offset, ZIP64_LIMIT),
+        0,
+    )
+
+
+def _get_max_compressed_size(file_size, compress):
+    """
+    Get the largest size an entry's contents can take in the archive.
+
+    :param file_size: Size of the contents in bytes
+    :param compress: True if the contents are deflated
+    :return: Upper bound of the size of the stored contents in bytes
+    """
+    if not compress:
+        return file_size
+    # Deflating incompressible data adds a few bytes of overhead per block, per zlib's deflateBound()
+    return file_size + (file_size >> 12) + (file_size >> 14) + (file_size >> 25) + 13
+
+
+def _get_dos_date_time(timestamp):
+    """
+    Convert a UNIX timestamp to the MS-DOS time and date fields used by ZIP archives.
+
+    :param timestamp: UNIX timestamp, or None for now
+    :return: Tuple of (DOS time, DOS date)
+    """
+    date_time = time.localtime(time.time() if timestamp is None else timestamp)
+    # MS-DOS dates start in 1980
+    if date_time.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (
+        (date_time.tm_hour << 11) | (date_time.tm_min << 5) | (date_time.tm_sec // 2),
+        ((date_time.tm_year - 1980) << 9) | (date_time.tm_mon << 5) | date_time.tm_mday,
+    )
@@ -1,4 +1,5 @@
 import base64
+import hashlib
 
 import flask
 
@@ -6,6 +7,10 @@ import config
 import database.attachment
 import database.paste
 import util.cryptography
+import util.file_response
+import util.paste_unlock
+import util.storage
+import util.zip_stream
 from api.decorators import render_view
 from api.decorators import require_login_frontend
 from modern_paste import app
@@ -36,8 +41,7 @@ def paste_view(paste_id, deactivation_token=None):
     :param deactivation_token: Deactivation token string for paste if the user is attempting to deactivate.
     """
     try:
-        paste = database.paste.get_paste_by_id(util.cryptography.get_decid(paste_id), active_only=True)
-        database.paste.increment_paste_views(util.cryptography.get_decid(paste_id))
+        paste = database.paste.view_paste(util.cryptography.get_decid(paste_id))
     except (PasteDoesNotExistException, InvalidIDException):
         return 'paste/nonexistent.html', {}
 
@@ -58,19 +62,26 @@ def paste_view_raw(paste_id):
     :param paste_id: Encid or decid of the paste to look up; supplied in the URL
     """
     try:
-        paste = database.paste.get_paste_by_id(util.cryptography.get_decid(paste_id), active_only=True)
+        paste = database.paste.get_paste_by_id(util.cryptography.get_decid(paste_id), active_only=True, refresh=True)
 
         password_protection_error = 'In order to view the raw contents of a password-protected paste, ' \
                                     'you must supply the password (in plain text) as a GET parameter in the URL, e.g. ' \
                                     '{example}'.format(example=PasteViewRawInterfaceURI.full_uri(paste_id=paste_id, password='PASTE_PASSWORD_HERE'))
         invalid_password_error = 'The password you supplied for this paste is not correct.'
-        if paste.password_hash and not flask.request.args.get('password'):
+        # A valid unlock token, e.g. in the cookie set when the paste was unlocked, stands in for the password
+        unlock_token = None
+        if paste.password_hash:
+            unlock_token = util.paste_unlock.unlock_paste(paste, flask.request.args.get('password'))
+        if paste.password_hash and not unlock_token and not flask.request.args.get('password'):
             return flask.Response(password_protection_error, mimetype='text/plain')
-        if paste.password_hash and util.cryptography.secure_hash(flask.request.args.get('password')) != paste.password_hash:
+        if paste.password_hash and not unlock_token:
             return flask.Response(invalid_password_error, mimetype='text/plain')
 
-        database.paste.increment_paste_views(util.cryptography.get_decid(paste_id))
-        return flask.Response(paste.contents, mimetype='text/plain')
+        database.paste.count_paste_view(paste)
+        resp = flask.Response(paste.contents, mimetype='text/plain')
+        if unlock_token:
+            util.paste_unlock.set_unlock_cookie(resp, paste, unlock_token)
+        return resp
     except (PasteDoesNotExistException, InvalidIDException):
         return flask.Response('This paste either does not exist or has been deleted.', mimetype='text/plain')
 
@@ -89,14 +100,63 @@ def paste_attachment(paste_id, file_name):
             file_name=file_name,
             active_only=True,
         )
-        file_path = '{attachments_dir}/{paste_id}/{hash_name}'.format(
+        if attachment.data is not None:
+            # Inline attachments are served from the row already loaded, without touching the filesystem
+            return util.file_response.make_data_response(
+                attachment.data,
+                attachment.mime_type,
+                etag=hashlib.sha256(attachment.data).hexdigest(),
+            )
+
+        relative_file_path = database.attachment.resolve_attachment_file_path(attachment)
+        file_path = '{attachments_dir}/{relative_file_path}'.format(
             attachments_dir=config.ATTACHMENTS_DIR,
-            paste_id=util.cryptography.get_decid(paste_id),
-            hash_name=attachment.hash_name,
+            relative_file_path=relative_file_path,
         )
-        resp = flask.make_response(base64.b64decode(open(file_path).read()))
-        resp.headers['Content-Type'] = attachment.mime_type
-        return resp
+
+        if not attachment.is_raw:
+            # Legacy attachment files hold base64-encoded data, and must be decoded before they are sent
+            resp = flask.make_response(base64.b64decode(open(file_path).read()))
+            resp.headers['Content-Type'] = attachment.mime_type
+            return resp
+
+        segment = database.attachment.get_attachment_segment(attachment)
+        if segment is not None:
+            # Attachments packed into a segment are always served by the application, which reads only their bytes.
+            # The segment file is modified whenever another attachment is appended to it, so the attachment is instead
+            # validated by its digest and the time its paste was posted.
+            segment_path, segment_offset, file_size = segment
+            return util.file_response.make_file_response(
+                segment_path,
+                attachment.mime_type,
+                etag=attachment.blob_digest,
+                offset=segment_offset,
+                length=file_size,
+                last_modified=database.paste.get_paste_by_id(attachment.paste_id).post_time,
+            )
+
+        storage_backend = util.storage.get_storage_backend()
+        if not storage_backend.is_local and attachment.blob_digest:
+            # Blobs in an object store are streamed to the client as they are downloaded
+            return util.file_response.make_stream_response(
+                storage_backend.open(relative_file_path),
+                attachment.mime_type,
+                etag=attachment.blob_digest,
+            )
+
+        if config.ATTACHMENT_SENDFILE_HEADER == 'X-Sendfile':
+            resp = flask.Response(mimetype=attachment.mime_type)
+            resp.headers['X-Sendfile'] = file_path
+            return resp
+        if config.ATTACHMENT_SENDFILE_HEADER == 'X-Accel-Redirect':
+            resp = flask.Response(mimetype=attachment.mime_type)
+            resp.headers['X-Accel-Redirect'] = '{prefix}/{relative_file_path}'.format(
+                prefix=config.ATTACHMENT_ACCEL_REDIRECT_PREFIX.rstrip('/'),
+                relative_file_path=relative_file_path,
+            )
+            return resp
+        # Attachment blobs are named by the digest of their contents, which serves as a strong entity tag
+        return util.file_response.make_file_response(file_path, attachment.mime_type, etag=attachment.blob_digest)
     except (PasteDoesNotExistException, InvalidIDException):
         return 'No paste with the given ID could be found. ' \
                'It\'s also possible that the paste has been deactivated or has expired.', 404
@@ -106,6 +166,66 @@ def paste_attachment(paste_id, file_name):
         return 'Undefined error. Please open an issue at https://github.com/LINKIWI/modern-paste/issues', 500
 
 
+@app.route(PasteAttachmentsArchiveURI.path, methods=['GET'])
+def paste_attachments_archive(paste_id):
+    """
+    Download all of a paste's attachments as a single ZIP archive. The archive is generated while it is sent, reading
+    one chunk of one attachment at a time, so it is never staged on disk or held in memory. Attachments of types that
+    are already compressed, such as images, are stored as they are rather than deflated again.
+
+    :param paste_id: Encid or decid of the paste whose attachments to download; supplied in the URL
+    """
+    try:
+        paste = database.paste.get_paste_by_id(util.cryptography.get_decid(paste_id), active_only=True)
+
+        # As for raw pastes, a password-protected paste is unlocked by an unlock token, or by its password supplied as
+        # a GET parameter
+        unlock_token = None
+        if paste.password_hash:
+            unlock_token = util.paste_unlock.unlock_paste(paste, flask.request.args.get('password'))
+        if paste.password_hash and not unlock_token and not flask.request.args.get('password'):
+            return 'In order to download the attachments of a password-protected paste, you must supply the password ' \
+                   '(in plain text) as a GET parameter in the URL, e.g. {example}'.format(
+                       example=PasteAttachmentsArchiveURI.full_uri(paste_id=paste_id, password='PASTE_PASSWORD_HERE'),
+                   ), 401
+        if paste.password_hash and not unlock_token:
+            return 'The password you supplied for this paste is not correct.', 403
+
+        attachments = database.attachment.get_attachments_for_paste(paste.paste_id, active_only=True)
+        if not attachments:
+            return 'This paste has no attachments.', 404
+
+        # The file size recorded for an attachment is the one stated by the client that uploaded it, and may differ
+        # from the number of bytes actually streamed, so every entry is written with ZIP64 sizes rather than risk a
+        # corrupt archive near the 4 GiB limit
+        archive = util.zip_stream.iter_zip(
+            (
+                (
+                    attachment.file_name,
+                    None,
+                    not util.zip_stream.is_compressed_mime_type(attachment.mime_type),
+                    database.attachment.iter_attachment_data(attachment),
+                )
+                for attachment in attachments
+            ),
+            modified_time=paste.post_time,
+        )
+        # The request context is kept for the lifetime of the generator, which still loads inline attachments from
+        # the database while the archive is sent
+        resp = flask.Response(flask.stream_with_context(archive), mimetype='application/zip')
+        resp.headers['Content-Disposition'] = 'attachment; filename="{paste_id}-attachments.zip"'.format(
+            paste_id=util.cryptography.get_id_repr(paste.paste_id),
+        )
+        if unlock_token:
+            util.paste_unlock.set_unlock_cookie(resp, paste, unlock_token)
+        return resp
+    except (PasteDoesNotExistException, InvalidIDException):
+        return 'No paste with the given ID could be found. ' \
+               'It\'s also possible that the paste has been deactivated or has expired.', 404
+    except:
+        return 'Undefined error. Please open an issue at https://github.com/LINKIWI/modern-paste/issues', 500
+
+
 @app.route(PasteArchiveInterfaceURI.path, methods=['GET'])
 @render_view
 def paste_archive():
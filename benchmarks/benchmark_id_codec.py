@@ -0,0 +1,71 @@
+"""
+This script measures the time spent converting paste IDs to encrypted IDs, comparing the previous approach of creating
+a new AES cipher object for every ID against util.cryptography.IdCodec, without a cache, with a warm cache, and
+converting a whole page of IDs at once with IdCodec.encode_many, as the paste listing endpoints do. It also measures
+util.cryptography.ShortIdCodec, which converts IDs to short IDs without a cache.
+"""
+
+import argparse
+import base64
+import time
+
+from Crypto.Cipher import AES
+
+import config
+import util.cryptography
+
+
+def previous_encode(decid):
+    cipher = AES.new(config.ID_ENCRYPTION_KEY, AES.MODE_CBC, config.ID_ENCRYPTION_IV)
+    return base64.b64encode(
+        cipher.encrypt(util.cryptography._pad(str(decid))),
+        util.cryptography.ALTCHARS,
+    ).rstrip('=')
+
+
+def measure(encode_page, page_size, num_pages):
+    """
+    Convert pages of IDs repeatedly.
+
+    :param encode_page: Function of a list of decrypted IDs that converts them all
+    :param page_size: Number of IDs per page
+    :param num_pages: Number of pages to convert; the same pages are converted again once all have been converted
+    :return: Tuple of (microseconds per ID, thousands of IDs per second)
+    """
+    pages = [range(page * page_size + 1, (page + 1) * page_size + 1) for page in range(10)]
+    start_time = time.time()
+    for page in range(num_pages):
+        encode_page(pages[page % len(pages)])
+    elapsed = time.time() - start_time
+    num_ids = page_size * num_pages
+    return elapsed * 1000000 / num_ids, num_ids / elapsed / 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', help='Number of pages of IDs to convert per approach', type=int, default=2000)
+    parser.add_argument('--page-size', help='Number of IDs per page', type=int, default=50)
+    args = parser.parse_args()
+
+    uncached_codec = util.cryptography.IdCodec(config.ID_ENCRYPTION_KEY, config.ID_ENCRYPTION_IV)
+    cached_codec = util.cryptography.IdCodec(config.ID_ENCRYPTION_KEY, config.ID_ENCRYPTION_IV, config.ID_CACHE_SIZE)
+    short_id_codec = util.cryptography.ShortIdCodec(config.ID_ENCRYPTION_KEY)
+    results = [
+        ('previous (new cipher per ID)', measure(lambda page: map(previous_encode, page), args.page_size, args.pages)),
+        ('codec, no cache', measure(lambda page: map(uncached_codec.encode, page), args.page_size, args.pages)),
+        ('codec, cached', measure(lambda page: map(cached_codec.encode, page), args.page_size, args.pages)),
+        ('codec, cached, batched', measure(cached_codec.encode_many, args.page_size, args.pages)),
+        ('short IDs', measure(lambda page: map(short_id_codec.encode, page), args.page_size, args.pages)),
+    ]
+
+    print '{approach:<32}{latency:>16}{throughput:>16}'.format(
+        approach='approach',
+        latency='us/ID',
+        throughput='k IDs/s',
+    )
+    for approach, (latency, throughput) in results:
+        print '{approach:<32}{latency:>16.2f}{throughput:>16.1f}'.format(
+            approach=approach,
+            latency=latency,
+            throughput=throughput,
+        )
@@ -0,0 +1,61 @@
+"""
+This script measures the throughput of password hashing, comparing the legacy util.cryptography.secure_hash loop of
+SHA-256 rounds in Python against the native PBKDF2-HMAC-SHA256 of util.cryptography.hash_password. Since the two make
+different numbers of rounds, it reports both the time per hash and the number of SHA-256 rounds computed per second.
+"""
+
+import argparse
+import time
+
+import config
+import util.cryptography
+
+
+def measure(hash_function, rounds_per_hash, num_hashes):
+    """
+    Hash a password repeatedly.
+
+    :param hash_function: Function of a password that hashes it
+    :param rounds_per_hash: Number of SHA-256 compressions per hash, for computing the throughput
+    :param num_hashes: Number of hashes to compute
+    :return: Tuple of (milliseconds per hash, hashes per second, thousands of rounds per second)
+    """
+    start_time = time.time()
+    for i in range(num_hashes):
+        hash_function('password {i}'.format(i=i))
+    elapsed = time.time() - start_time
+    return elapsed * 1000 / num_hashes, num_hashes / elapsed, rounds_per_hash * num_hashes / elapsed / 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hashes', help='Number of hashes to compute per hash function', type=int, default=50)
+    args = parser.parse_args()
+
+    results = [
+        # Each legacy round hashes a 64-character hex digest, taking two SHA-256 compressions
+        ('legacy secure_hash', measure(util.cryptography.secure_hash, 2 * 10001, args.hashes)),
+        # Each PBKDF2 iteration computes an HMAC, taking two SHA-256 compressions
+        (
+            'pbkdf2 ({iterations} iterations)'.format(iterations=config.PASSWORD_HASH_ITERATIONS),
+            measure(util.cryptography.hash_password, 2 * config.PASSWORD_HASH_ITERATIONS, args.hashes),
+        ),
+        (
+            'pbkdf2 (10001 iterations)',
+            measure(lambda password: util.cryptography.hash_password(password, iterations=10001), 2 * 10001, args.hashes),
+        ),
+    ]
+
+    print '{function:<32}{latency:>16}{throughput:>16}{rounds:>20}'.format(
+        function='hash function',
+        latency='ms/hash',
+        throughput='hashes/s',
+        rounds='k rounds/s',
+    )
+    for function, (latency, throughput, rounds) in results:
+        print '{function:<32}{latency:>16.3f}{throughput:>16.1f}{rounds:>20.1f}'.format(
+            function=function,
+            latency=latency,
+            throughput=throughput,
+            rounds=rounds,
+        )
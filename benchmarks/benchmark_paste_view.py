@@ -0,0 +1,71 @@
+"""
+This script measures the number of SQL statements and the wall time spent per paste view, comparing the previous
+lookup-then-increment view path against the fused database.paste.view_paste path, with and without the view count
+buffer. It runs against the test database (config.DATABASE_NAME + '_test'), which it creates and drops.
+"""
+
+import argparse
+import time
+
+import config
+import database.paste
+import database.view_buffer
+import util.cryptography
+import util.testing
+from modern_paste import app
+from modern_paste import db
+
+
+def previous_view_path(paste_id):
+    database.paste.get_paste_by_id(util.cryptography.get_decid(paste_id), active_only=True)
+    database.paste.increment_paste_views(util.cryptography.get_decid(paste_id))
+
+
+def fused_view_path(paste_id):
+    database.paste.view_paste(util.cryptography.get_decid(paste_id))
+
+
+def measure(view_path, paste_id, num_views):
+    """
+    Run a view path repeatedly against a single paste.
+
+    :param view_path: Function that performs a single paste view
+    :param paste_id: ID of the paste to view
+    :param num_views: Number of views to perform
+    :return: Tuple of (statements per view, milliseconds per view)
+    """
+    with util.testing.QueryCounter() as counter:
+        start_time = time.time()
+        for _ in range(num_views):
+            # Each view is handled in a fresh session, as it would be in a separate request
+            db.session.remove()
+            view_path(paste_id)
+        elapsed = time.time() - start_time
+    return counter.count / float(num_views), elapsed * 1000 / num_views
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--views', help='Number of views to perform per view path', type=int, default=500)
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_TEST_DATABASE_URI']
+    db.create_all()
+    try:
+        paste_id = database.paste.create_new_paste(contents='x' * 8192).paste_id
+        results = []
+
+        config.ENABLE_VIEW_COUNT_BUFFER = False
+        results.append(('previous (lookup + increment)', measure(previous_view_path, paste_id, args.views)))
+        results.append(('fused view_paste', measure(fused_view_path, paste_id, args.views)))
+
+        config.ENABLE_VIEW_COUNT_BUFFER = True
+        results.append(('fused view_paste, buffered', measure(fused_view_path, paste_id, args.views)))
+        database.view_buffer.get_view_count_buffer().drain()
+
+        print '{path:<32}{queries:>16}{latency:>16}'.format(path='view path', queries='queries/view', latency='ms/view')
+        for path, (queries, latency) in results:
+            print '{path:<32}{queries:>16.2f}{latency:>16.3f}'.format(path=path, queries=queries, latency=latency)
+    finally:
+        db.session.remove()
+        db.drop_all()
@@ -1,27 +1,74 @@
 """
-This script creates and drops all tables in the current database, as specified by config.BUILD_ENVIRONMENT.
+This script creates, upgrades, and drops all tables in the current database, as specified by config.BUILD_ENVIRONMENT.
 """
 
 import sys
 import argparse
 
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+
+def upgrade_database(db):
+    """
+    Bring the schema of an existing database up to date with the models, without dropping any tables or data. Tables
+    that do not yet exist are created, and columns and indexes declared on the models that are missing from existing
+    tables are added. New columns are added as nullable, with existing rows set to NULL. Existing columns and indexes
+    are left untouched, even if they are no longer declared on the models.
+
+    :param db: The Flask-SQLAlchemy database object
+    :return: List of the names of the tables, columns, and indexes that were created
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            # Creating the table also creates all of its indexes
+            table.create(db.engine)
+            created.append(table.name)
+            continue
+
+        existing_columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing_columns:
+                db.engine.execute('ALTER TABLE {table} ADD COLUMN {column}'.format(
+                    table=db.engine.dialect.identifier_preparer.format_table(table),
+                    column=CreateColumn(column).compile(dialect=db.engine.dialect),
+                ))
+                created.append('{table}.{column}'.format(table=table.name, column=column.name))
+
+        existing_indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing_indexes:
+                index.create(db.engine)
+                created.append(index.name)
+
+    return created
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--create', help='Create the database and all tables', action='store_true')
+    parser.add_argument('--upgrade', help='Create any missing tables, columns, and indexes in an existing database', action='store_true')
     parser.add_argument('--drop', help='Drop the database and all tables', action='store_true')
     args = parser.parse_args()
 
     from modern_paste import db
-    if args.create and args.drop:
+    if args.create + args.upgrade + args.drop > 1:
         print 'Requested action ambiguous; exiting'
         sys.exit(1)
     elif args.create:
         print 'Creating database and all tables'
         db.create_all()
+    elif args.upgrade:
+        print 'Upgrading database tables, columns, and indexes'
+        for name in upgrade_database(db):
+            print 'Created {name}'.format(name=name)
     elif args.drop:
         print 'Dropping database and all tables'
         db.drop_all()
     else:
-        print 'Call this script with either the --create or --drop flag to create or drop the database, respectively'
+        print 'Call this script with either the --create, --upgrade, or --drop flag to create, upgrade, or drop the database, respectively'
         sys.exit(1)
@@ -0,0 +1,146 @@
+"""
+This script moves attachment files stored in an earlier directory layout (see ATTACHMENTS_DIR_FALLBACK_LEVELS in
+config.py) into the layout configured by ATTACHMENTS_DIR_LEVELS.
+
+It is safe to run while the application is serving requests: each file is first linked into its new location and only
+then unlinked from its old one, so it is always reachable under at least one of the paths the application looks up. It
+is also safe to interrupt and re-run.
+"""
+
+import errno
+import os
+import sys
+import argparse
+
+
+def migrate_attachment_layout(chunk_size):
+    """
+    Move all attachment files, blobs, and partial uploads into the configured directory layout.
+
+    :param chunk_size: Maximum number of rows loaded at a time
+    :return: Number of files moved
+    """
+    import database.attachment
+    import database.upload_session
+    import models
+    import util.storage
+
+    moved = 0
+    for levels in database.attachment.get_layout_levels()[1:]:
+        print 'Moving files from the layout with {levels} levels of subdirectories'.format(levels=levels)
+        for attachment in _iter_rows(
+            models.Attachment.query.filter(models.Attachment.blob_digest.is_(None)),
+            models.Attachment.attachment_id,
+            chunk_size,
+        ):
+            moved += _move_file(
+                database.attachment.get_attachment_file_path(attachment, levels),
+                database.attachment.get_attachment_file_path(attachment),
+            )
+        # Blobs in an object store were only ever stored in the configured layout
+        if util.storage.get_storage_backend().is_local:
+            for blob in _iter_rows(models.AttachmentBlob.query, models.AttachmentBlob.digest, chunk_size):
+                moved += _move_file(
+                    database.attachment.get_blob_file_path(blob.digest, levels),
+                    database.attachment.get_blob_file_path(blob.digest),
+                )
+        for upload_session in _iter_rows(
+            models.UploadSession.query,
+            models.UploadSession.upload_session_id,
+            chunk_size,
+        ):
+            moved += _move_file(
+                database.upload_session.get_partial_file_path(upload_session, levels),
+                database.upload_session.get_partial_file_path(upload_session),
+            )
+
+    return moved
+
+
+def _iter_rows(query, key_column, chunk_size):
+    """
+    Iterate over the rows of a query in chunks, in order of a unique key.
+
+    :param query: Query selecting the rows
+    :param key_column: Unique column by which the rows are ordered
+    :param chunk_size: Maximum number of rows loaded at a time
+    :return: Generator of rows
+    """
+    from modern_paste import session
+
+    last_key = None
+    while True:
+        chunk_query = query
+        if last_key is not None:
+            chunk_query = chunk_query.filter(key_column > last_key)
+        rows = chunk_query.order_by(key_column).limit(chunk_size).all()
+        # End the read transaction, so that the migration does not hold a snapshot open between chunks
+        session.commit()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last_key = getattr(rows[-1], key_column.key)
+
+
+def _move_file(source_relative_path, dest_relative_path):
+    """
+    Move a file within the attachments directory, and remove the directories it leaves empty.
+
+    :param source_relative_path: Current path of the file, relative to config.ATTACHMENTS_DIR
+    :param dest_relative_path: New path of the file, relative to config.ATTACHMENTS_DIR
+    :return: 1 if the file was moved, or 0 if there was no file to move
+    """
+    import config
+    import database.attachment
+
+    source_path = '{attachments_dir}/{relative_path}'.format(
+        attachments_dir=config.ATTACHMENTS_DIR,
+        relative_path=source_relative_path,
+    )
+    dest_path = '{attachments_dir}/{relative_path}'.format(
+        attachments_dir=config.ATTACHMENTS_DIR,
+        relative_path=dest_relative_path,
+    )
+    if source_relative_path == dest_relative_path or not os.path.exists(source_path):
+        return 0
+
+    try:
+        os.makedirs(os.path.dirname(dest_path))
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            raise
+    try:
+        os.link(source_path, dest_path)
+    except OSError as exception:
+        # The file was already linked by an earlier, interrupted run
+        if exception.errno != errno.EEXIST:
+            raise
+    os.remove(source_path)
+
+    # Remove the directories left empty, up to the top of the attachments directory or blob store
+    source_dir = os.path.dirname(source_relative_path)
+    while source_dir and source_dir != database.attachment.BLOBS_DIR:
+        try:
+            os.rmdir('{attachments_dir}/{source_dir}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                source_dir=source_dir,
+            ))
+        except OSError:
+            break
+        source_dir = os.path.dirname(source_dir)
+
+    return 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunk-size', help='Number of rows loaded at a time', type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.chunk_size < 1:
+        print 'The chunk size must be positive; exiting'
+        sys.exit(1)
+
+    moved = migrate_attachment_layout(args.chunk_size)
+    print 'Moved {moved} attachment files'.format(moved=moved)
@@ -0,0 +1,77 @@
+"""
+This script converts attachment files stored base64-encoded by earlier versions of Modern Paste into raw binary files.
+It is safe to interrupt and re-run: each attachment is converted and marked as raw individually, and its encoded file is
+only removed once the attachment refers to the raw file.
+
+Run build_database.py --upgrade before running this script, so that the attachment table has the is_raw column.
+"""
+
+import os
+import sys
+import argparse
+
+
+def migrate_attachments(chunk_size):
+    """
+    Decode all legacy base64-encoded attachment files into the blob store. Each attachment is switched from its encoded
+    file to the raw blob in a single commit, and the encoded file is removed after that; until then, the attachment
+    still refers to the encoded file, so neither an interruption nor a concurrent download ever decodes raw data.
+
+    :param chunk_size: Maximum number of attachment rows loaded at a time
+    :return: Tuple of (number of attachments converted, number of attachments whose files are missing)
+    """
+    import config
+    import database.attachment
+    import models
+    from modern_paste import session
+
+    converted = 0
+    missing = 0
+    last_attachment_id = 0
+    while True:
+        attachments = models.Attachment.query.filter(
+            models.Attachment.is_raw.is_(None),
+            models.Attachment.attachment_id > last_attachment_id,
+        ).order_by(
+            models.Attachment.attachment_id,
+        ).limit(chunk_size).all()
+        if not attachments:
+            return converted, missing
+
+        for attachment in attachments:
+            file_path = '{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.resolve_attachment_file_path(attachment),
+            )
+            if not os.path.exists(file_path):
+                missing += 1
+                continue
+
+            try:
+                database.attachment.convert_legacy_attachment(attachment, file_path)
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            # An interruption here only leaves the encoded file behind, which the scrubber removes with its paste
+            os.remove(file_path)
+            converted += 1
+
+        last_attachment_id = attachments[-1].attachment_id
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunk-size', help='Number of attachments loaded at a time', type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.chunk_size < 1:
+        print 'The chunk size must be positive; exiting'
+        sys.exit(1)
+
+    print 'Converting base64-encoded attachment files to raw binary files'
+    converted, missing = migrate_attachments(args.chunk_size)
+    print 'Converted {converted} attachments; {missing} attachment files were missing'.format(
+        converted=converted,
+        missing=missing,
+    )
@@ -0,0 +1,27 @@
+"""
+This script computes the total size and number of attachments of every paste and user, which are kept up to date as
+attachments are added and scrubbed, and against which the attachment quotas are enforced. Run it once after upgrading a
+database created before the totals were introduced; until then, the totals of existing pastes and users count as zero.
+
+Run build_database.py --upgrade before running this script, so that the paste and user tables have the total columns.
+It is safe to interrupt and re-run.
+"""
+
+import sys
+import argparse
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunk-size', help='Number of pastes or users recounted at a time', type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.chunk_size < 1:
+        print 'The chunk size must be positive; exiting'
+        sys.exit(1)
+
+    import database.attachment
+
+    print 'Recounting the attachment totals of all pastes and users'
+    stats = database.attachment.recount_attachment_totals(args.chunk_size)
+    print 'Recounted {recounted_pastes} pastes and {recounted_users} users'.format(**stats)
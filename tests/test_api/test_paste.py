@@ -1,7 +1,10 @@
 # coding=utf-8
 
+import base64
 import json
 import random
+import shutil
+import tempfile
 import time
 
 import mock
@@ -11,12 +14,16 @@ import config
 import constants.api
 import database.attachment
 import database.paste
+import database.upload_session
 import database.user
+import models
 import util.cryptography
+import util.paste_unlock
 import util.testing
 from uri.authentication import *
 from uri.main import *
 from uri.paste import *
+from util.exception import *
 
 
 class TestPaste(util.testing.DatabaseTestCase):
@@ -195,13 +202,13 @@ class TestPaste(util.testing.DatabaseTestCase):
                             'name': 'file name',
                             'size': 12345,
                             'mime_type': 'image/png',
-                            'data': 'binary data',
+                            'data': base64.b64encode('binary data'),
                         },
                         {
                             'name': 'file name 2',
                             'size': 12345,
                             'mime_type': 'image/png',
-                            'data': 'binary data 2',
+                            'data': base64.b64encode('binary data 2'),
                         }
                     ]
                 }),
@@ -209,6 +216,8 @@ class TestPaste(util.testing.DatabaseTestCase):
             )
             self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
             self.assertEqual(2, mock_store_attachment_file.call_count)
+            # Attachment data is decoded before it is stored
+            mock_store_attachment_file.assert_any_call(mock.ANY, 'binary data', mock.ANY)
 
             resp_data = json.loads(resp.data)
             self.assertEqual('file_name', resp_data['attachments'][0]['name'])
@@ -226,6 +235,79 @@ class TestPaste(util.testing.DatabaseTestCase):
                 'file_name_2')
             )
 
+    def test_submit_paste_attachment_quota(self):
+        config.MAX_PASTE_ATTACHMENTS_COUNT = 1
+        with mock.patch.object(database.attachment, '_store_attachment_file') as mock_store_attachment_file:
+            resp = self.client.post(
+                PasteSubmitURI.uri(),
+                data=json.dumps({
+                    'contents': 'contents',
+                    'attachments': [
+                        {
+                            'name': 'file name',
+                            'size': 12345,
+                            'mime_type': 'image/png',
+                            'data': base64.b64encode('binary data'),
+                        },
+                        {
+                            'name': 'file name 2',
+                            'size': 12345,
+                            'mime_type': 'image/png',
+                            'data': base64.b64encode('binary data 2'),
+                        }
+                    ]
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE_CODE, resp.status_code)
+            self.assertEqual('paste_attachment_quota_exceeded_failure', json.loads(resp.data)[constants.api.FAILURE])
+            self.assertEqual(0, mock_store_attachment_file.call_count)
+            # The paste is not created
+            self.assertEqual(0, models.Paste.query.count())
+
+    def test_submit_paste_attachment_quota_declared_size(self):
+        config.MAX_PASTE_ATTACHMENTS_SIZE = 100.0 / (1000 * 1000)  # 100 B
+        with mock.patch.object(database.attachment, '_store_attachment_file') as mock_store_attachment_file:
+            # The quota counts the attachment's data, whatever size is declared for it
+            resp = self.client.post(
+                PasteSubmitURI.uri(),
+                data=json.dumps({
+                    'contents': 'contents',
+                    'attachments': [
+                        {
+                            'name': 'file name',
+                            'size': 0,
+                            'mime_type': 'image/png',
+                            'data': base64.b64encode('x' * 101),
+                        },
+                    ]
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(constants.api.PASTE_ATTACHMENT_QUOTA_EXCEEDED_FAILURE_CODE, resp.status_code)
+            self.assertEqual(0, mock_store_attachment_file.call_count)
+
+            for size in [-1, 'size', 1.5, True]:
+                resp = self.client.post(
+                    PasteSubmitURI.uri(),
+                    data=json.dumps({
+                        'contents': 'contents',
+                        'attachments': [
+                            {
+                                'name': 'file name',
+                                'size': size,
+                                'mime_type': 'image/png',
+                                'data': base64.b64encode('x'),
+                            },
+                        ]
+                    }),
+                    content_type='application/json',
+                )
+                self.assertEqual(constants.api.INCOMPLETE_PARAMS_FAILURE_CODE, resp.status_code)
+                self.assertEqual(constants.api.INCOMPLETE_PARAMS_FAILURE, json.loads(resp.data))
+            self.assertEqual(0, mock_store_attachment_file.call_count)
+            self.assertEqual(0, models.Paste.query.count())
+
     def test_submit_paste_invalid_attachments(self):
         with mock.patch.object(database.attachment, '_store_attachment_file') as mock_store_attachment_file:
             resp = self.client.post(
@@ -273,7 +355,7 @@ class TestPaste(util.testing.DatabaseTestCase):
                             'name': 'file name',
                             'size': 12345,
                             'mime_type': 'image/png',
-                            'data': util.testing.random_alphanumeric_string(length=5),
+                            'data': util.testing.random_alphanumeric_string(length=8),
                         },
                     ]
                 }),
@@ -319,6 +401,293 @@ class TestPaste(util.testing.DatabaseTestCase):
             )
             self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
 
+    def test_upload_paste_attachment(self):
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        try:
+            paste = util.testing.PasteFactory.generate(user_id=None)
+            resp = self.client.post(
+                PasteAttachmentUploadURI.uri(
+                    paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                    name='file name',
+                    deactivation_token=paste.deactivation_token,
+                ),
+                data='binary data',
+                content_type='image/png',
+            )
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            resp_data = json.loads(resp.data)
+            self.assertEqual(util.cryptography.get_id_repr(paste.paste_id), resp_data['paste_id'])
+            self.assertEqual('file_name', resp_data['attachment']['name'])
+            self.assertEqual(len('binary data'), resp_data['attachment']['size'])
+            self.assertEqual('image/png', resp_data['attachment']['mime_type'])
+
+            attachment = database.attachment.get_attachment_by_name(paste.paste_id, 'file_name')
+            with open('{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(attachment),
+            ), 'rb') as attachment_file:
+                self.assertEqual('binary data', attachment_file.read())
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+    def test_upload_paste_attachment_owner(self):
+        user = util.testing.UserFactory.generate(username='username', password='password')
+        paste = util.testing.PasteFactory.generate(user_id=user.user_id)
+        with mock.patch.object(database.attachment, 'create_new_attachment_from_stream') as mock_create_attachment:
+            mock_create_attachment.return_value = mock.Mock(file_name='file_name', file_size=11, mime_type='text/plain')
+
+            resp = self.client.post(
+                PasteAttachmentUploadURI.uri(
+                    paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                    name='file name',
+                    mime_type='text/plain',
+                ),
+                data='binary data',
+                headers={constants.api.API_KEY_HEADER: user.api_key},
+            )
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            self.assertEqual('text/plain', mock_create_attachment.call_args[1]['mime_type'])
+
+            # Neither the session cookie nor an API key in the query string is accepted
+            self.api_login_user('username', 'password')
+            for params in [{}, {'api_key': user.api_key}]:
+                resp = self.client.post(
+                    PasteAttachmentUploadURI.uri(
+                        paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                        name='file name',
+                        **params
+                    ),
+                    data='binary data',
+                    content_type='text/plain',
+                )
+                self.assertEqual(constants.api.AUTH_FAILURE_CODE, resp.status_code)
+            self.assertEqual(1, mock_create_attachment.call_count)
+
+    def test_upload_paste_attachment_unauthorized(self):
+        user = util.testing.UserFactory.generate()
+        paste = util.testing.PasteFactory.generate()
+        with mock.patch.object(database.attachment, 'create_new_attachment_from_stream') as mock_create_attachment:
+            for params, headers in [
+                ({}, {}),
+                ({'deactivation_token': 'invalid'}, {}),
+                ({}, {constants.api.API_KEY_HEADER: user.api_key}),
+                ({}, {constants.api.API_KEY_HEADER: 'invalid'}),
+            ]:
+                resp = self.client.post(
+                    PasteAttachmentUploadURI.uri(
+                        paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                        name='file name',
+                        **params
+                    ),
+                    data='binary data',
+                    headers=headers,
+                )
+                self.assertEqual(constants.api.AUTH_FAILURE_CODE, resp.status_code)
+                self.assertEqual(constants.api.AUTH_FAILURE, json.loads(resp.data))
+            self.assertEqual(0, mock_create_attachment.call_count)
+
+    def test_upload_paste_attachment_invalid(self):
+        paste = util.testing.PasteFactory.generate()
+
+        resp = self.client.post(PasteAttachmentUploadURI.uri(name='file name'), data='binary data')
+        self.assertEqual(constants.api.INCOMPLETE_PARAMS_FAILURE_CODE, resp.status_code)
+        self.assertEqual(constants.api.INCOMPLETE_PARAMS_FAILURE, json.loads(resp.data))
+
+        resp = self.client.post(PasteAttachmentUploadURI.uri(paste_id=-1, name='file name'), data='binary data')
+        self.assertEqual(constants.api.NONEXISTENT_PASTE_FAILURE_CODE, resp.status_code)
+        self.assertEqual(constants.api.NONEXISTENT_PASTE_FAILURE, json.loads(resp.data))
+
+        config.ENABLE_PASTE_ATTACHMENTS = False
+        resp = self.client.post(
+            PasteAttachmentUploadURI.uri(
+                paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                name='file name',
+                deactivation_token=paste.deactivation_token,
+            ),
+            data='binary data',
+        )
+        self.assertEqual(constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE_CODE, resp.status_code)
+        self.assertEqual(constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE, json.loads(resp.data))
+
+    def test_upload_paste_attachment_too_large(self):
+        config.MAX_ATTACHMENT_SIZE = 10.0 / (1000 * 1000)  # 10 B
+        paste = util.testing.PasteFactory.generate()
+        uri = PasteAttachmentUploadURI.uri(
+            paste_id=util.cryptography.get_id_repr(paste.paste_id),
+            name='file name',
+            deactivation_token=paste.deactivation_token,
+        )
+
+        # Rejected up front from the declared Content-Length
+        with mock.patch.object(database.attachment, 'create_new_attachment_from_stream') as mock_create_attachment:
+            resp = self.client.post(uri, data='binary data')
+            self.assertEqual(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE, resp.status_code)
+            self.assertEqual(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE, json.loads(resp.data))
+            self.assertEqual(0, mock_create_attachment.call_count)
+
+        # Rejected while streaming
+        with mock.patch.object(database.attachment, 'create_new_attachment_from_stream') as mock_create_attachment:
+            mock_create_attachment.side_effect = AttachmentTooLargeException
+            resp = self.client.post(uri, data='data')
+            self.assertEqual(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE, resp.status_code)
+            self.assertEqual(10, mock_create_attachment.call_args[1]['max_size'])
+
+    def test_upload_paste_attachment_server_error(self):
+        paste = util.testing.PasteFactory.generate()
+        with mock.patch.object(database.attachment, 'create_new_attachment_from_stream', side_effect=SQLAlchemyError):
+            resp = self.client.post(
+                PasteAttachmentUploadURI.uri(
+                    paste_id=util.cryptography.get_id_repr(paste.paste_id),
+                    name='file name',
+                    deactivation_token=paste.deactivation_token,
+                ),
+                data='binary data',
+            )
+            self.assertEqual(constants.api.UNDEFINED_FAILURE_CODE, resp.status_code)
+            self.assertEqual(constants.api.UNDEFINED_FAILURE, json.loads(resp.data))
+
+    def test_upload_session(self):
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        config.UPLOAD_SESSION_CHUNK_SIZE = 4
+        try:
+            paste = util.testing.PasteFactory.generate(user_id=None)
+            resp = self.client.post(
+                UploadSessionCreateURI.uri(),
+                data=json.dumps({
+                    'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                    'name': 'file name',
+                    'size': len('binary data'),
+                    'mime_type': 'image/png',
+                    'deactivation_token': paste.deactivation_token,
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            upload_session = json.loads(resp.data)['upload_session']
+            self.assertEqual(4, upload_session['chunk_size'])
+            self.assertEqual(3, upload_session['num_chunks'])
+            upload_token = upload_session['upload_token']
+
+            for chunk_index in [2, 0]:
+                resp = self.client.put(
+                    UploadSessionChunkURI.uri(upload_token=upload_token, chunk_index=chunk_index),
+                    data='binary data'[chunk_index * 4:(chunk_index + 1) * 4],
+                )
+                self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            self.assertEqual([0, 2], json.loads(resp.data)['received_chunks'])
+
+            resp = self.client.get(UploadSessionStatusURI.uri(upload_token=upload_token))
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            self.assertEqual([0, 2], json.loads(resp.data)['received_chunks'])
+            self.assertEqual([0, 8], json.loads(resp.data)['received_offsets'])
+
+            resp = self.client.post(UploadSessionFinalizeURI.uri(upload_token=upload_token))
+            self.assertEqual(constants.api.INCOMPLETE_UPLOAD_FAILURE_CODE, resp.status_code)
+            self.assertEqual(constants.api.INCOMPLETE_UPLOAD_FAILURE, json.loads(resp.data))
+
+            resp = self.client.put(UploadSessionChunkURI.uri(upload_token=upload_token, chunk_index=1), data='ry d')
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+
+            resp = self.client.post(UploadSessionFinalizeURI.uri(upload_token=upload_token))
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            resp_data = json.loads(resp.data)
+            self.assertEqual(util.cryptography.get_id_repr(paste.paste_id), resp_data['paste_id'])
+            self.assertEqual('file_name', resp_data['attachment']['name'])
+            self.assertEqual(len('binary data'), resp_data['attachment']['size'])
+
+            attachment = database.attachment.get_attachment_by_name(paste.paste_id, 'file_name')
+            with open('{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(attachment),
+            ), 'rb') as attachment_file:
+                self.assertEqual('binary data', attachment_file.read())
+
+            # The upload session no longer exists after it is finalized
+            resp = self.client.get(UploadSessionStatusURI.uri(upload_token=upload_token))
+            self.assertEqual(constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE_CODE, resp.status_code)
+            self.assertEqual(constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE, json.loads(resp.data))
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+    def test_create_upload_session_invalid(self):
+        user = util.testing.UserFactory.generate()
+        paste = util.testing.PasteFactory.generate()
+        with mock.patch.object(database.upload_session, 'create_upload_session') as mock_create_upload_session:
+            for params, failure, failure_code in [
+                ({'size': 'invalid'}, constants.api.INCOMPLETE_PARAMS_FAILURE, constants.api.INCOMPLETE_PARAMS_FAILURE_CODE),
+                ({'size': -1}, constants.api.INCOMPLETE_PARAMS_FAILURE, constants.api.INCOMPLETE_PARAMS_FAILURE_CODE),
+                ({'size': 10}, constants.api.AUTH_FAILURE, constants.api.AUTH_FAILURE_CODE),
+                ({'size': 10, 'deactivation_token': 'invalid'}, constants.api.AUTH_FAILURE, constants.api.AUTH_FAILURE_CODE),
+                ({'size': 10, 'api_key': user.api_key}, constants.api.AUTH_FAILURE, constants.api.AUTH_FAILURE_CODE),
+                ({'size': 10, 'paste_id': -1}, constants.api.NONEXISTENT_PASTE_FAILURE, constants.api.NONEXISTENT_PASTE_FAILURE_CODE),
+            ]:
+                data = {
+                    'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                    'name': 'file name',
+                }
+                data.update(params)
+                resp = self.client.post(
+                    UploadSessionCreateURI.uri(),
+                    data=json.dumps(data),
+                    content_type='application/json',
+                )
+                self.assertEqual(failure_code, resp.status_code)
+                self.assertEqual(failure, json.loads(resp.data))
+            self.assertEqual(0, mock_create_upload_session.call_count)
+
+            config.MAX_ATTACHMENT_SIZE = 10.0 / (1000 * 1000)  # 10 B
+            resp = self.client.post(
+                UploadSessionCreateURI.uri(),
+                data=json.dumps({
+                    'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                    'name': 'file name',
+                    'size': 11,
+                    'deactivation_token': paste.deactivation_token,
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE_CODE, resp.status_code)
+            self.assertEqual(constants.api.PASTE_ATTACHMENT_TOO_LARGE_FAILURE, json.loads(resp.data))
+
+            config.ENABLE_PASTE_ATTACHMENTS = False
+            resp = self.client.post(
+                UploadSessionCreateURI.uri(),
+                data=json.dumps({
+                    'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                    'name': 'file name',
+                    'size': 10,
+                    'deactivation_token': paste.deactivation_token,
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(constants.api.PASTE_ATTACHMENTS_DISABLED_FAILURE_CODE, resp.status_code)
+            self.assertEqual(0, mock_create_upload_session.call_count)
+
+    def test_upload_session_chunk_invalid(self):
+        resp = self.client.put(UploadSessionChunkURI.uri(upload_token='invalid', chunk_index=0), data='data')
+        self.assertEqual(constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE_CODE, resp.status_code)
+        self.assertEqual(constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE, json.loads(resp.data))
+
+        resp = self.client.post(UploadSessionFinalizeURI.uri(upload_token='invalid'))
+        self.assertEqual(constants.api.NONEXISTENT_UPLOAD_SESSION_FAILURE_CODE, resp.status_code)
+
+        with mock.patch.object(database.upload_session, 'get_upload_session'):
+            resp = self.client.put(UploadSessionChunkURI.uri(upload_token='token', chunk_index='invalid'), data='data')
+            self.assertEqual(constants.api.INVALID_UPLOAD_CHUNK_FAILURE_CODE, resp.status_code)
+            self.assertEqual(constants.api.INVALID_UPLOAD_CHUNK_FAILURE, json.loads(resp.data))
+
+            with mock.patch.object(database.upload_session, 'write_upload_chunk', side_effect=InvalidUploadChunkException):
+                resp = self.client.put(UploadSessionChunkURI.uri(upload_token='token', chunk_index=5), data='data')
+                self.assertEqual(constants.api.INVALID_UPLOAD_CHUNK_FAILURE_CODE, resp.status_code)
+
+            with mock.patch.object(database.upload_session, 'write_upload_chunk', side_effect=SQLAlchemyError):
+                resp = self.client.put(UploadSessionChunkURI.uri(upload_token='token', chunk_index=0), data='data')
+                self.assertEqual(constants.api.UNDEFINED_FAILURE_CODE, resp.status_code)
+
     def test_submit_paste_server_error(self):
         with mock.patch.object(database.paste, 'create_new_paste', side_effect=SQLAlchemyError):
             resp = self.client.post(
@@ -594,6 +963,34 @@ class TestPaste(util.testing.DatabaseTestCase):
         paste_details['attachments'] = []
         self.assertEqual(paste_details, json.loads(resp.data)['details'])
 
+    def test_paste_details_short_ids(self):
+        config.USE_SHORT_IDS = True
+        paste = util.testing.PasteFactory.generate(password=None, user_id=None)
+        short_id = util.cryptography.get_short_id(paste.paste_id)
+        for paste_id in [short_id, util.cryptography.get_encid(paste.paste_id)]:
+            resp = self.client.post(
+                PasteDetailsURI.uri(),
+                data=json.dumps({
+                    'paste_id': paste_id,
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(resp.status_code, constants.api.SUCCESS_CODE)
+            self.assertEqual(short_id, json.loads(resp.data)['details']['paste_id_repr'])
+            self.assertEqual(
+                PasteViewInterfaceURI.full_uri(paste_id=short_id),
+                json.loads(resp.data)['details']['url'],
+            )
+
+        resp = self.client.post(
+            PasteDetailsURI.uri(),
+            data=json.dumps({
+                'paste_id': paste.paste_id,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(resp.status_code, constants.api.NONEXISTENT_PASTE_FAILURE_CODE)
+
     def test_paste_details_password(self):
         user = util.testing.UserFactory.generate(username='username')
         paste = util.testing.PasteFactory.generate(password='None', user_id=user.user_id)
@@ -642,6 +1039,96 @@ class TestPaste(util.testing.DatabaseTestCase):
         paste_details['attachments'] = []
         self.assertEqual(paste_details, json.loads(resp.data)['details'])
 
+    def test_paste_details_unlock_token(self):
+        paste = util.testing.PasteFactory.generate(password='password', user_id=None)
+        resp = self.client.post(
+            PasteDetailsURI.uri(),
+            data=json.dumps({
+                'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                'password': 'password',
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        unlock_token = json.loads(resp.data)['unlock_token']
+        self.assertIsNotNone(unlock_token)
+        self.assertIn(util.paste_unlock.UNLOCK_TOKEN_COOKIE, resp.headers['Set-Cookie'])
+
+        # The token unlocks the paste without the password, which is not hashed again
+        with mock.patch.object(util.cryptography, 'verify_password') as mock_verify_password:
+            resp = self.client.post(
+                PasteDetailsURI.uri(),
+                data=json.dumps({
+                    'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                    'unlock_token': unlock_token,
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            self.assertEqual(paste.contents, json.loads(resp.data)['details']['contents'])
+
+            resp = self.client.post(
+                PasteDetailsURI.uri(),
+                data=json.dumps({
+                    'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                }),
+                content_type='application/json',
+                headers={util.paste_unlock.UNLOCK_TOKEN_HEADER: unlock_token},
+            )
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            self.assertEqual(0, mock_verify_password.call_count)
+
+        # Changing the password revokes the token
+        database.paste.set_paste_password(paste.paste_id, 'new password')
+        resp = self.client.post(
+            PasteDetailsURI.uri(),
+            data=json.dumps({
+                'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                'unlock_token': unlock_token,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.AUTH_FAILURE_CODE, resp.status_code)
+
+        # Pastes without a password need no token
+        paste = util.testing.PasteFactory.generate(password=None, user_id=None)
+        resp = self.client.post(
+            PasteDetailsURI.uri(),
+            data=json.dumps({
+                'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        self.assertIsNone(json.loads(resp.data)['unlock_token'])
+        self.assertNotIn('Set-Cookie', resp.headers)
+
+    def test_paste_details_password_owner(self):
+        user = util.testing.UserFactory.generate(username='username', password='password')
+        paste = util.testing.PasteFactory.generate(password='paste password', user_id=user.user_id)
+        self.api_login_user('username', 'password')
+        resp = self.client.post(
+            PasteDetailsURI.uri(),
+            data=json.dumps({
+                'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        self.assertEqual(paste.contents, json.loads(resp.data)['details']['contents'])
+
+        # The password is still required for pastes owned by other users
+        other_user = util.testing.UserFactory.generate()
+        paste = util.testing.PasteFactory.generate(password='paste password', user_id=other_user.user_id)
+        resp = self.client.post(
+            PasteDetailsURI.uri(),
+            data=json.dumps({
+                'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.AUTH_FAILURE_CODE, resp.status_code)
+
     def test_paste_details_anonymous(self):
         paste = util.testing.PasteFactory.generate(password=None, user_id=None)
         resp = self.client.post(
@@ -722,7 +1209,7 @@ class TestPaste(util.testing.DatabaseTestCase):
             self.assertIn(attachment, json.loads(resp.data)['details']['attachments'])
 
     def test_paste_details_server_error(self):
-        with mock.patch.object(database.paste, 'get_paste_by_id', side_effect=SQLAlchemyError):
+        with mock.patch.object(database.paste, 'get_paste_details', side_effect=SQLAlchemyError):
             paste = util.testing.PasteFactory.generate(password=None)
             resp = self.client.post(
                 PasteDetailsURI.uri(),
@@ -734,6 +1221,37 @@ class TestPaste(util.testing.DatabaseTestCase):
             self.assertEqual(resp.status_code, constants.api.UNDEFINED_FAILURE_CODE)
             self.assertEqual(json.loads(resp.data), constants.api.UNDEFINED_FAILURE)
 
+    def test_paste_details_query_count(self):
+        user = util.testing.UserFactory.generate(username='username')
+        paste = util.testing.PasteFactory.generate(password=None, user_id=user.user_id)
+        for _ in range(5):
+            util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
+        with util.testing.QueryCounter() as counter:
+            resp = self.client.post(
+                PasteDetailsURI.uri(),
+                data=json.dumps({
+                    'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+                }),
+                content_type='application/json',
+            )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        self.assertEqual('username', json.loads(resp.data)['details']['poster_username'])
+        self.assertEqual(5, len(json.loads(resp.data)['details']['attachments']))
+        # One joined query for the paste and its poster, and one for its attachments
+        self.assertEqual(2, counter.count)
+
+    def test_paste_details_nonexistent_poster(self):
+        paste = util.testing.PasteFactory.generate(password=None, user_id=12345)
+        resp = self.client.post(
+            PasteDetailsURI.uri(),
+            data=json.dumps({
+                'paste_id': util.cryptography.get_id_repr(paste.paste_id),
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.NONEXISTENT_PASTE_FAILURE_CODE, resp.status_code)
+        self.assertEqual(constants.api.NONEXISTENT_PASTE_FAILURE, json.loads(resp.data))
+
     def test_pastes_for_user_unauthorized(self):
         resp = self.client.post(
             PastesForUserURI.uri(),
@@ -770,7 +1288,7 @@ class TestPaste(util.testing.DatabaseTestCase):
     def test_pastes_for_user_valid(self):
         user = util.testing.UserFactory.generate(username='username', password='password')
         self.api_login_user('username', 'password')
-        pastes = [util.testing.PasteFactory.generate(user_id=user.user_id).as_dict() for i in range(10)]
+        pastes = [util.testing.PasteFactory.generate(user_id=user.user_id) for i in range(10)]
         resp = self.client.post(
             PastesForUserURI.uri(),
             data=json.dumps({}),
@@ -778,8 +1296,20 @@ class TestPaste(util.testing.DatabaseTestCase):
         )
         self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
         self.assertEqual(len(pastes), len(json.loads(resp.data)['pastes']))
-        for paste in json.loads(resp.data)['pastes']:
-            self.assertIn(paste, pastes)
+        for paste_dict in json.loads(resp.data)['pastes']:
+            self.assertIn(paste_dict, [paste.as_dict(include_contents=False) for paste in pastes])
+
+        resp = self.client.post(
+            PastesForUserURI.uri(),
+            data=json.dumps({
+                'include_contents': True,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        self.assertEqual(len(pastes), len(json.loads(resp.data)['pastes']))
+        for paste_dict in json.loads(resp.data)['pastes']:
+            self.assertIn(paste_dict, [paste.as_dict() for paste in pastes])
 
     def test_pastes_for_user_server_error(self):
         user = util.testing.UserFactory.generate(username='username', password='password')
@@ -843,7 +1373,7 @@ class TestPaste(util.testing.DatabaseTestCase):
             with mock.patch.object(time, 'time', return_value=time.time() + random.randint(-10000, 10000)):
                 pastes.append(util.testing.PasteFactory.generate(expiry_time=None))
         recent_pastes_sorted = map(
-            lambda paste: paste.as_dict(),
+            lambda paste: paste.as_dict(include_contents=False),
             sorted(pastes, key=lambda paste: paste.post_time, reverse=True),
         )
 
@@ -858,6 +1388,144 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
         self.assertEqual(recent_pastes_sorted[0:5], json.loads(resp.data)['pastes'])
 
+    def test_recent_pastes_encrypted_ids(self):
+        config.USE_ENCRYPTED_IDS = True
+        pastes = [util.testing.PasteFactory.generate(expiry_time=None) for i in range(5)]
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'page_num': 0,
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        self.assertEqual(
+            sorted(util.cryptography.get_encid(paste.paste_id) for paste in pastes),
+            sorted(paste_dict['paste_id_repr'] for paste_dict in json.loads(resp.data)['pastes']),
+        )
+        for paste_dict in json.loads(resp.data)['pastes']:
+            self.assertIn(paste_dict, [paste.as_dict(include_contents=False) for paste in pastes])
+
+    def test_recent_pastes_include_contents(self):
+        pastes = [util.testing.PasteFactory.generate(expiry_time=None) for i in range(5)]
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'page_num': 0,
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        for paste in json.loads(resp.data)['pastes']:
+            self.assertNotIn('contents', paste)
+            self.assertEqual(8192, paste['contents_size'])
+
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'page_num': 0,
+                'num_per_page': 5,
+                'include_contents': True,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        for paste_dict in json.loads(resp.data)['pastes']:
+            self.assertIn(paste_dict['contents'], [paste.contents for paste in pastes])
+            self.assertNotIn('contents_preview', paste_dict)
+
+    def test_recent_pastes_cursor(self):
+        pastes = []
+        for i in range(15):
+            with mock.patch.object(time, 'time', return_value=time.time() + random.randint(-10000, 10000)):
+                pastes.append(util.testing.PasteFactory.generate(expiry_time=None))
+        recent_paste_ids = [
+            util.cryptography.get_id_repr(paste.paste_id)
+            for paste in sorted(pastes, key=lambda paste: (paste.post_time, paste.paste_id), reverse=True)
+        ]
+
+        cursor = None
+        for page_num in range(3):
+            resp = self.client.post(
+                RecentPastesURI.uri(),
+                data=json.dumps({
+                    'cursor': cursor,
+                    'num_per_page': 5,
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            self.assertEqual(
+                recent_paste_ids[page_num * 5:(page_num + 1) * 5],
+                [paste['paste_id_repr'] for paste in json.loads(resp.data)['pastes']],
+            )
+            cursor = json.loads(resp.data)['next_cursor']
+            self.assertIsNotNone(cursor)
+
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'cursor': cursor,
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        self.assertEqual([], json.loads(resp.data)['pastes'])
+        self.assertIsNone(json.loads(resp.data)['next_cursor'])
+
+    def test_recent_pastes_invalid_cursor(self):
+        resp = self.client.post(
+            RecentPastesURI.uri(),
+            data=json.dumps({
+                'cursor': 'invalid',
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.INVALID_CURSOR_FAILURE_CODE, resp.status_code)
+        self.assertEqual(constants.api.INVALID_CURSOR_FAILURE, json.loads(resp.data))
+
+    def test_top_pastes_cursor(self):
+        pastes = [util.testing.PasteFactory.generate() for i in range(15)]
+        for paste in pastes:
+            for i in range(random.randint(0, 10)):
+                database.paste.increment_paste_views(paste.paste_id)
+        top_paste_ids = [
+            util.cryptography.get_id_repr(paste.paste_id)
+            for paste in sorted(pastes, key=lambda paste: (paste.views, paste.paste_id), reverse=True)
+        ]
+
+        cursor = None
+        for page_num in range(3):
+            resp = self.client.post(
+                TopPastesURI.uri(),
+                data=json.dumps({
+                    'cursor': cursor,
+                    'num_per_page': 5,
+                }),
+                content_type='application/json',
+            )
+            self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+            self.assertEqual(
+                top_paste_ids[page_num * 5:(page_num + 1) * 5],
+                [paste['paste_id_repr'] for paste in json.loads(resp.data)['pastes']],
+            )
+            cursor = json.loads(resp.data)['next_cursor']
+
+        resp = self.client.post(
+            TopPastesURI.uri(),
+            data=json.dumps({
+                'cursor': 'invalid',
+                'num_per_page': 5,
+            }),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.INVALID_CURSOR_FAILURE_CODE, resp.status_code)
+        self.assertEqual(constants.api.INVALID_CURSOR_FAILURE, json.loads(resp.data))
+
     def test_top_pastes_invalid(self):
         resp = self.client.post(
             TopPastesURI.uri(),
@@ -1,3 +1,4 @@
+import base64
 import json
 
 import mock
@@ -265,6 +266,34 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual(64, len(new_key))
         self.assertNotEqual(old_api_key, new_key)
 
+    def test_user_attachment_usage(self):
+        user = util.testing.UserFactory.generate(username='username', password='password')
+        paste = util.testing.PasteFactory.generate(user_id=user.user_id)
+        util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_data=base64.b64encode('x' * 100))
+        util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_data=base64.b64encode('x' * 200))
+        config.MAX_USER_ATTACHMENTS_SIZE = 5
+
+        self.api_login_user('username', 'password')
+        resp = self.client.post(
+            UserAttachmentUsageURI.uri(),
+            data=json.dumps({}),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.SUCCESS_CODE, resp.status_code)
+        resp_data = json.loads(resp.data)
+        self.assertEqual(300, resp_data['attachments_size'])
+        self.assertEqual(2, resp_data['attachments_count'])
+        self.assertEqual(5 * 1000 * 1000, resp_data['max_attachments_size'])
+        self.assertIsNone(resp_data['max_attachments_count'])
+
+    def test_user_attachment_usage_unauthenticated(self):
+        resp = self.client.post(
+            UserAttachmentUsageURI.uri(),
+            data=json.dumps({}),
+            content_type='application/json',
+        )
+        self.assertEqual(constants.api.AUTH_FAILURE_CODE, resp.status_code)
+
     def test_api_key_regenerate_server_error(self):
         with mock.patch.object(database.user, 'generate_new_api_key', side_effect=SQLAlchemyError):
             util.testing.UserFactory.generate(username='username', password='password')
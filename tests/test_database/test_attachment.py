@@ -1,13 +1,20 @@
+import StringIO
+import base64
 import errno
+import hashlib
 import os
+import shutil
+import tempfile
 
 import mock
 
 import config
 import database.attachment
 import database.paste
+import models
 import util.cryptography
 import util.testing
+from modern_paste import db
 from util.exception import *
 
 
@@ -20,19 +27,21 @@ class TestAttachment(util.testing.DatabaseTestCase):
                 file_name='file name',
                 file_size=12345,
                 mime_type='image/png',
-                file_data='binary data',
+                file_data=base64.b64encode('binary data'),
             )
             self.assertGreater(attachment.attachment_id, -1)
             self.assertEqual(paste.paste_id, attachment.paste_id)
             self.assertEqual('file_name', attachment.file_name)
             self.assertEqual(12345, attachment.file_size)
             self.assertEqual('image/png', attachment.mime_type)
-            self.assertEqual(util.cryptography.secure_hash('file_name'), attachment.hash_name)
+            self.assertEqual(hashlib.sha256('file_name').hexdigest(), attachment.hash_name)
+            self.assertTrue(attachment.is_raw)
+            self.assertEqual(hashlib.sha256('binary data').hexdigest(), attachment.blob_digest)
             self.assertEqual(1, mock_store_attachment_file.call_count)
             mock_store_attachment_file.assert_called_with(
                 paste.paste_id,
                 'binary data',
-                attachment.hash_name,
+                attachment.blob_digest,
             )
 
     def test_create_new_attachment_unsafe_file_name(self):
@@ -43,10 +52,10 @@ class TestAttachment(util.testing.DatabaseTestCase):
                 file_name='test/.bashrc',  # Sneaky
                 file_size=12345,
                 mime_type='image/png',
-                file_data='binary data',
+                file_data=base64.b64encode('binary data'),
             )
             self.assertEqual('test_.bashrc', attachment.file_name)
-            self.assertEqual(util.cryptography.secure_hash('test_.bashrc'), attachment.hash_name)
+            self.assertEqual(hashlib.sha256('test_.bashrc').hexdigest(), attachment.hash_name)
             self.assertEqual(1, mock_store_attachment_file.call_count)
 
     def test_attachment_dict_repr(self):
@@ -57,7 +66,7 @@ class TestAttachment(util.testing.DatabaseTestCase):
                 file_name='file_name',
                 file_size=12345,
                 mime_type='image/png',
-                file_data='binary data',
+                file_data=base64.b64encode('binary data'),
             )
             attachment_dict = attachment.as_dict()
             self.assertEqual(util.cryptography.get_id_repr(paste.paste_id), attachment_dict['paste_id_repr'])
@@ -65,16 +74,332 @@ class TestAttachment(util.testing.DatabaseTestCase):
             self.assertEqual(12345, attachment_dict['file_size'])
             self.assertEqual('image/png', attachment_dict['mime_type'])
 
+    def test_create_new_attachment_deduplicated(self):
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        try:
+            pastes = [util.testing.PasteFactory.generate() for _ in range(3)]
+            attachments = [
+                database.attachment.create_new_attachment(
+                    paste_id=paste.paste_id,
+                    file_name='file name',
+                    file_size=12345,
+                    mime_type='image/png',
+                    file_data=base64.b64encode('binary data'),
+                )
+                for paste in pastes
+            ]
+            digest = hashlib.sha256('binary data').hexdigest()
+            self.assertEqual([digest] * 3, [attachment.blob_digest for attachment in attachments])
+
+            blob = models.AttachmentBlob.query.filter_by(digest=digest).one()
+            self.assertEqual(3, blob.ref_count)
+            self.assertEqual(len('binary data'), blob.file_size)
+
+            # The contents are stored only once
+            self.assertEqual(['blobs'], os.listdir(config.ATTACHMENTS_DIR))
+            self.assertEqual(
+                [digest],
+                os.listdir(os.path.dirname('{attachments_dir}/{relative_file_path}'.format(
+                    attachments_dir=config.ATTACHMENTS_DIR,
+                    relative_file_path=database.attachment.get_blob_file_path(digest),
+                ))),
+            )
+            with open('{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(attachments[0]),
+            ), 'rb') as attachment_file:
+                self.assertEqual('binary data', attachment_file.read())
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+    def test_create_new_attachment_nonexistent_paste(self):
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.attachment.create_new_attachment,
+            paste_id=-1,
+            file_name='file name',
+            file_size=12345,
+            mime_type='image/png',
+            file_data=base64.b64encode('binary data'),
+        )
+        self.assertEqual(0, models.AttachmentBlob.query.count())
+
+    def test_create_new_attachment_inline(self):
+        config.ATTACHMENT_INLINE_MAX_FILE_SIZE = len('binary data')
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        try:
+            paste = util.testing.PasteFactory.generate()
+            attachment = database.attachment.create_new_attachment(
+                paste_id=paste.paste_id,
+                file_name='file name',
+                file_size=len('binary data'),
+                mime_type='image/png',
+                file_data=base64.b64encode('binary data'),
+            )
+            self.assertEqual('binary data', attachment.data)
+            self.assertIsNone(attachment.blob_digest)
+            self.assertEqual(0, models.AttachmentBlob.query.count())
+            self.assertEqual([], os.listdir(config.ATTACHMENTS_DIR))
+            self.assertEqual('binary data', database.attachment.get_attachment_by_name(paste.paste_id, 'file_name').data)
+
+            # Files read from a stream are inlined once complete
+            attachment = database.attachment.create_new_attachment_from_stream(
+                paste_id=paste.paste_id,
+                file_name='stream',
+                mime_type='image/png',
+                stream=StringIO.StringIO('stream data'),
+            )
+            self.assertEqual('stream data', attachment.data)
+            self.assertIsNone(attachment.blob_digest)
+            self.assertEqual([], os.listdir('{attachments_dir}/blobs'.format(attachments_dir=config.ATTACHMENTS_DIR)))
+
+            # Larger files are still stored in the blob store
+            attachment = database.attachment.create_new_attachment(
+                paste_id=paste.paste_id,
+                file_name='large',
+                file_size=len('binary data!'),
+                mime_type='image/png',
+                file_data=base64.b64encode('binary data!'),
+            )
+            self.assertIsNone(attachment.data)
+            self.assertEqual(hashlib.sha256('binary data!').hexdigest(), attachment.blob_digest)
+
+            self.assertRaises(
+                PasteDoesNotExistException,
+                database.attachment.create_new_attachment,
+                paste_id=-1,
+                file_name='file name',
+                file_size=len('binary data'),
+                mime_type='image/png',
+                file_data=base64.b64encode('binary data'),
+            )
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+    def test_iter_attachment_data(self):
+        config.ATTACHMENT_INLINE_MAX_FILE_SIZE = len('inline')
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        try:
+            paste = util.testing.PasteFactory.generate()
+            for data in ['inline', 'blob data']:
+                attachment = database.attachment.create_new_attachment(
+                    paste_id=paste.paste_id,
+                    file_name=data,
+                    file_size=len(data),
+                    mime_type='text/plain',
+                    file_data=base64.b64encode(data),
+                )
+                self.assertEqual(data, ''.join(database.attachment.iter_attachment_data(attachment, chunk_size=4)))
+
+            # Legacy base64-encoded attachment file
+            attachment.blob_digest = None
+            attachment.is_raw = None
+            file_path = '{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(attachment),
+            )
+            os.makedirs(os.path.dirname(file_path))
+            with open(file_path, 'wb') as attachment_file:
+                attachment_file.write(base64.b64encode('legacy file contents'))
+            chunks = list(database.attachment.iter_attachment_data(attachment, chunk_size=3))
+            self.assertEqual('legacy file contents', ''.join(chunks))
+            self.assertTrue(all(len(chunk) <= 3 for chunk in chunks))
+
+            # Legacy files wrapped across lines, as MIME-encoded base64 is
+            contents = ''.join(chr(i % 256) for i in range(200))
+            with open(file_path, 'wb') as attachment_file:
+                attachment_file.write(base64.encodestring(contents))
+            chunks = list(database.attachment.iter_attachment_data(attachment, chunk_size=10))
+            self.assertEqual(contents, ''.join(chunks))
+            self.assertTrue(all(len(chunk) <= 10 for chunk in chunks))
+
+            # Nothing is read until the generator is advanced
+            os.remove(file_path)
+            chunks = database.attachment.iter_attachment_data(attachment)
+            self.assertRaises(IOError, list, chunks)
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+    def test_convert_legacy_attachment(self):
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        try:
+            paste = util.testing.PasteFactory.generate()
+            attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
+            models.Attachment.query.filter_by(attachment_id=attachment.attachment_id).update({
+                models.Attachment.blob_digest: None,
+                models.Attachment.is_raw: None,
+            })
+            # Committing expires the attachment, so it is loaded again as a legacy attachment
+            db.session.commit()
+            file_path = '{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(attachment),
+            )
+            os.makedirs(os.path.dirname(file_path))
+            with open(file_path, 'wb') as attachment_file:
+                attachment_file.write(base64.b64encode('legacy file contents'))
+
+            # Until the conversion is committed, the attachment still refers to its encoded file, which is left intact
+            database.attachment.convert_legacy_attachment(attachment, file_path)
+            db.session.rollback()
+            attachment = models.Attachment.query.filter_by(attachment_id=attachment.attachment_id).one()
+            self.assertIsNone(attachment.blob_digest)
+            self.assertIsNone(attachment.is_raw)
+            self.assertEqual('legacy file contents', ''.join(database.attachment.iter_attachment_data(attachment)))
+
+            database.attachment.convert_legacy_attachment(attachment, file_path)
+            db.session.commit()
+            os.remove(file_path)
+            attachment = models.Attachment.query.filter_by(attachment_id=attachment.attachment_id).one()
+            self.assertEqual(hashlib.sha256('legacy file contents').hexdigest(), attachment.blob_digest)
+            self.assertTrue(attachment.is_raw)
+            self.assertEqual('legacy file contents', ''.join(database.attachment.iter_attachment_data(attachment)))
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+    def test_attachment_totals(self):
+        user = util.testing.UserFactory.generate()
+        paste = util.testing.PasteFactory.generate(user_id=user.user_id)
+        other_paste = util.testing.PasteFactory.generate(user_id=user.user_id)
+        anonymous_paste = util.testing.PasteFactory.generate(user_id=None)
+        util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_data=base64.b64encode('x' * 100))
+        util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_data=base64.b64encode('x' * 200))
+        util.testing.AttachmentFactory.generate(paste_id=other_paste.paste_id, file_data=base64.b64encode('x' * 400))
+        # The declared size of an attachment is not what counts, but the size of its data
+        util.testing.AttachmentFactory.generate(
+            paste_id=anonymous_paste.paste_id,
+            file_size=0,
+            file_data=base64.b64encode('x' * 800),
+        )
+
+        self.assertEqual((300, 2), self._get_totals(models.Paste, paste_id=paste.paste_id))
+        self.assertEqual((400, 1), self._get_totals(models.Paste, paste_id=other_paste.paste_id))
+        self.assertEqual((800, 1), self._get_totals(models.Paste, paste_id=anonymous_paste.paste_id))
+        self.assertEqual((700, 3), self._get_totals(models.User, user_id=user.user_id))
+
+        # Totals not yet computed count as zero
+        models.Paste.query.filter_by(paste_id=paste.paste_id).update({
+            models.Paste.attachments_size: None,
+            models.Paste.attachments_count: None,
+        })
+        util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_data=base64.b64encode('x' * 100))
+        self.assertEqual((100, 1), self._get_totals(models.Paste, paste_id=paste.paste_id))
+
+    def test_attachment_quota(self):
+        user = util.testing.UserFactory.generate()
+        paste = util.testing.PasteFactory.generate(user_id=user.user_id)
+        other_paste = util.testing.PasteFactory.generate(user_id=user.user_id)
+        config.MAX_PASTE_ATTACHMENTS_SIZE = 1000.0 / (1000 * 1000)  # 1000 B
+        config.MAX_PASTE_ATTACHMENTS_COUNT = 2
+        config.MAX_USER_ATTACHMENTS_SIZE = 1500.0 / (1000 * 1000)  # 1500 B
+
+        util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_data=base64.b64encode('x' * 600))
+        self.assertRaises(
+            AttachmentQuotaExceededException,
+            util.testing.AttachmentFactory.generate,
+            paste_id=paste.paste_id,
+            file_data=base64.b64encode('x' * 500),
+        )
+        util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_data=base64.b64encode('x' * 400))
+        # The paste is at its size quota, and would exceed its count quota
+        self.assertRaises(
+            AttachmentQuotaExceededException,
+            util.testing.AttachmentFactory.generate,
+            paste_id=paste.paste_id,
+            file_data=base64.b64encode('x' * 0),
+        )
+        self.assertEqual(2, models.Attachment.query.filter_by(paste_id=paste.paste_id).count())
+        self.assertEqual((1000, 2), self._get_totals(models.Paste, paste_id=paste.paste_id))
+
+        # The user's quota spans all of their pastes
+        self.assertRaises(
+            AttachmentQuotaExceededException,
+            util.testing.AttachmentFactory.generate,
+            paste_id=other_paste.paste_id,
+            file_data=base64.b64encode('x' * 600),
+        )
+        self.assertEqual((0, 0), self._get_totals(models.Paste, paste_id=other_paste.paste_id))
+        self.assertEqual((1000, 2), self._get_totals(models.User, user_id=user.user_id))
+        util.testing.AttachmentFactory.generate(paste_id=other_paste.paste_id, file_data=base64.b64encode('x' * 500))
+        self.assertEqual((1500, 3), self._get_totals(models.User, user_id=user.user_id))
+
+        database.attachment.check_attachment_quota([0], paste_id=util.testing.PasteFactory.generate(user_id=None).paste_id)
+        database.attachment.check_attachment_quota([1000, 0])
+        self.assertRaises(AttachmentQuotaExceededException, database.attachment.check_attachment_quota, [0, 0, 0])
+        self.assertRaises(
+            AttachmentQuotaExceededException,
+            database.attachment.check_attachment_quota,
+            [1],
+            user_id=user.user_id,
+        )
+        self.assertRaises(
+            AttachmentQuotaExceededException,
+            database.attachment.check_attachment_quota,
+            [0],
+            paste_id=paste.paste_id,
+        )
+        self.assertRaises(PasteDoesNotExistException, database.attachment.check_attachment_quota, [0], paste_id=-1)
+
+    def test_recount_attachment_totals(self):
+        user = util.testing.UserFactory.generate()
+        pastes = [util.testing.PasteFactory.generate(user_id=user.user_id) for _ in range(3)]
+        for paste in pastes[:2]:
+            util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_data=base64.b64encode('x' * 100))
+        util.testing.AttachmentFactory.generate(
+            paste_id=pastes[0].paste_id,
+            file_size=12345,
+            file_data=base64.b64encode('y' * 200),
+        )
+        for model in [models.Paste, models.User]:
+            model.query.update({model.attachments_size: None, model.attachments_count: None})
+
+        stats = database.attachment.recount_attachment_totals(chunk_size=2)
+        self.assertEqual(3, stats['recounted_pastes'])
+        self.assertEqual(1, stats['recounted_users'])
+        self.assertEqual((300, 2), self._get_totals(models.Paste, paste_id=pastes[0].paste_id))
+        self.assertEqual((100, 1), self._get_totals(models.Paste, paste_id=pastes[1].paste_id))
+        self.assertEqual((0, 0), self._get_totals(models.Paste, paste_id=pastes[2].paste_id))
+        self.assertEqual((400, 3), self._get_totals(models.User, user_id=user.user_id))
+
+    def test_get_decoded_size(self):
+        for data in ['', 'a', 'ab', 'abc', 'binary data', 'x' * 1000]:
+            self.assertEqual(len(data), database.attachment.get_decoded_size(base64.b64encode(data)))
+        self.assertEqual(0, database.attachment.get_decoded_size(None))
+
+    def _get_totals(self, model, **criteria):
+        row = model.query.filter_by(**criteria).populate_existing().one()
+        return row.attachments_size, row.attachments_count
+
     def test_store_attachment_file(self):
-        with mock.patch.object(os, 'makedirs') as mock_makedirs, mock.patch('__builtin__.open') as mock_open:
+        digest = hashlib.sha256('binary data').hexdigest()
+        blob_file_path = '{attachments_dir}/{relative_file_path}'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+            relative_file_path=database.attachment.get_blob_file_path(digest),
+        )
+
+        with mock.patch.object(os, 'makedirs') as mock_makedirs, mock.patch.object(os, 'rename') as mock_rename, \
+                mock.patch('__builtin__.open') as mock_open:
             exception = OSError()
             exception.errno = errno.EEXIST
             mock_makedirs.side_effect = exception
 
             paste = util.testing.PasteFactory.generate()
-            self.assertIsNone(database.attachment._store_attachment_file(paste.paste_id, 'binary data', 'hash name'))
+            self.assertIsNone(database.attachment._store_attachment_file(paste.paste_id, 'binary data', digest))
             self.assertEqual(1, mock_makedirs.call_count)
+            mock_makedirs.assert_called_with(os.path.dirname(blob_file_path))
             self.assertEqual(1, mock_open.call_count)
+            mock_open.return_value.__enter__.return_value.write.assert_called_with('binary data')
+            # The file is written to a temporary path and then moved into place
+            self.assertEqual(1, mock_rename.call_count)
+            self.assertEqual(blob_file_path, mock_rename.call_args[0][1])
 
         with mock.patch.object(os, 'makedirs') as mock_makedirs, mock.patch('__builtin__.open') as mock_open:
             exception = OSError()
@@ -87,23 +412,186 @@ class TestAttachment(util.testing.DatabaseTestCase):
                 database.attachment._store_attachment_file,
                 paste.paste_id,
                 'binary data',
-                'hash name',
+                digest,
             )
 
-        with mock.patch.object(os, 'makedirs') as mock_makedirs, mock.patch('__builtin__.open') as mock_open:
+        # Files that are already stored are not written again
+        with mock.patch.object(os.path, 'exists', return_value=True), mock.patch('__builtin__.open') as mock_open:
             paste = util.testing.PasteFactory.generate()
-            self.assertIsNone(database.attachment._store_attachment_file(paste.paste_id, 'binary data', 'hash name'))
-            self.assertEqual(1, mock_makedirs.call_count)
-            mock_makedirs.assert_called_with('{attachments_dir}/{paste_id}'.format(
-                attachments_dir=config.ATTACHMENTS_DIR,
+            self.assertIsNone(database.attachment._store_attachment_file(paste.paste_id, 'binary data', digest))
+            self.assertEqual(0, mock_open.call_count)
+
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.attachment._store_attachment_file,
+            -1,
+            'binary data',
+            digest,
+        )
+
+    def test_get_attachment_file_path(self):
+        paste = util.testing.PasteFactory.generate()
+        attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
+        digest = attachment.blob_digest
+        config.ATTACHMENTS_DIR_LEVELS = 2
+        self.assertEqual(
+            'blobs/{first}/{second}/{digest}'.format(first=digest[0:2], second=digest[2:4], digest=digest),
+            database.attachment.get_attachment_file_path(attachment),
+        )
+        self.assertEqual(
+            'blobs/{first}/{digest}'.format(first=digest[0:2], digest=digest),
+            database.attachment.get_attachment_file_path(attachment, levels=1),
+        )
+
+        # Legacy attachments are stored per paste
+        attachment.blob_digest = None
+        paste_hash = hashlib.md5(str(paste.paste_id)).hexdigest()
+        self.assertEqual(
+            'pastes-2/{first}/{second}/{paste_id}/{hash_name}'.format(
+                first=paste_hash[0:2],
+                second=paste_hash[2:4],
                 paste_id=paste.paste_id,
+                hash_name=attachment.hash_name,
+            ),
+            database.attachment.get_attachment_file_path(attachment),
+        )
+        config.ATTACHMENTS_DIR_LEVELS = 0
+        self.assertEqual(
+            '{paste_id}/{hash_name}'.format(paste_id=paste.paste_id, hash_name=attachment.hash_name),
+            database.attachment.get_attachment_file_path(attachment),
+        )
+
+    def test_resolve_attachment_file_path(self):
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        config.ATTACHMENTS_DIR_FALLBACK_LEVELS = [0, 1]
+        try:
+            paste = util.testing.PasteFactory.generate()
+            attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
+
+            # Files missing from every layout resolve to the configured layout
+            self.assertEqual(
+                database.attachment.get_attachment_file_path(attachment),
+                database.attachment.resolve_attachment_file_path(attachment),
+            )
+
+            # Files not yet migrated are found in an earlier layout
+            file_path = '{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(attachment, levels=1),
+            )
+            os.makedirs(os.path.dirname(file_path))
+            open(file_path, 'wb').close()
+            self.assertEqual(
+                database.attachment.get_attachment_file_path(attachment, levels=1),
+                database.attachment.resolve_attachment_file_path(attachment),
+            )
+
+            # Legacy files are found under the names of both naming schemes, whichever the attachment records
+            legacy_attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_name='legacy')
+            legacy_attachment.blob_digest = None
+            legacy_file_path = '{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(legacy_attachment),
+            )
+            os.makedirs(os.path.dirname(legacy_file_path))
+            open(legacy_file_path, 'wb').close()
+            self.assertEqual(hashlib.sha256('legacy').hexdigest(), legacy_attachment.hash_name)
+            self.assertEqual(
+                database.attachment.get_attachment_file_path(legacy_attachment),
+                database.attachment.resolve_attachment_file_path(legacy_attachment),
+            )
+            # The recorded name is looked up first, so the iterated hash is not computed for files found under it
+            with mock.patch.object(util.cryptography, 'secure_hash') as mock_secure_hash:
+                database.attachment.resolve_attachment_file_path(legacy_attachment)
+                self.assertEqual(0, mock_secure_hash.call_count)
+
+            legacy_attachment.hash_name = util.cryptography.secure_hash('legacy')
+            self.assertTrue(database.attachment.resolve_attachment_file_path(legacy_attachment).endswith(
+                hashlib.sha256('legacy').hexdigest(),
             ))
-            self.assertEqual(1, mock_open.call_count)
-            mock_open.assert_called_with('{attachments_dir}/{paste_id}/{file_name}'.format(
+            os.rename(legacy_file_path, '{paste_dir}/{hash_name}'.format(
+                paste_dir=os.path.dirname(legacy_file_path),
+                hash_name=util.cryptography.secure_hash('legacy'),
+            ))
+            self.assertTrue(database.attachment.resolve_attachment_file_path(legacy_attachment).endswith(
+                util.cryptography.secure_hash('legacy'),
+            ))
+            legacy_attachment.hash_name = hashlib.sha256('legacy').hexdigest()
+            self.assertTrue(database.attachment.resolve_attachment_file_path(legacy_attachment).endswith(
+                util.cryptography.secure_hash('legacy'),
+            ))
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+    def test_create_new_attachment_from_stream(self):
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        try:
+            paste = util.testing.PasteFactory.generate()
+            data = os.urandom(database.attachment.UPLOAD_CHUNK_SIZE * 2 + 100)
+            attachment = database.attachment.create_new_attachment_from_stream(
+                paste_id=paste.paste_id,
+                file_name='file name',
+                mime_type='image/png',
+                stream=StringIO.StringIO(data),
+                max_size=len(data),
+            )
+            self.assertEqual('file_name', attachment.file_name)
+            self.assertEqual(len(data), attachment.file_size)
+            self.assertEqual('image/png', attachment.mime_type)
+            self.assertTrue(attachment.is_raw)
+            self.assertEqual(attachment, database.attachment.get_attachment_by_name(paste.paste_id, 'file_name'))
+
+            self.assertEqual(hashlib.sha256(data).hexdigest(), attachment.blob_digest)
+            # No temporary files should be left behind
+            self.assertEqual(
+                [attachment.blob_digest[:2]],
+                os.listdir('{attachments_dir}/blobs'.format(attachments_dir=config.ATTACHMENTS_DIR)),
+            )
+            with open('{attachments_dir}/{relative_file_path}'.format(
                 attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(attachment),
+            ), 'rb') as attachment_file:
+                self.assertEqual(data, attachment_file.read())
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+    def test_create_new_attachment_from_stream_too_large(self):
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        try:
+            paste = util.testing.PasteFactory.generate()
+            stream = StringIO.StringIO(os.urandom(database.attachment.UPLOAD_CHUNK_SIZE * 4))
+            self.assertRaises(
+                AttachmentTooLargeException,
+                database.attachment.create_new_attachment_from_stream,
                 paste_id=paste.paste_id,
-                file_name='hash name',
-            ), 'w')
+                file_name='file name',
+                mime_type='image/png',
+                stream=stream,
+                max_size=database.attachment.UPLOAD_CHUNK_SIZE + 1,
+            )
+            # Reading should stop as soon as the limit is exceeded
+            self.assertEqual(database.attachment.UPLOAD_CHUNK_SIZE * 2, stream.tell())
+            self.assertEqual([], os.listdir('{attachments_dir}/blobs'.format(attachments_dir=config.ATTACHMENTS_DIR)))
+            self.assertEqual([], database.attachment.get_attachments_for_paste(paste.paste_id))
+            self.assertEqual(0, models.AttachmentBlob.query.count())
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+    def test_create_new_attachment_from_stream_nonexistent_paste(self):
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.attachment.create_new_attachment_from_stream,
+            paste_id=-1,
+            file_name='file name',
+            mime_type='image/png',
+            stream=StringIO.StringIO('data'),
+        )
 
     def test_get_attachment_by_id(self):
         self.assertRaises(
@@ -0,0 +1,105 @@
+import time
+
+import mock
+
+import config
+import database.expiry
+import database.leaderboard
+import database.paste
+import util.testing
+from modern_paste import db
+
+
+class TestExpiry(util.testing.DatabaseTestCase):
+    def setUp(self):
+        super(TestExpiry, self).setUp()
+        self.scheduler = database.expiry.ExpiryScheduler(horizon=3600, batch_size=2)
+
+    def test_load(self):
+        now = int(time.time())
+        soon_pastes = [util.testing.PasteFactory.generate(expiry_time=now + 60 * (i + 1)) for i in range(3)]
+        later_paste = util.testing.PasteFactory.generate(expiry_time=now + 7200)
+        util.testing.PasteFactory.generate(expiry_time=None)
+        inactive_paste = util.testing.PasteFactory.generate(expiry_time=now + 60)
+        database.paste.deactivate_paste(inactive_paste.paste_id)
+
+        self.scheduler.load(now + 3600)
+        stats = self.scheduler.stats()
+        self.assertEqual(3, stats['scheduled_pastes'])
+        self.assertEqual(now + 60, stats['next_expiry_time'])
+        self.assertEqual(now + 3600, stats['loaded_until'])
+        self.assertEqual(
+            [paste.paste_id for paste in soon_pastes],
+            self.scheduler.pop_expired(now + 3600),
+        )
+
+        # Extending the horizon only loads the pastes that were not already loaded
+        self.scheduler.load(now + 7200)
+        self.assertEqual([later_paste.paste_id], self.scheduler.pop_expired(now + 7200))
+
+    def test_schedule(self):
+        self.scheduler.schedule(1, int(time.time()) + 60)
+        self.assertEqual(0, self.scheduler.stats()['scheduled_pastes'])
+
+        now = int(time.time())
+        self.scheduler.load(now + 3600)
+        self.scheduler.schedule(1, now + 120)
+        self.scheduler.schedule(2, now + 60)
+        self.scheduler.schedule(3, None)
+        self.scheduler.schedule(4, now + 7200)
+        self.assertEqual(2, self.scheduler.stats()['scheduled_pastes'])
+        self.assertEqual([], self.scheduler.pop_expired(now))
+        self.assertEqual([2], self.scheduler.pop_expired(now + 60))
+        self.assertEqual([1], self.scheduler.pop_expired(now + 3600))
+
+    def test_create_new_paste_schedules(self):
+        config.ENABLE_EXPIRY_SCHEDULER = True
+        now = int(time.time())
+        self.scheduler.load(now + 3600)
+        with mock.patch.object(database.expiry, 'get_expiry_scheduler', return_value=self.scheduler):
+            paste = database.paste.create_new_paste('contents', expiry_time=now + 60)
+            database.paste.create_new_paste('contents', expiry_time=None)
+        self.assertEqual([paste.paste_id], self.scheduler.pop_expired(now + 60))
+
+    def test_run_pending(self):
+        now = time.time()
+        pastes = [util.testing.PasteFactory.generate(expiry_time=int(now) + 10) for _ in range(5)]
+        unexpired_paste = util.testing.PasteFactory.generate(expiry_time=int(now) + 1000)
+        database.paste.deactivate_paste(pastes[0].paste_id)
+
+        self.assertEqual(0, self.scheduler.run_pending())
+        with mock.patch.object(time, 'time', return_value=now + 20):
+            self.assertEqual(4, self.scheduler.run_pending())
+
+        stats = self.scheduler.stats()
+        self.assertEqual(4, stats['deactivated_pastes'])
+        self.assertEqual(2, stats['batch_count'])
+        self.assertEqual(1, stats['scheduled_pastes'])
+
+        db.session.commit()
+        db.session.expire_all()
+        for paste in pastes:
+            self.assertFalse(database.paste.get_paste_by_id(paste.paste_id).is_active)
+        self.assertTrue(database.paste.get_paste_by_id(unexpired_paste.paste_id).is_active)
+
+    def test_run_pending_extends_horizon(self):
+        now = time.time()
+        self.scheduler.run_pending()
+        loaded_until = self.scheduler.stats()['loaded_until']
+        self.assertGreaterEqual(loaded_until, now + 3600)
+
+        paste = util.testing.PasteFactory.generate(expiry_time=int(loaded_until) + 600)
+        with mock.patch.object(time, 'time', return_value=now + 1900):
+            self.scheduler.run_pending()
+        self.assertEqual(1, self.scheduler.stats()['scheduled_pastes'])
+        self.assertEqual(paste.expiry_time, self.scheduler.stats()['next_expiry_time'])
+
+    def test_deactivate_evicts_leaderboard(self):
+        config.ENABLE_TOP_PASTES_LEADERBOARD = True
+        leaderboard = database.leaderboard.TopPastesLeaderboard(size=5, max_staleness=3600)
+        paste = util.testing.PasteFactory.generate(expiry_time=int(time.time()) + 1000)
+        with mock.patch.object(database.leaderboard, 'get_top_pastes_leaderboard', return_value=leaderboard):
+            leaderboard.refresh()
+            self.assertEqual([(paste.paste_id, 0)], leaderboard.get_page(0, 5))
+            self.assertEqual(1, self.scheduler.deactivate([paste.paste_id]))
+            self.assertEqual([], leaderboard.get_page(0, 5))
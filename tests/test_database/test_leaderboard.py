@@ -0,0 +1,133 @@
+import random
+import time
+
+import mock
+
+import config
+import database.leaderboard
+import database.paste
+import util.testing
+
+
+class TestLeaderboard(util.testing.DatabaseTestCase):
+    def setUp(self):
+        super(TestLeaderboard, self).setUp()
+        self.leaderboard = database.leaderboard.TopPastesLeaderboard(size=5, max_staleness=3600)
+
+    def _generate_viewed_pastes(self, num_pastes):
+        pastes = [util.testing.PasteFactory.generate(expiry_time=None) for _ in range(num_pastes)]
+        for paste in pastes:
+            for _ in range(random.randint(0, 10)):
+                database.paste.increment_paste_views(paste.paste_id)
+        return sorted(pastes, key=lambda paste: (paste.views, paste.paste_id), reverse=True)
+
+    def test_refresh(self):
+        pastes = self._generate_viewed_pastes(8)
+        self.assertTrue(self.leaderboard.is_stale())
+        self.leaderboard.refresh()
+        self.assertFalse(self.leaderboard.is_stale())
+        self.assertEqual(
+            [(paste.paste_id, paste.views) for paste in pastes[:5]],
+            self.leaderboard.get_page(0, 5),
+        )
+        self.assertEqual(1, self.leaderboard.refresh_count)
+
+    def test_refresh_excludes_inactive_and_expired(self):
+        pastes = self._generate_viewed_pastes(3)
+        database.paste.deactivate_paste(pastes[0].paste_id)
+        expired_paste = util.testing.PasteFactory.generate(expiry_time=int(time.time()) - 10)
+        self.leaderboard.refresh()
+        self.assertEqual(
+            [(paste.paste_id, paste.views) for paste in pastes[1:]],
+            self.leaderboard.get_page(0, 5),
+        )
+        self.assertNotIn(expired_paste.paste_id, [paste_id for paste_id, _ in self.leaderboard.get_page(0, 5)])
+
+    def test_get_page_stale(self):
+        self.leaderboard.get_page(0, 5)
+        self.assertEqual(1, self.leaderboard.refresh_count)
+        self.leaderboard.get_page(0, 5)
+        self.assertEqual(1, self.leaderboard.refresh_count)
+        with mock.patch.object(time, 'time', return_value=time.time() + 3601):
+            self.leaderboard.get_page(0, 5)
+        self.assertEqual(2, self.leaderboard.refresh_count)
+
+    def test_get_page_beyond_leaderboard(self):
+        pastes = self._generate_viewed_pastes(8)
+        self.leaderboard.refresh()
+        self.assertEqual([(paste.paste_id, paste.views) for paste in pastes[:3]], self.leaderboard.get_page(0, 3))
+        # The second page extends past the last paste held in the leaderboard
+        self.assertIsNone(self.leaderboard.get_page(1, 3))
+
+    def test_get_page_complete(self):
+        pastes = self._generate_viewed_pastes(4)
+        self.leaderboard.refresh()
+        # All active pastes fit in the leaderboard, so a partial page is authoritative
+        self.assertEqual([(paste.paste_id, paste.views) for paste in pastes[3:]], self.leaderboard.get_page(1, 3))
+        self.assertEqual([], self.leaderboard.get_page(2, 3))
+
+    def test_get_page_after(self):
+        self._generate_viewed_pastes(5)
+        self.leaderboard.refresh()
+        first_page = self.leaderboard.get_page(0, 2)
+        paste_id, views = first_page[-1]
+        self.assertEqual(self.leaderboard.get_page(1, 2), self.leaderboard.get_page(0, 2, after=(views, paste_id)))
+
+    def test_get_page_skips_expired(self):
+        paste = util.testing.PasteFactory.generate(expiry_time=int(time.time()) + 60)
+        self.leaderboard.refresh()
+        self.assertEqual([(paste.paste_id, 0)], self.leaderboard.get_page(0, 5))
+        with mock.patch.object(time, 'time', return_value=time.time() + 120):
+            self.leaderboard.max_staleness = 3600 * 2
+            self.assertEqual([], self.leaderboard.get_page(0, 5))
+
+    def test_record_views(self):
+        pastes = self._generate_viewed_pastes(6)
+        self.leaderboard.refresh()
+        self.assertNotIn(pastes[5].paste_id, [paste_id for paste_id, _ in self.leaderboard.get_page(0, 5)])
+
+        # A paste outside the leaderboard is added once it ranks among the top pastes
+        self.leaderboard.record_views(pastes[5].paste_id, pastes[0].views + 1)
+        self.assertEqual((pastes[5].paste_id, pastes[0].views + 1), self.leaderboard.get_page(0, 5)[0])
+        self.assertNotIn(pastes[4].paste_id, [paste_id for paste_id, _ in self.leaderboard.get_page(0, 5)])
+
+        # A paste that does not rank among the top pastes is not added
+        self.leaderboard.record_views(pastes[4].paste_id, 0)
+        self.assertNotIn(pastes[4].paste_id, [paste_id for paste_id, _ in self.leaderboard.get_page(0, 5)])
+
+        # A paste already in the leaderboard is moved
+        self.leaderboard.record_views(pastes[3].paste_id, pastes[0].views + 2)
+        self.assertEqual((pastes[3].paste_id, pastes[0].views + 2), self.leaderboard.get_page(0, 5)[0])
+        self.assertEqual(1, self.leaderboard.refresh_count)
+
+    def test_record_views_before_refresh(self):
+        self.leaderboard.record_views(1, 10)
+        self.assertTrue(self.leaderboard.is_stale())
+
+    def test_remove(self):
+        pastes = self._generate_viewed_pastes(3)
+        self.leaderboard.refresh()
+        self.leaderboard.remove(pastes[0].paste_id)
+        self.leaderboard.remove(-1)
+        self.assertEqual(
+            [(paste.paste_id, paste.views) for paste in pastes[1:]],
+            self.leaderboard.get_page(0, 5),
+        )
+
+    def test_get_top_pastes_leaderboard(self):
+        config.ENABLE_TOP_PASTES_LEADERBOARD = True
+        pastes = [util.testing.PasteFactory.generate(expiry_time=None) for _ in range(7)]
+        with mock.patch.object(database.leaderboard, 'get_top_pastes_leaderboard', return_value=self.leaderboard):
+            self.leaderboard.refresh()
+            for paste in pastes[:3]:
+                database.paste.increment_paste_views(paste.paste_id)
+            database.paste.increment_paste_views(pastes[0].paste_id)
+            database.paste.deactivate_paste(pastes[1].paste_id)
+
+            top_pastes = database.paste.get_top_pastes(0, 2)
+            self.assertEqual([pastes[0].paste_id, pastes[2].paste_id], [paste.paste_id for paste in top_pastes])
+            self.assertEqual([2, 1], [paste.views for paste in top_pastes])
+            self.assertEqual(1, self.leaderboard.refresh_count)
+
+            # Pages past the end of the leaderboard are queried from the database
+            self.assertEqual(2, len(database.paste.get_top_pastes(2, 2)))
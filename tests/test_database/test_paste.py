@@ -7,10 +7,13 @@ import errno
 
 import mock
 
+import config
 import database.attachment
 import database.paste
+import database.view_buffer
 import util.cryptography
 import util.testing
+from modern_paste import db
 from util.exception import *
 
 
@@ -23,7 +26,7 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual('title', paste.title)
         self.assertEqual('python', paste.language)
         self.assertEqual('python', paste.language)
-        self.assertEqual(util.cryptography.secure_hash('password'), paste.password_hash)
+        self.assertTrue(util.cryptography.verify_password('password', paste.password_hash))
         self.assertTrue(paste.is_api_post)
 
         # Should also be able to create pastes with all optional fields blank
@@ -71,6 +74,50 @@ class TestPaste(util.testing.DatabaseTestCase):
             active_only=True,
         )
 
+    def test_get_paste_details(self):
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.get_paste_details,
+            -1,
+        )
+
+        user = util.testing.UserFactory.generate(username='username')
+        paste = util.testing.PasteFactory.generate(user_id=user.user_id)
+        attachments = [util.testing.AttachmentFactory.generate(paste_id=paste.paste_id) for _ in range(3)]
+        # An attachment of no existing paste, whose ID no paste can be given
+        util.testing.AttachmentFactory.generate(paste_id=-1)
+        queried_paste, queried_attachments, poster_username = database.paste.get_paste_details(paste.paste_id)
+        self.assertEqual(paste, queried_paste)
+        self.assertEqual(
+            set([attachment.attachment_id for attachment in attachments]),
+            set([attachment.attachment_id for attachment in queried_attachments]),
+        )
+        self.assertEqual('username', poster_username)
+
+        # Anonymous paste
+        paste = util.testing.PasteFactory.generate(user_id=None)
+        queried_paste, queried_attachments, poster_username = database.paste.get_paste_details(paste.paste_id)
+        self.assertEqual(paste, queried_paste)
+        self.assertEqual([], queried_attachments)
+        self.assertIsNone(poster_username)
+
+        database.paste.deactivate_paste(paste.paste_id)
+        self.assertEqual(paste, database.paste.get_paste_details(paste.paste_id)[0])
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.get_paste_details,
+            paste.paste_id,
+            active_only=True,
+        )
+
+        paste = util.testing.PasteFactory.generate(expiry_time=int(time.time()) - 1000)
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.get_paste_details,
+            paste.paste_id,
+            active_only=True,
+        )
+
     def test_is_paste_active(self):
         self.assertFalse(database.paste.is_paste_active(-1))
 
@@ -89,7 +136,7 @@ class TestPaste(util.testing.DatabaseTestCase):
         old_password_hash = str(paste.password_hash)
         database.paste.set_paste_password(paste.paste_id, 'new password')
         new_password_hash = str(database.paste.get_paste_by_id(paste.paste_id).password_hash)
-        self.assertEqual(util.cryptography.secure_hash('new password'), new_password_hash)
+        self.assertTrue(util.cryptography.verify_password('new password', new_password_hash))
         self.assertNotEqual(new_password_hash, old_password_hash)
 
         paste = util.testing.PasteFactory.generate()
@@ -133,6 +180,74 @@ class TestPaste(util.testing.DatabaseTestCase):
             database.paste.increment_paste_views(paste.paste_id)
         self.assertEqual(51, database.paste.get_paste_by_id(paste.paste_id).views)
 
+    def test_view_paste(self):
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.view_paste,
+            paste_id=-1,
+        )
+
+        paste = util.testing.PasteFactory.generate()
+        self.assertEqual(paste, database.paste.view_paste(paste.paste_id))
+        self.assertEqual(1, paste.views)
+        for i in range(10):
+            database.paste.view_paste(paste.paste_id)
+        db.session.expire_all()
+        self.assertEqual(11, database.paste.get_paste_by_id(paste.paste_id).views)
+
+        database.paste.deactivate_paste(paste.paste_id)
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.view_paste,
+            paste_id=paste.paste_id,
+        )
+
+        paste = util.testing.PasteFactory.generate(expiry_time=int(time.time()) - 1000)
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.view_paste,
+            paste_id=paste.paste_id,
+        )
+        self.assertEqual(0, database.paste.get_paste_by_id(paste.paste_id).views)
+
+    def test_view_paste_query_count(self):
+        # The ID is read up front, since reading it from the expired paste would be counted as a query
+        paste_id = util.testing.PasteFactory.generate().paste_id
+        db.session.expire_all()
+
+        # Previous view path: active lookup, then a second lookup and write to increment the view count
+        with util.testing.QueryCounter() as counter:
+            database.paste.get_paste_by_id(paste_id, active_only=True)
+            database.paste.increment_paste_views(paste_id)
+        self.assertEqual(3, counter.count)
+        db.session.expire_all()
+
+        # Fused path: one lookup, one atomic increment
+        with util.testing.QueryCounter() as counter:
+            database.paste.view_paste(paste_id)
+        self.assertEqual(2, counter.count)
+        db.session.expire_all()
+
+        # Fused path with buffered view counts: the lookup is the only statement
+        config.ENABLE_VIEW_COUNT_BUFFER = True
+        with mock.patch.object(database.view_buffer, 'buffer_paste_view', return_value=1) as mock_buffer_paste_view:
+            with util.testing.QueryCounter() as counter:
+                database.paste.view_paste(paste_id)
+            self.assertEqual(1, counter.count)
+            mock_buffer_paste_view.assert_called_with(paste_id)
+
+    def test_count_paste_view(self):
+        paste = util.testing.PasteFactory.generate()
+        with util.testing.QueryCounter() as counter:
+            self.assertEqual(paste, database.paste.count_paste_view(paste))
+        self.assertEqual(1, counter.count)
+        self.assertEqual(1, paste.views)
+        # The incremented view count should not be written back as an absolute value by a later commit
+        self.assertNotIn(paste, db.session.dirty)
+        database.paste.deactivate_paste(paste.paste_id)
+        db.session.expire_all()
+        self.assertEqual(1, database.paste.get_paste_by_id(paste.paste_id).views)
+
     def test_get_recent_pastes(self):
         pastes = []
         for i in range(15):
@@ -157,6 +272,36 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual([], database.paste.get_top_pastes(3, 5))
         self.assertEqual([], database.paste.get_top_pastes(4, 5))
 
+    def test_get_recent_pastes_after(self):
+        pastes = []
+        for i in range(15):
+            with mock.patch.object(time, 'time', return_value=time.time() + random.randint(-10, 10)):
+                pastes.append(util.testing.PasteFactory.generate(expiry_time=None))
+        recent_pastes_sorted = sorted(pastes, key=lambda paste: (paste.post_time, paste.paste_id), reverse=True)
+
+        page = database.paste.get_recent_pastes(0, 5)
+        self.assertEqual(recent_pastes_sorted[0:5], page)
+        page = database.paste.get_recent_pastes(0, 5, after=(page[-1].post_time, page[-1].paste_id))
+        self.assertEqual(recent_pastes_sorted[5:10], page)
+        page = database.paste.get_recent_pastes(0, 5, after=(page[-1].post_time, page[-1].paste_id))
+        self.assertEqual(recent_pastes_sorted[10:15], page)
+        self.assertEqual([], database.paste.get_recent_pastes(0, 5, after=(page[-1].post_time, page[-1].paste_id)))
+
+    def test_get_top_pastes_after(self):
+        pastes = [util.testing.PasteFactory.generate() for i in range(15)]
+        for paste in pastes:
+            for i in range(random.randint(0, 3)):
+                database.paste.increment_paste_views(paste.paste_id)
+        top_pastes_sorted = sorted(pastes, key=lambda paste: (paste.views, paste.paste_id), reverse=True)
+
+        page = database.paste.get_top_pastes(0, 5)
+        self.assertEqual(top_pastes_sorted[0:5], page)
+        page = database.paste.get_top_pastes(0, 5, after=(page[-1].views, page[-1].paste_id))
+        self.assertEqual(top_pastes_sorted[5:10], page)
+        page = database.paste.get_top_pastes(0, 5, after=(page[-1].views, page[-1].paste_id))
+        self.assertEqual(top_pastes_sorted[10:15], page)
+        self.assertEqual([], database.paste.get_top_pastes(0, 5, after=(page[-1].views, page[-1].paste_id)))
+
     def test_get_all_pastes_for_user(self):
         user = util.testing.UserFactory.generate()
         pastes = []
@@ -183,6 +328,45 @@ class TestPaste(util.testing.DatabaseTestCase):
         for paste in queried_active_pastes:
             self.assertTrue(paste.is_active)
 
+    def test_get_pastes_summary(self):
+        user = util.testing.UserFactory.generate()
+        contents = 'line\n' * 100 + 'last line'
+        for i in range(5):
+            # Previews of password-protected pastes are redacted
+            util.testing.PasteFactory.generate(user_id=user.user_id, contents=contents, expiry_time=None, password=None)
+        db.session.expunge_all()
+
+        for pastes in [
+            database.paste.get_recent_pastes(0, 5, summary=True),
+            database.paste.get_top_pastes(0, 5, summary=True),
+            database.paste.get_all_pastes_for_user(user.user_id, active_only=True, summary=True),
+        ]:
+            self.assertEqual(5, len(pastes))
+            for paste in pastes:
+                # The contents should not have been loaded
+                self.assertNotIn('contents', paste.__dict__)
+                self.assertEqual(contents[:200], paste.contents_preview)
+                self.assertEqual(len(contents), paste.contents_size)
+                self.assertEqual(101, paste.contents_num_lines)
+                summary_dict = paste.as_dict(include_contents=False)
+                self.assertNotIn('contents', summary_dict)
+                self.assertNotIn('contents', paste.__dict__)
+                self.assertEqual(contents[:200], summary_dict['contents_preview'])
+                self.assertEqual(len(contents), summary_dict['contents_size'])
+                self.assertEqual(101, summary_dict['contents_num_lines'])
+            db.session.expunge_all()
+
+        # Non-summary queries should not load the summary projections
+        for paste in database.paste.get_recent_pastes(0, 5):
+            self.assertEqual(contents, paste.__dict__['contents'])
+            self.assertNotIn('contents_preview', paste.__dict__)
+
+    def test_get_pastes_summary_password_protected(self):
+        util.testing.PasteFactory.generate(password='password', expiry_time=None)
+        db.session.expunge_all()
+        paste = database.paste.get_recent_pastes(0, 5, summary=True)[0]
+        self.assertIsNone(paste.as_dict(include_contents=False)['contents_preview'])
+
     def test_get_all_pastes_for_user_expired(self):
         user = util.testing.UserFactory.generate()
         [util.testing.PasteFactory.generate(user_id=user.user_id, expiry_time=int(time.time()) - 1000) for i in range(15)]
@@ -195,7 +379,8 @@ class TestPaste(util.testing.DatabaseTestCase):
         deactivated_pastes = [database.paste.deactivate_paste(paste.paste_id) for paste in pastes[:10]]
         with mock.patch.object(shutil, 'rmtree') as mock_rmtree:
             database.paste.scrub_inactive_pastes()
-            self.assertEqual(10, mock_rmtree.call_count)
+            # Each paste's attachment directory is removed in every directory layout
+            self.assertEqual(10 * len(database.attachment.get_layout_levels()), mock_rmtree.call_count)
             for deactivated_paste in deactivated_pastes:
                 self.assertRaises(
                     PasteDoesNotExistException,
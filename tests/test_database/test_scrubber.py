@@ -0,0 +1,174 @@
+import base64
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+
+import config
+import database.attachment
+import database.leaderboard
+import database.paste
+import database.scrubber
+import database.user
+import models
+import util.testing
+from modern_paste import db
+from util.exception import *
+
+
+class TestScrubber(util.testing.DatabaseTestCase):
+    def test_scrub_inactive_pastes_chunked(self):
+        pastes = [util.testing.PasteFactory.generate(expiry_time=None) for _ in range(10)]
+        [util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_name='file') for paste in pastes]
+        deactivated_pastes = [database.paste.deactivate_paste(paste.paste_id) for paste in pastes[:7]]
+        expired_paste = util.testing.PasteFactory.generate(expiry_time=int(time.time()) - 10)
+
+        progress = []
+        scrubber = database.scrubber.Scrubber(chunk_size=3, chunk_interval=0.5, progress_callback=progress.append)
+        with mock.patch.object(shutil, 'rmtree') as mock_rmtree, mock.patch.object(time, 'sleep') as mock_sleep:
+            stats = scrubber.scrub_inactive_pastes()
+            self.assertEqual(8 * len(database.attachment.get_layout_levels()), mock_rmtree.call_count)
+            # The 8 scrubbed pastes are deleted in chunks of 3, pausing between chunks
+            self.assertEqual([mock.call(0.5)] * 2, mock_sleep.call_args_list)
+
+        self.assertEqual(3, stats['chunk_count'])
+        self.assertEqual(8, stats['deleted_pastes'])
+        self.assertEqual(7, stats['deleted_attachments'])
+        self.assertEqual(7, stats['deleted_blobs'])
+        self.assertEqual(0, stats['deleted_users'])
+        self.assertGreaterEqual(stats['pastes_per_second'], 0)
+        self.assertEqual([3, 6, 8], [chunk_stats['deleted_pastes'] for chunk_stats in progress])
+
+        for paste in deactivated_pastes + [expired_paste]:
+            self.assertRaises(
+                PasteDoesNotExistException,
+                database.paste.get_paste_by_id,
+                paste_id=paste.paste_id,
+            )
+        for paste in pastes[7:]:
+            self.assertIsNotNone(database.paste.get_paste_by_id(paste.paste_id))
+            self.assertIsNotNone(database.attachment.get_attachment_by_name(paste.paste_id, 'file'))
+
+    def test_scrub_inactive_pastes_committed(self):
+        # The ID is read up front, since the rollback expires the paste, whose row no longer exists to reload it from
+        paste_id = util.testing.PasteFactory.generate(expiry_time=None).paste_id
+        database.paste.deactivate_paste(paste_id)
+        with mock.patch.object(shutil, 'rmtree'):
+            database.paste.scrub_inactive_pastes()
+        db.session.rollback()
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.paste.get_paste_by_id,
+            paste_id=paste_id,
+        )
+
+    def test_scrub_inactive_pastes_leaderboard(self):
+        config.ENABLE_TOP_PASTES_LEADERBOARD = True
+        leaderboard = database.leaderboard.TopPastesLeaderboard(size=5, max_staleness=3600)
+        paste_id = util.testing.PasteFactory.generate(expiry_time=int(time.time()) + 5).paste_id
+        with mock.patch.object(database.leaderboard, 'get_top_pastes_leaderboard', return_value=leaderboard):
+            leaderboard.refresh()
+            self.assertEqual([paste_id], [top_paste_id for top_paste_id, _ in leaderboard.get_page(0, 5)])
+            with mock.patch.object(time, 'time', return_value=time.time() + 10), mock.patch.object(shutil, 'rmtree'):
+                database.paste.scrub_inactive_pastes()
+            self.assertEqual([], leaderboard.get_page(0, 5))
+
+    def test_scrub_inactive_pastes_shared_blobs(self):
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        try:
+            pastes = [util.testing.PasteFactory.generate(expiry_time=None) for _ in range(2)]
+            attachments = [
+                database.attachment.create_new_attachment(
+                    paste_id=paste.paste_id,
+                    file_name='file',
+                    file_size=11,
+                    mime_type='text/plain',
+                    file_data=base64.b64encode('binary data'),
+                )
+                for paste in pastes
+            ]
+            blob_file_path = '{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(attachments[0]),
+            )
+
+            # The blob is still referenced by the other paste's attachment
+            database.paste.deactivate_paste(pastes[0].paste_id)
+            stats = database.scrubber.Scrubber(chunk_size=10, chunk_interval=0).scrub_inactive_pastes()
+            self.assertEqual(1, stats['deleted_attachments'])
+            self.assertEqual(0, stats['deleted_blobs'])
+            self.assertEqual(1, models.AttachmentBlob.query.filter_by(digest=attachments[0].blob_digest).one().ref_count)
+            self.assertTrue(os.path.exists(blob_file_path))
+
+            database.paste.deactivate_paste(pastes[1].paste_id)
+            stats = database.scrubber.Scrubber(chunk_size=10, chunk_interval=0).scrub_inactive_pastes()
+            self.assertEqual(1, stats['deleted_attachments'])
+            self.assertEqual(1, stats['deleted_blobs'])
+            self.assertEqual(0, models.AttachmentBlob.query.count())
+            self.assertFalse(os.path.exists(blob_file_path))
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+    def test_scrub_inactive_pastes_attachment_totals(self):
+        user = util.testing.UserFactory.generate()
+        pastes = [util.testing.PasteFactory.generate(user_id=user.user_id, expiry_time=None) for _ in range(3)]
+        for paste in pastes:
+            util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_data=base64.b64encode('x' * 100))
+        util.testing.AttachmentFactory.generate(paste_id=pastes[0].paste_id, file_data=base64.b64encode('y' * 50))
+
+        for paste in pastes[:2]:
+            database.paste.deactivate_paste(paste.paste_id)
+        with mock.patch.object(shutil, 'rmtree'):
+            database.scrubber.Scrubber(chunk_size=10, chunk_interval=0).scrub_inactive_pastes()
+
+        user = models.User.query.filter_by(user_id=user.user_id).populate_existing().one()
+        self.assertEqual(100, user.attachments_size)
+        self.assertEqual(1, user.attachments_count)
+
+    def test_scrub_inactive_users(self):
+        users = [util.testing.UserFactory.generate() for _ in range(5)]
+        pastes = [util.testing.PasteFactory.generate(user_id=user.user_id, expiry_time=None) for user in users]
+        anonymous_paste = util.testing.PasteFactory.generate(user_id=None, expiry_time=None)
+        # Deactivate the users directly, leaving their pastes active
+        for user in users[:3]:
+            user.is_active = False
+        db.session.commit()
+
+        # The IDs are read up front, since the rollback below expires the users and pastes, whose rows may be deleted
+        user_ids = [user.user_id for user in users]
+        paste_ids = [paste.paste_id for paste in pastes]
+        anonymous_paste_id = anonymous_paste.paste_id
+
+        scrubber = database.scrubber.Scrubber(chunk_size=2, chunk_interval=0)
+        with mock.patch.object(shutil, 'rmtree') as mock_rmtree:
+            stats = scrubber.scrub_inactive_users()
+            self.assertEqual(3 * len(database.attachment.get_layout_levels()), mock_rmtree.call_count)
+        self.assertEqual(3, stats['deleted_users'])
+        self.assertEqual(3, stats['deleted_pastes'])
+
+        db.session.rollback()
+        for user_id, paste_id in zip(user_ids[:3], paste_ids[:3]):
+            self.assertRaises(
+                UserDoesNotExistException,
+                database.user.get_user_by_id,
+                user_id=user_id,
+            )
+            self.assertRaises(
+                PasteDoesNotExistException,
+                database.paste.get_paste_by_id,
+                paste_id=paste_id,
+            )
+        for user_id, paste_id in zip(user_ids[3:], paste_ids[3:]):
+            self.assertIsNotNone(database.user.get_user_by_id(user_id))
+            self.assertIsNotNone(database.paste.get_paste_by_id(paste_id))
+        self.assertIsNotNone(database.paste.get_paste_by_id(anonymous_paste_id))
+
+    def test_stats_before_scrub(self):
+        stats = database.scrubber.Scrubber(chunk_size=10, chunk_interval=0).stats()
+        self.assertEqual(0, stats['chunk_count'])
+        self.assertEqual(0.0, stats['elapsed_time'])
+        self.assertEqual(0.0, stats['pastes_per_second'])
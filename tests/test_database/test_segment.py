@@ -0,0 +1,115 @@
+import base64
+import os
+import shutil
+import tempfile
+
+import config
+import database.attachment
+import database.paste
+import database.scrubber
+import database.segment
+import models
+import util.testing
+
+
+class TestSegment(util.testing.DatabaseTestCase):
+    def setUp(self):
+        super(TestSegment, self).setUp()
+        self.attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        config.ENABLE_ATTACHMENT_SEGMENTS = True
+        config.ATTACHMENT_SEGMENT_MAX_FILE_SIZE = 100
+        config.ATTACHMENT_SEGMENT_SIZE = 1000
+
+    def tearDown(self):
+        shutil.rmtree(config.ATTACHMENTS_DIR)
+        config.ATTACHMENTS_DIR = self.attachments_dir
+        super(TestSegment, self).tearDown()
+
+    def _create_attachment(self, paste, data):
+        return database.attachment.create_new_attachment(
+            paste_id=paste.paste_id,
+            file_name='file',
+            file_size=len(data),
+            mime_type='text/plain',
+            file_data=base64.b64encode(data),
+        )
+
+    def test_is_segment_candidate(self):
+        self.assertTrue(database.segment.is_segment_candidate(0))
+        self.assertTrue(database.segment.is_segment_candidate(100))
+        self.assertFalse(database.segment.is_segment_candidate(101))
+        config.ENABLE_ATTACHMENT_SEGMENTS = False
+        self.assertFalse(database.segment.is_segment_candidate(0))
+
+    def test_append_to_segment(self):
+        self.assertEqual([], database.segment.get_segment_ids())
+        self.assertEqual((1, 0), database.segment.append_to_segment('a' * 600))
+        self.assertEqual((1, 600), database.segment.append_to_segment('b' * 300))
+        # The active segment is sealed once it would grow beyond the segment size
+        self.assertEqual((2, 0), database.segment.append_to_segment('c' * 200))
+        self.assertEqual([1, 2], database.segment.get_segment_ids())
+
+        self.assertEqual('a' * 600, database.segment.read_segment(1, 0, 600))
+        self.assertEqual('b' * 300, database.segment.read_segment(1, 600, 300))
+        self.assertEqual('c' * 200, database.segment.read_segment(2, 0, 200))
+
+        # Data larger than the segment size still goes into a segment of its own
+        self.assertEqual((3, 0), database.segment.append_to_segment('d' * 2000))
+
+    def test_create_new_attachment_in_segment(self):
+        paste = util.testing.PasteFactory.generate()
+        attachment = self._create_attachment(paste, 'small file')
+        blob = models.AttachmentBlob.query.filter_by(digest=attachment.blob_digest).one()
+        self.assertEqual(1, blob.segment_id)
+        self.assertEqual(0, blob.segment_offset)
+        self.assertEqual(
+            (database.segment.get_segment_path(1), 0, len('small file')),
+            database.attachment.get_attachment_segment(attachment),
+        )
+        self.assertEqual('small file', ''.join(database.attachment.iter_attachment_data(attachment, chunk_size=3)))
+        self.assertFalse(os.path.exists('{attachments_dir}/{blobs_dir}'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+            blobs_dir=database.attachment.BLOBS_DIR,
+        )))
+
+        # Identical files are not appended again
+        self._create_attachment(util.testing.PasteFactory.generate(), 'small file')
+        self.assertEqual(len('small file'), os.path.getsize(database.segment.get_segment_path(1)))
+
+        # Large files are still stored in files of their own
+        large_attachment = self._create_attachment(paste, 'x' * 101)
+        self.assertIsNone(database.attachment.get_attachment_segment(large_attachment))
+        self.assertTrue(os.path.exists('{attachments_dir}/{relative_file_path}'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+            relative_file_path=database.attachment.get_attachment_file_path(large_attachment),
+        )))
+
+    def test_compact_attachment_segments(self):
+        pastes = [util.testing.PasteFactory.generate(expiry_time=None) for _ in range(12)]
+        attachments = [self._create_attachment(paste, chr(ord('a') + i) * 100) for i, paste in enumerate(pastes)]
+        # Segment 1 holds the first 10 attachments, and segment 2 is active
+        self.assertEqual([1, 2], database.segment.get_segment_ids())
+
+        for paste in pastes[:4]:
+            database.paste.deactivate_paste(paste.paste_id)
+        database.scrubber.Scrubber(chunk_size=10, chunk_interval=0).scrub_inactive_pastes()
+
+        # Only 40% of segment 1 is garbage
+        stats = database.segment.compact_attachment_segments(threshold=0.5)
+        self.assertEqual(0, stats['compacted_segments'])
+
+        database.paste.deactivate_paste(pastes[4].paste_id)
+        database.scrubber.Scrubber(chunk_size=10, chunk_interval=0).scrub_inactive_pastes()
+        stats = database.segment.compact_attachment_segments(threshold=0.5, chunk_size=2)
+        self.assertEqual(1, stats['compacted_segments'])
+        self.assertEqual(5, stats['moved_blobs'])
+        self.assertEqual(500, stats['reclaimed_bytes'])
+        self.assertFalse(os.path.exists(database.segment.get_segment_path(1)))
+
+        for i, attachment in enumerate(attachments[5:], 5):
+            segment_path, offset, length = database.attachment.get_attachment_segment(attachment)
+            self.assertNotEqual(database.segment.get_segment_path(1), segment_path)
+            with open(segment_path, 'rb') as segment_file:
+                segment_file.seek(offset)
+                self.assertEqual(chr(ord('a') + i) * 100, segment_file.read(length))
@@ -0,0 +1,197 @@
+import StringIO
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+
+import config
+import database.attachment
+import database.upload_session
+import util.testing
+from util.exception import *
+
+
+class TestUploadSession(util.testing.DatabaseTestCase):
+    def setUp(self):
+        super(TestUploadSession, self).setUp()
+        self.attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        config.UPLOAD_SESSION_CHUNK_SIZE = 10
+
+    def tearDown(self):
+        shutil.rmtree(config.ATTACHMENTS_DIR)
+        config.ATTACHMENTS_DIR = self.attachments_dir
+        super(TestUploadSession, self).tearDown()
+
+    def _upload_chunks(self, upload_session, data, chunk_indexes):
+        for chunk_index in chunk_indexes:
+            chunk = data[chunk_index * upload_session.chunk_size:(chunk_index + 1) * upload_session.chunk_size]
+            database.upload_session.write_upload_chunk(upload_session, chunk_index, StringIO.StringIO(chunk))
+
+    def test_create_upload_session(self):
+        paste = util.testing.PasteFactory.generate()
+        upload_session = database.upload_session.create_upload_session(paste.paste_id, 'file name', 25, 'image/png')
+        self.assertEqual('file_name', upload_session.file_name)
+        self.assertEqual(25, upload_session.file_size)
+        self.assertEqual(10, upload_session.chunk_size)
+        self.assertEqual(3, upload_session.num_chunks)
+        self.assertEqual([10, 10, 5], [upload_session.get_chunk_length(i) for i in range(3)])
+        self.assertEqual(64, len(upload_session.upload_token))
+        self.assertEqual(upload_session, database.upload_session.get_upload_session(upload_session.upload_token))
+        self.assertEqual([], database.upload_session.get_received_chunks(upload_session))
+
+        self.assertRaises(
+            PasteDoesNotExistException,
+            database.upload_session.create_upload_session,
+            -1,
+            'file name',
+            25,
+            'image/png',
+        )
+        self.assertRaises(
+            UploadSessionDoesNotExistException,
+            database.upload_session.get_upload_session,
+            'invalid',
+        )
+
+    def test_create_upload_session_size_limits(self):
+        paste = util.testing.PasteFactory.generate()
+        paste_dir = database.attachment.get_paste_attachment_dir(paste.paste_id)
+        # Without an attachment size limit, the size of resumable uploads is still bounded
+        config.UPLOAD_SESSION_MAX_FILE_SIZE = 25.0 / (1000 * 1000)  # 25 B
+        database.upload_session.create_upload_session(paste.paste_id, 'file', 25, 'image/png')
+        config.MAX_PASTE_ATTACHMENTS_SIZE = 15.0 / (1000 * 1000)  # 15 B
+        for file_size, exception in [
+            (26, AttachmentTooLargeException),
+            (2 ** 62, AttachmentTooLargeException),
+            # Uploads that would exceed a quota are rejected before their partial file is created
+            (20, AttachmentQuotaExceededException),
+        ]:
+            num_files = len(os.listdir('{attachments_dir}/{paste_dir}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                paste_dir=paste_dir,
+            )))
+            self.assertRaises(
+                exception,
+                database.upload_session.create_upload_session,
+                paste.paste_id,
+                'file',
+                file_size,
+                'image/png',
+            )
+            self.assertEqual(num_files, len(os.listdir('{attachments_dir}/{paste_dir}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                paste_dir=paste_dir,
+            ))))
+
+        # The attachment size limit takes precedence
+        config.MAX_ATTACHMENT_SIZE = 10.0 / (1000 * 1000)  # 10 B
+        self.assertRaises(
+            AttachmentTooLargeException,
+            database.upload_session.create_upload_session,
+            paste.paste_id,
+            'file',
+            11,
+            'image/png',
+        )
+
+    def test_upload_out_of_order(self):
+        paste = util.testing.PasteFactory.generate()
+        data = os.urandom(25)
+        upload_session = database.upload_session.create_upload_session(paste.paste_id, 'file', len(data), 'image/png')
+
+        self._upload_chunks(upload_session, data, [2, 0])
+        self.assertEqual([0, 2], database.upload_session.get_received_chunks(upload_session))
+        self.assertRaises(
+            IncompleteUploadException,
+            database.upload_session.finalize_upload_session,
+            upload_session,
+        )
+
+        # Retried chunks replace the previously received data
+        database.upload_session.write_upload_chunk(upload_session, 1, StringIO.StringIO('x' * 10))
+        self._upload_chunks(upload_session, data, [1])
+        self.assertEqual([0, 1, 2], database.upload_session.get_received_chunks(upload_session))
+
+        attachment = database.upload_session.finalize_upload_session(upload_session)
+        self.assertEqual('file', attachment.file_name)
+        self.assertEqual(25, attachment.file_size)
+        self.assertEqual('image/png', attachment.mime_type)
+        self.assertTrue(attachment.is_raw)
+        self.assertEqual(attachment, database.attachment.get_attachment_by_name(paste.paste_id, 'file'))
+        with open('{attachments_dir}/{relative_file_path}'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+            relative_file_path=database.attachment.get_attachment_file_path(attachment),
+        ), 'rb') as attachment_file:
+            self.assertEqual(data, attachment_file.read())
+
+        # The upload session is removed once it is finalized
+        self.assertRaises(
+            UploadSessionDoesNotExistException,
+            database.upload_session.get_upload_session,
+            upload_session.upload_token,
+        )
+        # The partial file is moved into the blob store
+        self.assertEqual(
+            [],
+            os.listdir('{attachments_dir}/{paste_dir}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                paste_dir=database.attachment.get_paste_attachment_dir(paste.paste_id),
+            )),
+        )
+        self.assertEqual(hashlib.sha256(data).hexdigest(), attachment.blob_digest)
+
+    def test_upload_empty_file(self):
+        paste = util.testing.PasteFactory.generate()
+        upload_session = database.upload_session.create_upload_session(paste.paste_id, 'file', 0, 'text/plain')
+        self.assertEqual(1, upload_session.num_chunks)
+        database.upload_session.write_upload_chunk(upload_session, 0, StringIO.StringIO(''))
+        self.assertEqual(0, database.upload_session.finalize_upload_session(upload_session).file_size)
+
+    def test_write_upload_chunk_invalid(self):
+        paste = util.testing.PasteFactory.generate()
+        upload_session = database.upload_session.create_upload_session(paste.paste_id, 'file', 25, 'image/png')
+        for chunk_index, chunk in [
+            (-1, 'x' * 10),
+            (3, 'x' * 10),
+            # Too short
+            (0, 'x' * 9),
+            # Too long
+            (0, 'x' * 11),
+            (2, 'x' * 10),
+        ]:
+            self.assertRaises(
+                InvalidUploadChunkException,
+                database.upload_session.write_upload_chunk,
+                upload_session,
+                chunk_index,
+                StringIO.StringIO(chunk),
+            )
+        self.assertEqual([], database.upload_session.get_received_chunks(upload_session))
+
+    def test_scrub_abandoned_upload_sessions(self):
+        # The paste must not expire before the upload sessions are abandoned
+        paste = util.testing.PasteFactory.generate(expiry_time=None)
+        abandoned_upload_session = database.upload_session.create_upload_session(paste.paste_id, 'file', 25, 'image/png')
+        self._upload_chunks(abandoned_upload_session, 'x' * 25, [0])
+
+        with mock.patch.object(time, 'time', return_value=time.time() + config.UPLOAD_SESSION_MAX_IDLE_TIME + 10):
+            active_upload_session = database.upload_session.create_upload_session(paste.paste_id, 'file 2', 25, 'image/png')
+            self.assertEqual(1, database.upload_session.scrub_abandoned_upload_sessions())
+
+        self.assertRaises(
+            UploadSessionDoesNotExistException,
+            database.upload_session.get_upload_session,
+            abandoned_upload_session.upload_token,
+        )
+        self.assertEqual(active_upload_session, database.upload_session.get_upload_session(active_upload_session.upload_token))
+        self.assertEqual(
+            ['upload-{upload_token}'.format(upload_token=active_upload_session.upload_token)],
+            os.listdir('{attachments_dir}/{paste_dir}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                paste_dir=database.attachment.get_paste_attachment_dir(paste.paste_id),
+            )),
+        )
@@ -1,9 +1,13 @@
+import base64
+
 from util.exception import *
 
+import config
 import util.testing
 import util.cryptography
 import database.user
 import database.paste
+from modern_paste import db
 
 
 class TestUser(util.testing.DatabaseTestCase):
@@ -41,7 +45,7 @@ class TestUser(util.testing.DatabaseTestCase):
         new_user = database.user.get_user_by_id(user.user_id)
         self.assertEqual('new_name', new_user.name)
         self.assertEqual('new@email.com', new_user.email)
-        self.assertEqual(util.cryptography.secure_hash('new_password'), new_user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('new_password', new_user.password_hash))
 
     def test_remove_user_details(self):
         user = util.testing.UserFactory.generate(name='old_name', email='old@email.com', password='old_password')
@@ -49,7 +53,7 @@ class TestUser(util.testing.DatabaseTestCase):
         new_user = database.user.get_user_by_id(user.user_id)
         self.assertIsNone(new_user.name)
         self.assertIsNone(new_user.email)
-        self.assertEqual(util.cryptography.secure_hash('old_password'), new_user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('old_password', new_user.password_hash))
 
     def test_get_user_by_id(self):
         self.assertRaises(
@@ -60,7 +64,7 @@ class TestUser(util.testing.DatabaseTestCase):
         database.user.create_new_user('username', 'password', '127.0.0.1', 'name', 'test@test.com')
         user = database.user.get_user_by_id(1)
         self.assertEqual('username', user.username)
-        self.assertEqual(util.cryptography.secure_hash('password'), user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('password', user.password_hash))
         self.assertEqual('127.0.0.1', user.signup_ip)
         self.assertEqual('name', user.name)
         self.assertEqual('test@test.com', user.email)
@@ -75,6 +79,15 @@ class TestUser(util.testing.DatabaseTestCase):
             active_only=True,
         )
 
+    def test_get_user_attachment_totals(self):
+        self.assertRaises(UserDoesNotExistException, database.user.get_user_attachment_totals, -1)
+        user = util.testing.UserFactory.generate()
+        self.assertEqual((0, 0), database.user.get_user_attachment_totals(user.user_id))
+        paste = util.testing.PasteFactory.generate(user_id=user.user_id)
+        util.testing.AttachmentFactory.generate(paste_id=paste.paste_id, file_data=base64.b64encode('x' * 100))
+        # The user's row already in the session is not updated with the totals
+        self.assertEqual((100, 1), database.user.get_user_attachment_totals(user.user_id))
+
     def test_get_user_by_username(self):
         self.assertRaises(
             UserDoesNotExistException,
@@ -84,7 +97,7 @@ class TestUser(util.testing.DatabaseTestCase):
         database.user.create_new_user('username', 'password', '127.0.0.1', 'name', 'test@test.com')
         user = database.user.get_user_by_username('username')
         self.assertEqual('username', user.username)
-        self.assertEqual(util.cryptography.secure_hash('password'), user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('password', user.password_hash))
         self.assertEqual('127.0.0.1', user.signup_ip)
         self.assertEqual('name', user.name)
         self.assertEqual('test@test.com', user.email)
@@ -109,7 +122,7 @@ class TestUser(util.testing.DatabaseTestCase):
         generated_user = database.user.create_new_user('username', 'password', '127.0.0.1', 'name', 'test@test.com')
         user = database.user.get_user_by_api_key(generated_user.api_key)
         self.assertEqual('username', user.username)
-        self.assertEqual(util.cryptography.secure_hash('password'), user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('password', user.password_hash))
         self.assertEqual('127.0.0.1', user.signup_ip)
         self.assertEqual('name', user.name)
         self.assertEqual('test@test.com', user.email)
@@ -144,6 +157,28 @@ class TestUser(util.testing.DatabaseTestCase):
         self.assertTrue(database.user.authenticate_user('userNAME', 'password'))
         self.assertTrue(database.user.authenticate_user('uSeRnAME', 'password'))
 
+    def test_authenticate_user_rehash(self):
+        user = util.testing.UserFactory.generate(username='username', password='password')
+        current_password_hash = user.password_hash
+        self.assertTrue(database.user.authenticate_user('username', 'password'))
+        # Hashes made with the configured parameters are kept as they are
+        self.assertEqual(current_password_hash, database.user.get_user_by_id(user.user_id).password_hash)
+
+        # Legacy hashes are upgraded on a successful login only
+        user.password_hash = util.cryptography.secure_hash('password')
+        db.session.commit()
+        self.assertFalse(database.user.authenticate_user('username', 'wrong password'))
+        self.assertEqual(util.cryptography.secure_hash('password'), database.user.get_user_by_id(user.user_id).password_hash)
+        self.assertTrue(database.user.authenticate_user('username', 'password'))
+        password_hash = database.user.get_user_by_id(user.user_id).password_hash
+        self.assertTrue(password_hash.startswith('pbkdf2_sha256$1000$'))
+        self.assertTrue(database.user.authenticate_user('username', 'password'))
+
+        # As are hashes made with fewer iterations than configured
+        config.PASSWORD_HASH_ITERATIONS = 2000
+        self.assertTrue(database.user.authenticate_user('username', 'password'))
+        self.assertTrue(database.user.get_user_by_id(user.user_id).password_hash.startswith('pbkdf2_sha256$2000$'))
+
     def test_authenticate_inactive_user(self):
         user = util.testing.UserFactory.generate(username='username', password='password')
         database.user.deactivate_user(user.user_id)
@@ -181,7 +216,7 @@ class TestUser(util.testing.DatabaseTestCase):
         database.user.create_new_user('username', 'password', '127.0.0.1', 'name', 'test@test.com')
         user = database.user.load_user(1)
         self.assertEqual('username', user.username)
-        self.assertEqual(util.cryptography.secure_hash('password'), user.password_hash)
+        self.assertTrue(util.cryptography.verify_password('password', user.password_hash))
         self.assertEqual('127.0.0.1', user.signup_ip)
         self.assertEqual('name', user.name)
         self.assertEqual('test@test.com', user.email)
@@ -0,0 +1,134 @@
+import os
+import tempfile
+
+import mock
+from sqlalchemy.exc import SQLAlchemyError
+
+import config
+import database.paste
+import database.view_buffer
+import util.testing
+from modern_paste import db
+
+
+class TestViewBuffer(util.testing.DatabaseTestCase):
+    def setUp(self):
+        super(TestViewBuffer, self).setUp()
+        self.spill_file = tempfile.mktemp()
+        self.buffer = database.view_buffer.ViewCountBuffer(
+            flush_interval=3600,
+            max_buffered_delta=100,
+            spill_file=self.spill_file,
+        )
+        # Keep the background flusher out of the way; flushes are triggered explicitly in these tests
+        self.buffer._ensure_started = mock.Mock()
+
+    def tearDown(self):
+        for path in [self.spill_file, '{spill_file}.{pid}'.format(spill_file=self.spill_file, pid=os.getpid())]:
+            if os.path.exists(path):
+                os.remove(path)
+        super(TestViewBuffer, self).tearDown()
+
+    def test_increment(self):
+        self.assertEqual(1, self.buffer.increment(1))
+        self.assertEqual(2, self.buffer.increment(1))
+        self.assertEqual(5, self.buffer.increment(2, delta=5))
+        self.assertEqual(2, self.buffer.pending_views(1))
+        self.assertEqual(5, self.buffer.pending_views(2))
+        self.assertEqual(0, self.buffer.pending_views(3))
+        self.assertEqual(2, self.buffer.stats()['buffered_pastes'])
+        self.assertEqual(7, self.buffer.stats()['buffered_views'])
+
+    def test_increment_triggers_flush(self):
+        self.buffer.increment(1, delta=99)
+        self.assertFalse(self.buffer._wakeup.is_set())
+        self.buffer.increment(1)
+        self.assertTrue(self.buffer._wakeup.is_set())
+
+    def test_flush(self):
+        pastes = [util.testing.PasteFactory.generate() for _ in range(3)]
+        self.buffer.increment(pastes[0].paste_id, delta=3)
+        self.buffer.increment(pastes[1].paste_id, delta=3)
+        self.buffer.increment(pastes[2].paste_id, delta=10)
+
+        self.assertEqual(16, self.buffer.flush())
+        db.session.expire_all()
+        self.assertEqual(3, database.paste.get_paste_by_id(pastes[0].paste_id).views)
+        self.assertEqual(3, database.paste.get_paste_by_id(pastes[1].paste_id).views)
+        self.assertEqual(10, database.paste.get_paste_by_id(pastes[2].paste_id).views)
+
+        stats = self.buffer.stats()
+        self.assertEqual(0, stats['buffered_pastes'])
+        self.assertEqual(0, stats['buffered_views'])
+        self.assertEqual(1, stats['flush_count'])
+        self.assertEqual(16, stats['flushed_views'])
+        self.assertGreaterEqual(stats['max_flush_latency'], stats['last_flush_latency'])
+
+        # Nothing left to flush
+        self.assertEqual(0, self.buffer.flush())
+        self.assertEqual(1, self.buffer.stats()['flush_count'])
+
+    def test_flush_failure(self):
+        self.buffer.increment(1, delta=4)
+        with mock.patch.object(database.view_buffer, 'db') as mock_db:
+            mock_db.engine.begin.side_effect = SQLAlchemyError
+            self.assertRaises(SQLAlchemyError, self.buffer.flush)
+        # Deltas should be retained for the next flush
+        self.assertEqual(4, self.buffer.pending_views(1))
+        self.assertEqual(1, self.buffer.stats()['failed_flush_count'])
+
+    def test_drain(self):
+        paste = util.testing.PasteFactory.generate()
+        self.buffer.increment(paste.paste_id, delta=7)
+        self.buffer.drain()
+        db.session.expire_all()
+        self.assertEqual(7, database.paste.get_paste_by_id(paste.paste_id).views)
+        self.assertFalse(os.path.exists(self.spill_file))
+
+    def test_drain_spills_on_failure(self):
+        self.buffer.increment(1, delta=4)
+        self.buffer.increment(2, delta=1)
+        with mock.patch.object(database.view_buffer, 'db') as mock_db:
+            mock_db.engine.begin.side_effect = SQLAlchemyError
+            self.buffer.drain()
+        self.assertEqual(0, self.buffer.stats()['buffered_views'])
+        self.assertEqual(5, self.buffer.stats()['spilled_views'])
+        with open(self.spill_file) as spill_file:
+            self.assertEqual(['1 4', '2 1'], sorted(spill_file.read().splitlines()))
+
+    def test_spill_disabled(self):
+        self.buffer.spill_file = None
+        self.buffer.increment(1)
+        self.assertEqual(0, self.buffer.spill())
+        self.assertEqual(0, self.buffer.replay_spill_file())
+
+    def test_replay_spill_file(self):
+        with open(self.spill_file, 'w') as spill_file:
+            spill_file.write('1 4\n2 1\n1 2\n3')
+        self.assertEqual(7, self.buffer.replay_spill_file())
+        self.assertEqual(6, self.buffer.pending_views(1))
+        self.assertEqual(1, self.buffer.pending_views(2))
+        self.assertEqual(0, self.buffer.pending_views(3))
+        self.assertFalse(os.path.exists(self.spill_file))
+
+        # The spill file has already been consumed
+        self.assertEqual(0, self.buffer.replay_spill_file())
+
+    def test_increment_paste_views_buffered(self):
+        config.ENABLE_VIEW_COUNT_BUFFER = True
+        paste = util.testing.PasteFactory.generate()
+        with mock.patch.object(database.view_buffer, 'get_view_count_buffer', return_value=self.buffer):
+            for _ in range(5):
+                self.assertEqual(paste, database.paste.increment_paste_views(paste.paste_id))
+            self.assertEqual(5, paste.views)
+            self.assertEqual(5, self.buffer.pending_views(paste.paste_id))
+
+            # The view count should not have been written yet
+            db.session.commit()
+            db.session.expire_all()
+            self.assertEqual(0, database.paste.get_paste_by_id(paste.paste_id).views)
+
+            database.view_buffer.flush_buffered_views()
+            db.session.commit()
+            db.session.expire_all()
+            self.assertEqual(5, database.paste.get_paste_by_id(paste.paste_id).views)
@@ -1,5 +1,9 @@
+import base64
 import unittest
 
+import mock
+from Crypto.Cipher import AES
+
 import config
 import util.cryptography
 from util.exception import *
@@ -68,6 +72,143 @@ class TestCryptography(unittest.TestCase):
         self.assertEqual(decid, util.cryptography.get_id_repr(decid))
         self.assertEqual(decid, util.cryptography.get_id_repr(encid))
 
+    def test_id_codec(self):
+        codec = util.cryptography.IdCodec(config.ID_ENCRYPTION_KEY, config.ID_ENCRYPTION_IV, cache_size=100)
+        # IDs are encrypted exactly as with a CBC cipher object, including IDs spanning several blocks
+        for decid in [1, 15, 123456789012345, 10 ** 17]:
+            cipher = AES.new(config.ID_ENCRYPTION_KEY, AES.MODE_CBC, config.ID_ENCRYPTION_IV)
+            expected_encid = base64.b64encode(
+                cipher.encrypt(util.cryptography._pad(str(decid))),
+                util.cryptography.ALTCHARS,
+            ).rstrip('=')
+            self.assertEqual(expected_encid, codec.encode(decid))
+            self.assertEqual(decid, codec.decode(expected_encid))
+            self.assertEqual(decid, util.cryptography.IdCodec(config.ID_ENCRYPTION_KEY, config.ID_ENCRYPTION_IV).decode(
+                expected_encid,
+            ))
+
+        self.assertRaises(InvalidIDException, codec.encode, 'not an ID')
+        for encid in ['', 'invalid', 'a' * 23, codec.encode(1)[:-2]]:
+            self.assertRaises(InvalidIDException, codec.decode, encid)
+
+        self.assertEqual([codec.encode(1), codec.encode(2)], codec.encode_many([1, '2']))
+        self.assertEqual([1, 2, 1], codec.decode_many([codec.encode(1), codec.encode(2), codec.encode(1)]))
+        self.assertRaises(InvalidIDException, codec.decode_many, [codec.encode(1), 'invalid'])
+
+    def test_id_codec_cache(self):
+        codec = util.cryptography.IdCodec(config.ID_ENCRYPTION_KEY, config.ID_ENCRYPTION_IV, cache_size=2)
+        encids = codec.encode_many([1, 2])
+        with mock.patch.object(codec, '_encrypt') as mock_encrypt, mock.patch.object(codec, '_decrypt') as mock_decrypt:
+            self.assertEqual(encids, codec.encode_many([1, 2]))
+            # Encrypted IDs are also remembered for decryption
+            self.assertEqual([1, 2], codec.decode_many(encids))
+            self.assertEqual(0, mock_encrypt.call_count)
+            self.assertEqual(0, mock_decrypt.call_count)
+
+        # The least recently used ID is evicted
+        codec.encode(1)
+        codec.encode(3)
+        with mock.patch.object(codec, '_encrypt', wraps=codec._encrypt) as mock_encrypt:
+            codec.encode(1)
+            self.assertEqual(0, mock_encrypt.call_count)
+            codec.encode(2)
+            self.assertEqual(1, mock_encrypt.call_count)
+
+        codec = util.cryptography.IdCodec(config.ID_ENCRYPTION_KEY, config.ID_ENCRYPTION_IV, cache_size=0)
+        codec.encode(1)
+        with mock.patch.object(codec, '_encrypt', wraps=codec._encrypt) as mock_encrypt:
+            codec.encode(1)
+            self.assertEqual(1, mock_encrypt.call_count)
+
+    def test_get_id_codec(self):
+        codec = util.cryptography.get_id_codec()
+        self.assertIs(codec, util.cryptography.get_id_codec())
+        id_cache_size = config.ID_CACHE_SIZE
+        config.ID_CACHE_SIZE = id_cache_size + 1
+        try:
+            self.assertIsNot(codec, util.cryptography.get_id_codec())
+            self.assertEqual(id_cache_size + 1, util.cryptography.get_id_codec().cache_size)
+        finally:
+            config.ID_CACHE_SIZE = id_cache_size
+
+    def test_get_id_reprs(self):
+        config.USE_ENCRYPTED_IDS = True
+        self.assertEqual(
+            [util.cryptography.get_id_repr(1), util.cryptography.get_id_repr(2)],
+            util.cryptography.get_id_reprs([1, 2]),
+        )
+        encid = util.cryptography.get_encid(3)
+        self.assertEqual([util.cryptography.get_encid(1), encid], util.cryptography.get_id_reprs([1, encid]))
+
+        config.USE_ENCRYPTED_IDS = False
+        self.assertEqual([1, 2], util.cryptography.get_id_reprs([1, 2]))
+        self.assertEqual([], util.cryptography.get_id_reprs([]))
+
+    def test_short_id_codec(self):
+        codec = util.cryptography.ShortIdCodec(config.ID_ENCRYPTION_KEY)
+        short_ids = [codec.encode(decid) for decid in range(1, 1001)]
+        self.assertEqual(1000, len(set(short_ids)))
+        for decid, short_id in enumerate(short_ids, 1):
+            self.assertEqual(6, len(short_id))
+            self.assertTrue(util.cryptography.is_short_id(short_id))
+            self.assertEqual(decid, codec.decode(short_id))
+        # Consecutive IDs do not have consecutive short IDs
+        self.assertNotEqual(sorted(short_ids), short_ids)
+        other_codec = util.cryptography.ShortIdCodec('other key')
+        self.assertNotEqual(short_ids, [other_codec.encode(decid) for decid in range(1, 1001)])
+
+        # Larger IDs take longer short IDs
+        for decid, length in [(62 ** 6 - 1, 6), (62 ** 6, 8), (62 ** 8 - 1, 8), (62 ** 8, 11), (62 ** 11 - 1, 11)]:
+            self.assertEqual(length, len(codec.encode(decid)))
+            self.assertEqual(decid, codec.decode(codec.encode(decid)))
+        for decid in [-1, 62 ** 11, 'not an ID']:
+            self.assertRaises(InvalidIDException, codec.encode, decid)
+
+        # Every string of the form of a short ID is the short ID of exactly one ID
+        for short_id in ['000000', 'zzzzzz', 'a1B2c3']:
+            self.assertEqual(short_id, codec.encode(codec.decode(short_id)))
+        # Except longer strings that would stand for IDs with a shorter short ID
+        self.assertRaises(InvalidIDException, codec.decode, codec._to_base62(codec._permute(15, 8), 8))
+        for short_id in ['', 'abcde', 'abcdefg', 'abc-ef', 'abc~ef', u'abcd\xe9f', 15, codec.encode(1) + '=']:
+            self.assertRaises(InvalidIDException, codec.decode, short_id)
+
+    def test_get_short_id_codec(self):
+        codec = util.cryptography.get_short_id_codec()
+        self.assertIs(codec, util.cryptography.get_short_id_codec())
+        id_encryption_key = config.ID_ENCRYPTION_KEY
+        config.ID_ENCRYPTION_KEY = 'other key'
+        try:
+            self.assertIsNot(codec, util.cryptography.get_short_id_codec())
+            self.assertNotEqual(codec.encode(15), util.cryptography.get_short_id(15))
+        finally:
+            config.ID_ENCRYPTION_KEY = id_encryption_key
+
+    def test_short_ids(self):
+        decid = 25
+        short_id = util.cryptography.get_short_id(decid)
+        encid = util.cryptography.get_encid(decid)
+
+        config.USE_SHORT_IDS = True
+        self.assertEqual(short_id, util.cryptography.get_id_repr(decid))
+        self.assertEqual(short_id, util.cryptography.get_id_repr(short_id))
+        self.assertEqual([short_id, short_id], util.cryptography.get_id_reprs([decid, short_id]))
+        self.assertEqual(decid, util.cryptography.get_decid(short_id))
+        # Links with encrypted IDs keep working, but links with decrypted IDs do not
+        self.assertEqual(decid, util.cryptography.get_decid(encid))
+        self.assertRaises(InvalidIDException, util.cryptography.get_decid, decid)
+        self.assertRaises(InvalidIDException, util.cryptography.get_decid, 'invalid')
+
+        # Short IDs take precedence over encrypted IDs
+        config.USE_ENCRYPTED_IDS = True
+        self.assertEqual(short_id, util.cryptography.get_id_repr(decid))
+        config.USE_SHORT_IDS = False
+        self.assertEqual(encid, util.cryptography.get_id_repr(decid))
+        self.assertEqual(decid, util.cryptography.get_decid(short_id))
+
+        config.USE_ENCRYPTED_IDS = False
+        self.assertEqual(decid, util.cryptography.get_id_repr(short_id))
+        self.assertRaises(InvalidIDException, util.cryptography.get_decid, short_id)
+
     def test_secure_hash(self):
         # Given the same number of iterations (10000), this result should always be the same
         self.assertEqual(
@@ -79,3 +220,42 @@ class TestCryptography(unittest.TestCase):
             'd5579c46dfcc7f18207013e65b44e4cb4e2c2298f4ac457ba8f82743f31e930b',
             util.cryptography.secure_hash('test string'),
         )
+
+    def test_hash_password(self):
+        password_hash = util.cryptography.hash_password('password', iterations=1000)
+        algorithm, iterations, salt, _ = password_hash.split('$')
+        self.assertEqual('pbkdf2_sha256', algorithm)
+        self.assertEqual('1000', iterations)
+        # Each hash has its own salt
+        self.assertNotEqual(password_hash, util.cryptography.hash_password('password', iterations=1000))
+
+        self.assertTrue(util.cryptography.verify_password('password', password_hash))
+        self.assertTrue(util.cryptography.verify_password(u'password', unicode(password_hash)))
+        self.assertFalse(util.cryptography.verify_password('wrong password', password_hash))
+        self.assertFalse(util.cryptography.verify_password(None, password_hash))
+        self.assertFalse(util.cryptography.verify_password('password', None))
+        self.assertFalse(util.cryptography.verify_password('password', 'bcrypt$1000$salt$hash'))
+        self.assertFalse(util.cryptography.verify_password('password', 'pbkdf2_sha256$many$salt$hash'))
+
+        unicode_password_hash = util.cryptography.hash_password(u'p\xe4ssword', iterations=1000)
+        self.assertTrue(util.cryptography.verify_password(u'p\xe4ssword', unicode_password_hash))
+
+    def test_verify_legacy_password(self):
+        self.assertTrue(util.cryptography.verify_password('test string', util.cryptography.secure_hash('test string')))
+        self.assertFalse(util.cryptography.verify_password('other string', util.cryptography.secure_hash('test string')))
+
+    def test_password_needs_rehash(self):
+        config.PASSWORD_HASH_ITERATIONS = 1000
+        self.assertFalse(util.cryptography.password_needs_rehash(util.cryptography.hash_password('password')))
+        self.assertTrue(util.cryptography.password_needs_rehash(util.cryptography.secure_hash('password')))
+        self.assertTrue(util.cryptography.password_needs_rehash(
+            util.cryptography.hash_password('password', iterations=500),
+        ))
+
+    def test_hash_file_name(self):
+        self.assertEqual(
+            '3c1cd05a9cfbb14946eb8c6716ac876699084aa69d30384151b214bb02f9ed01',
+            util.cryptography.hash_file_name('file_name'),
+        )
+        self.assertEqual(util.cryptography.hash_file_name('file_name'), util.cryptography.hash_file_name(u'file_name'))
+        self.assertNotEqual(util.cryptography.secure_hash('file_name'), util.cryptography.hash_file_name('file_name'))
@@ -0,0 +1,201 @@
+import os
+import tempfile
+import unittest
+
+from werkzeug.http import http_date
+
+import util.file_response
+from modern_paste import app
+
+
+class TestFileResponse(unittest.TestCase):
+    def setUp(self):
+        file_descriptor, self.file_path = tempfile.mkstemp()
+        with os.fdopen(file_descriptor, 'wb') as test_file:
+            test_file.write('0123456789')
+        os.utime(self.file_path, (1453355837, 1453355837))
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    def _get(self, headers=None, etag='digest', offset=0, length=None, last_modified=None):
+        with app.test_request_context(headers=headers or {}):
+            resp = util.file_response.make_file_response(
+                self.file_path,
+                'text/plain',
+                etag=etag,
+                offset=offset,
+                length=length,
+                last_modified=last_modified,
+            )
+            resp.direct_passthrough = False
+            data = resp.get_data()
+            resp.close()
+            return resp, data
+
+    def test_parse_range_header(self):
+        for range_header, expected_ranges in [
+            (None, None),
+            ('bytes=0-4', [(0, 4)]),
+            ('bytes=5-', [(5, 9)]),
+            ('bytes=-3', [(7, 9)]),
+            ('bytes=-30', [(0, 9)]),
+            ('bytes=8-30', [(8, 9)]),
+            ('bytes=0-1, 6-7', [(0, 1), (6, 7)]),
+            # Overlapping and adjacent ranges are merged
+            ('bytes=6-7,0-2,1-3,4-4', [(0, 4), (6, 7)]),
+            # Unsatisfiable
+            ('bytes=10-', []),
+            ('bytes=-0', []),
+            # Malformed
+            ('bytes=4-2', None),
+            ('bytes=a-b', None),
+            ('bytes=1', None),
+            ('lines=0-4', None),
+            ('bytes=' + ','.join(['0-0'] * (util.file_response.MAX_RANGES + 1)), None),
+        ]:
+            self.assertEqual(expected_ranges, util.file_response.parse_range_header(range_header, 10))
+        self.assertEqual([], util.file_response.parse_range_header('bytes=-5', 0))
+
+    def test_entire_file(self):
+        resp, data = self._get()
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('0123456789', data)
+        self.assertEqual('text/plain', resp.mimetype)
+        self.assertEqual('bytes', resp.headers['Accept-Ranges'])
+        self.assertEqual('10', resp.headers['Content-Length'])
+        self.assertEqual('"digest"', resp.headers['ETag'])
+        self.assertEqual(http_date(1453355837), resp.headers['Last-Modified'])
+
+        resp, _ = self._get(etag=None)
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_single_range(self):
+        resp, data = self._get({'Range': 'bytes=2-5'})
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual('2345', data)
+        self.assertEqual('text/plain', resp.mimetype)
+        self.assertEqual('4', resp.headers['Content-Length'])
+        self.assertEqual('bytes 2-5/10', resp.headers['Content-Range'])
+
+        resp, data = self._get({'Range': 'bytes=-2'})
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual('89', data)
+
+    def test_multiple_ranges(self):
+        resp, data = self._get({'Range': 'bytes=0-1,7-'})
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual('multipart/byteranges', resp.mimetype)
+        boundary = resp.mimetype_params['boundary']
+        self.assertEqual(
+            '\r\n--{boundary}\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-1/10\r\n\r\n01'
+            '\r\n--{boundary}\r\nContent-Type: text/plain\r\nContent-Range: bytes 7-9/10\r\n\r\n789'
+            '\r\n--{boundary}--\r\n'.format(boundary=boundary),
+            data,
+        )
+        self.assertEqual(str(len(data)), resp.headers['Content-Length'])
+
+    def test_unsatisfiable_range(self):
+        resp, data = self._get({'Range': 'bytes=20-30'})
+        self.assertEqual(416, resp.status_code)
+        self.assertEqual('', data)
+        self.assertEqual('bytes */10', resp.headers['Content-Range'])
+
+    def test_not_modified(self):
+        for headers in [
+            {'If-None-Match': '"digest"'},
+            {'If-None-Match': '"other", W/"digest"'},
+            {'If-None-Match': '*'},
+            {'If-Modified-Since': http_date(1453355837)},
+            {'If-Modified-Since': http_date(1453355837 + 10), 'Range': 'bytes=0-1'},
+        ]:
+            resp, data = self._get(headers)
+            self.assertEqual(304, resp.status_code)
+            self.assertEqual('', data)
+            self.assertEqual('"digest"', resp.headers['ETag'])
+
+        for headers in [
+            {'If-None-Match': '"other"'},
+            {'If-Modified-Since': http_date(1453355837 - 10)},
+            # If-None-Match takes precedence over If-Modified-Since
+            {'If-None-Match': '"other"', 'If-Modified-Since': http_date(1453355837)},
+        ]:
+            resp, data = self._get(headers)
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual('0123456789', data)
+
+    def test_if_range(self):
+        for if_range, expected_status_code, expected_data in [
+            ('"digest"', 206, '01'),
+            ('"other"', 200, '0123456789'),
+            (http_date(1453355837), 206, '01'),
+            (http_date(1453355837 - 10), 200, '0123456789'),
+        ]:
+            resp, data = self._get({'Range': 'bytes=0-1', 'If-Range': if_range})
+            self.assertEqual(expected_status_code, resp.status_code)
+            self.assertEqual(expected_data, data)
+
+    def test_file_region(self):
+        resp, data = self._get(offset=3, length=5)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('34567', data)
+        self.assertEqual('5', resp.headers['Content-Length'])
+
+        resp, data = self._get({'Range': 'bytes=1-2'}, offset=3, length=5)
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual('45', data)
+        self.assertEqual('bytes 1-2/5', resp.headers['Content-Range'])
+
+        resp, data = self._get({'Range': 'bytes=0-0,4-'}, offset=3, length=5)
+        self.assertEqual(206, resp.status_code)
+        self.assertIn('Content-Range: bytes 0-0/5\r\n\r\n3\r\n', data)
+        self.assertIn('Content-Range: bytes 4-4/5\r\n\r\n7\r\n', data)
+
+        resp, data = self._get({'Range': 'bytes=5-'}, offset=3, length=5)
+        self.assertEqual(416, resp.status_code)
+        self.assertEqual('bytes */5', resp.headers['Content-Range'])
+
+        resp, data = self._get(offset=3, length=0)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('', data)
+
+        # The modification time of the whole file does not validate a region of it
+        resp, data = self._get(offset=3, length=5)
+        self.assertNotIn('Last-Modified', resp.headers)
+        resp, data = self._get({'If-Modified-Since': http_date(1453355837)}, etag=None, offset=3, length=5)
+        self.assertEqual(200, resp.status_code)
+
+        # A modification time supplied for the region survives changes to the rest of the file
+        os.utime(self.file_path, (1453355900, 1453355900))
+        resp, data = self._get(offset=3, length=5, last_modified=1453355000)
+        self.assertEqual(http_date(1453355000), resp.headers['Last-Modified'])
+        resp, data = self._get({'If-Modified-Since': http_date(1453355000)}, etag=None, offset=3, length=5, last_modified=1453355000)
+        self.assertEqual(304, resp.status_code)
+        resp, data = self._get({'Range': 'bytes=1-2', 'If-Range': http_date(1453355000)}, etag=None, offset=3, length=5, last_modified=1453355000)
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual('45', data)
+
+    def test_data_response(self):
+        with app.test_request_context():
+            resp = util.file_response.make_data_response('0123456789', 'text/plain', etag='digest')
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual('0123456789', resp.get_data())
+            self.assertEqual('10', resp.headers['Content-Length'])
+            self.assertEqual('"digest"', resp.headers['ETag'])
+            self.assertNotIn('Last-Modified', resp.headers)
+
+        with app.test_request_context(headers={'Range': 'bytes=2-5'}):
+            resp = util.file_response.make_data_response('0123456789', 'text/plain', etag='digest')
+            resp.direct_passthrough = False
+            self.assertEqual(206, resp.status_code)
+            self.assertEqual('2345', resp.get_data())
+            self.assertEqual('bytes 2-5/10', resp.headers['Content-Range'])
+
+        with app.test_request_context(headers={'If-None-Match': '"digest"'}):
+            resp = util.file_response.make_data_response('0123456789', 'text/plain', etag='digest')
+            self.assertEqual(304, resp.status_code)
+
+        # Without a modification time, If-Modified-Since never matches
+        with app.test_request_context(headers={'If-Modified-Since': http_date(1453355837)}):
+            resp = util.file_response.make_data_response('0123456789', 'text/plain')
+            self.assertEqual(200, resp.status_code)
@@ -0,0 +1,44 @@
+import base64
+import unittest
+
+import config
+import util.pagination
+from util.exception import *
+
+
+class TestPagination(unittest.TestCase):
+    def tearDown(self):
+        config.USE_ENCRYPTED_IDS = False
+        config.USE_SHORT_IDS = False
+
+    def test_encode_decode_cursor(self):
+        for use_encrypted_ids, use_short_ids in [(False, False), (True, False), (False, True)]:
+            config.USE_ENCRYPTED_IDS = use_encrypted_ids
+            config.USE_SHORT_IDS = use_short_ids
+            cursor = util.pagination.encode_cursor(1453355837, 15)
+            self.assertNotIn('=', cursor)
+            self.assertNotIn('/', cursor)
+            self.assertEqual((1453355837, 15), util.pagination.decode_cursor(cursor))
+            self.assertEqual((0, 1), util.pagination.decode_cursor(util.pagination.encode_cursor(0, 1)))
+
+    def test_encode_cursor_encrypted_id(self):
+        config.USE_ENCRYPTED_IDS = True
+        cursor = util.pagination.encode_cursor(1453355837, 15)
+        self.assertNotIn(':15', base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+
+    def test_decode_cursor_invalid(self):
+        for cursor in ['', 'invalid', u'\ue863', 'MTIz', base64.urlsafe_b64encode('abc:1')]:
+            self.assertRaises(
+                InvalidCursorException,
+                util.pagination.decode_cursor,
+                cursor,
+            )
+
+        # A cursor generated with decrypted IDs is not valid when encrypted IDs are in use
+        cursor = util.pagination.encode_cursor(1453355837, 15)
+        config.USE_ENCRYPTED_IDS = True
+        self.assertRaises(
+            InvalidCursorException,
+            util.pagination.decode_cursor,
+            cursor,
+        )
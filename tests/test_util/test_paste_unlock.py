@@ -0,0 +1,70 @@
+import time
+
+import flask
+import mock
+
+import database.paste
+import util.cryptography
+import util.paste_unlock
+import util.testing
+from modern_paste import app
+
+
+class TestPasteUnlock(util.testing.DatabaseTestCase):
+    def test_unlock_token(self):
+        paste = util.testing.PasteFactory.generate(password='password')
+        token = util.paste_unlock.make_unlock_token(paste)
+        self.assertTrue(util.paste_unlock.verify_unlock_token(paste, token))
+        self.assertTrue(util.paste_unlock.verify_unlock_token(paste, unicode(token)))
+
+        # Tokens are specific to their paste
+        other_paste = util.testing.PasteFactory.generate(password='password')
+        self.assertFalse(util.paste_unlock.verify_unlock_token(other_paste, token))
+
+        # Tampered, malformed, and expired tokens are rejected
+        expiry_time, signature = token.split('.')
+        for invalid_token in [
+            None,
+            '',
+            'token',
+            '{expiry_time}.{signature}'.format(expiry_time=int(expiry_time) + 1, signature=signature),
+            '{expiry_time}.{signature}'.format(expiry_time=expiry_time, signature=signature[::-1]),
+            u'{expiry_time}.\xe9'.format(expiry_time=expiry_time),
+            util.paste_unlock.make_unlock_token(paste, expiry_time=int(time.time()) - 1),
+        ]:
+            self.assertFalse(util.paste_unlock.verify_unlock_token(paste, invalid_token))
+
+        # Changing the password invalidates existing tokens, even if the new password is the same
+        database.paste.set_paste_password(paste.paste_id, 'password')
+        self.assertFalse(util.paste_unlock.verify_unlock_token(paste, token))
+
+        # Pastes without a password cannot be unlocked
+        database.paste.set_paste_password(paste.paste_id, None)
+        self.assertFalse(util.paste_unlock.verify_unlock_token(paste, token))
+
+    def test_unlock_paste(self):
+        paste = util.testing.PasteFactory.generate(password='password')
+        with app.test_request_context():
+            self.assertIsNone(util.paste_unlock.unlock_paste(paste))
+            self.assertIsNone(util.paste_unlock.unlock_paste(paste, 'wrong password'))
+            token = util.paste_unlock.unlock_paste(paste, 'password')
+            self.assertTrue(util.paste_unlock.verify_unlock_token(paste, token))
+
+        for request_kwargs in [
+            {'headers': {util.paste_unlock.UNLOCK_TOKEN_HEADER: token}},
+            {'query_string': {util.paste_unlock.UNLOCK_TOKEN_PARAM: token}},
+            {'headers': {'Cookie': '{cookie}={token}'.format(cookie=util.paste_unlock.UNLOCK_TOKEN_COOKIE, token=token)}},
+        ]:
+            with app.test_request_context(**request_kwargs):
+                # The password is not hashed if the request carries a valid token
+                with mock.patch.object(util.cryptography, 'verify_password') as mock_verify_password:
+                    self.assertEqual(token, util.paste_unlock.unlock_paste(paste, 'wrong password'))
+                    self.assertEqual(0, mock_verify_password.call_count)
+
+    def test_set_unlock_cookie(self):
+        paste = util.testing.PasteFactory.generate(password='password')
+        resp = util.paste_unlock.set_unlock_cookie(flask.Response(), paste, 'token')
+        cookie = resp.headers['Set-Cookie']
+        self.assertIn('{cookie}=token'.format(cookie=util.paste_unlock.UNLOCK_TOKEN_COOKIE), cookie)
+        self.assertIn('Path=/paste/{paste_id}/'.format(paste_id=util.cryptography.get_id_repr(paste.paste_id)), cookie)
+        self.assertIn('HttpOnly', cookie)
@@ -0,0 +1,193 @@
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import moto
+
+import config
+import database.attachment
+import database.paste
+import database.scrubber
+import util.cryptography
+import util.storage
+import util.testing
+import views.paste
+
+
+class TestLocalStorageBackend(unittest.TestCase):
+    def setUp(self):
+        self.attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        config.ATTACHMENT_STORAGE_BACKEND = 'local'
+        self.storage_backend = util.storage.get_storage_backend()
+
+    def tearDown(self):
+        shutil.rmtree(config.ATTACHMENTS_DIR)
+        config.ATTACHMENTS_DIR = self.attachments_dir
+
+    def test_get_storage_backend(self):
+        self.assertIsInstance(self.storage_backend, util.storage.LocalStorageBackend)
+        self.assertIs(self.storage_backend, util.storage.get_storage_backend())
+
+        config.ATTACHMENT_STORAGE_BACKEND = 'nonexistent'
+        self.assertRaises(ValueError, util.storage.get_storage_backend)
+        config.ATTACHMENT_STORAGE_BACKEND = 'local'
+
+    def test_put(self):
+        self.assertFalse(self.storage_backend.exists('blobs/ab/digest'))
+        self.storage_backend.put('blobs/ab/digest', 'file contents')
+        self.assertTrue(self.storage_backend.exists('blobs/ab/digest'))
+        self.assertEqual(
+            '{attachments_dir}/blobs/ab/digest'.format(attachments_dir=config.ATTACHMENTS_DIR),
+            self.storage_backend.get_local_path('blobs/ab/digest'),
+        )
+        # No temporary files should be left behind
+        self.assertEqual(['digest'], os.listdir('{attachments_dir}/blobs/ab'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+        )))
+
+        stored_file = self.storage_backend.open('blobs/ab/digest')
+        self.assertEqual('file contents', stored_file.read())
+        stored_file.close()
+
+        self.storage_backend.delete('blobs/ab/digest')
+        self.assertFalse(self.storage_backend.exists('blobs/ab/digest'))
+        # Deleting a nonexistent file is not an error
+        self.storage_backend.delete('blobs/ab/digest')
+
+    def test_put_file(self):
+        file_descriptor, file_path = tempfile.mkstemp(dir=config.ATTACHMENTS_DIR)
+        with os.fdopen(file_descriptor, 'wb') as upload_file:
+            upload_file.write('file contents')
+
+        self.storage_backend.put_file('blobs/ab/digest', file_path)
+        self.assertFalse(os.path.exists(file_path))
+        with open(self.storage_backend.get_local_path('blobs/ab/digest'), 'rb') as stored_file:
+            self.assertEqual('file contents', stored_file.read())
+        self.assertEqual(0o644, os.stat(self.storage_backend.get_local_path('blobs/ab/digest')).st_mode & 0o777)
+
+
+class TestS3StorageBackend(util.testing.DatabaseTestCase):
+    def setUp(self):
+        super(TestS3StorageBackend, self).setUp()
+        # moto serves an in-process stand-in for S3, so no network access is needed
+        self.mock_s3 = moto.mock_s3()
+        self.mock_s3.start()
+
+        self.attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        config.ATTACHMENT_STORAGE_BACKEND = 's3'
+        config.ATTACHMENT_S3_BUCKET = 'attachments'
+        config.ATTACHMENT_S3_PREFIX = 'prefix/'
+        config.ATTACHMENT_S3_REGION = 'us-east-1'
+        config.ATTACHMENT_S3_ACCESS_KEY_ID = 'access key ID'
+        config.ATTACHMENT_S3_SECRET_ACCESS_KEY = 'secret access key'
+        config.ATTACHMENT_S3_MULTIPART_THRESHOLD = 5 * 1024 * 1024
+        config.ATTACHMENT_S3_MULTIPART_CHUNK_SIZE = 5 * 1024 * 1024
+        config.ATTACHMENT_S3_MAX_CONCURRENCY = 4
+
+        # Create a new client for each test, within the S3 stand-in
+        util.storage._storage_backend = None
+        self.storage_backend = util.storage.get_storage_backend()
+        self.storage_backend.client.create_bucket(Bucket='attachments')
+
+    def tearDown(self):
+        config.ATTACHMENT_STORAGE_BACKEND = 'local'
+        shutil.rmtree(config.ATTACHMENTS_DIR)
+        config.ATTACHMENTS_DIR = self.attachments_dir
+        self.mock_s3.stop()
+        super(TestS3StorageBackend, self).tearDown()
+
+    def _get_object(self, key):
+        return self.storage_backend.client.get_object(Bucket='attachments', Key=key)['Body'].read()
+
+    def _write_file(self, data):
+        file_descriptor, file_path = tempfile.mkstemp(dir=config.ATTACHMENTS_DIR)
+        with os.fdopen(file_descriptor, 'wb') as upload_file:
+            upload_file.write(data)
+        return file_path
+
+    def test_get_storage_backend(self):
+        self.assertIsInstance(self.storage_backend, util.storage.S3StorageBackend)
+        self.assertFalse(self.storage_backend.is_local)
+        self.assertIsNone(self.storage_backend.get_local_path('blobs/ab/digest'))
+
+    def test_put(self):
+        self.assertFalse(self.storage_backend.exists('blobs/ab/digest'))
+        self.storage_backend.put('blobs/ab/digest', 'file contents')
+        self.assertTrue(self.storage_backend.exists('blobs/ab/digest'))
+        self.assertEqual('file contents', self._get_object('prefix/blobs/ab/digest'))
+        self.assertEqual('file contents', self.storage_backend.open('blobs/ab/digest').read())
+
+        self.storage_backend.delete('blobs/ab/digest')
+        self.assertFalse(self.storage_backend.exists('blobs/ab/digest'))
+        self.storage_backend.delete('blobs/ab/digest')
+
+    def test_put_file(self):
+        file_path = self._write_file('file contents')
+        with mock.patch.object(self.storage_backend.client, 'create_multipart_upload') as mock_create_multipart_upload:
+            self.storage_backend.put_file('blobs/ab/digest', file_path)
+            self.assertEqual(0, mock_create_multipart_upload.call_count)
+        self.assertFalse(os.path.exists(file_path))
+        self.assertEqual('file contents', self._get_object('prefix/blobs/ab/digest'))
+
+    def test_put_file_multipart(self):
+        data = os.urandom(2 * config.ATTACHMENT_S3_MULTIPART_CHUNK_SIZE + 100)
+        file_path = self._write_file(data)
+        with mock.patch.object(
+            self.storage_backend.client,
+            'upload_part',
+            wraps=self.storage_backend.client.upload_part,
+        ) as mock_upload_part:
+            self.storage_backend.put_file('blobs/ab/digest', file_path)
+            self.assertEqual(3, mock_upload_part.call_count)
+            self.assertEqual(
+                [1, 2, 3],
+                sorted(call[1]['PartNumber'] for call in mock_upload_part.call_args_list),
+            )
+        self.assertFalse(os.path.exists(file_path))
+        self.assertEqual(data, self._get_object('prefix/blobs/ab/digest'))
+
+    def test_put_file_multipart_failure(self):
+        file_path = self._write_file(os.urandom(2 * config.ATTACHMENT_S3_MULTIPART_CHUNK_SIZE))
+        with mock.patch.object(self.storage_backend.client, 'upload_part', side_effect=IOError):
+            self.assertRaises(IOError, self.storage_backend.put_file, 'blobs/ab/digest', file_path)
+        # The failed upload is aborted, and the local file is kept for the caller to clean up
+        self.assertEqual(
+            [],
+            self.storage_backend.client.list_multipart_uploads(Bucket='attachments').get('Uploads', []),
+        )
+        self.assertFalse(self.storage_backend.exists('blobs/ab/digest'))
+        self.assertTrue(os.path.exists(file_path))
+
+    def test_attachment_lifecycle(self):
+        paste = util.testing.PasteFactory.generate()
+        attachment = database.attachment.create_new_attachment(
+            paste_id=paste.paste_id,
+            file_name='file name',
+            file_size=len('binary data'),
+            mime_type='text/plain',
+            file_data=base64.b64encode('binary data'),
+        )
+        key = database.attachment.get_blob_file_path(hashlib.sha256('binary data').hexdigest())
+        self.assertEqual(key, database.attachment.resolve_attachment_file_path(attachment))
+        self.assertEqual('binary data', self._get_object('prefix/' + key))
+        self.assertFalse(os.path.exists('{attachments_dir}/{key}'.format(
+            attachments_dir=config.ATTACHMENTS_DIR,
+            key=key,
+        )))
+
+        resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), 'file_name')
+        resp.direct_passthrough = False
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('binary data', resp.get_data())
+        self.assertEqual('"{digest}"'.format(digest=attachment.blob_digest), resp.headers['ETag'])
+        resp.close()
+
+        database.paste.deactivate_paste(paste.paste_id)
+        database.scrubber.Scrubber(chunk_size=10, chunk_interval=0).scrub_inactive_pastes()
+        self.assertFalse(self.storage_backend.exists(key))
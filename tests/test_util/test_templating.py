@@ -139,6 +139,12 @@ class TestTemplating(unittest.TestCase):
         self.assertEqual(decid, id_repr(decid))
         self.assertEqual(decid, id_repr(encid))
 
+        short_id = util.cryptography.get_short_id(decid)
+        config.USE_SHORT_IDS = True
+        self.assertEqual(short_id, id_repr(decid))
+        self.assertEqual(short_id, id_repr(short_id))
+        config.USE_SHORT_IDS = False
+
     def test_get_all_uris(self):
         uri = util.templating.get_uri_path()['uri']
         all_uris = util.templating.get_all_uris()['all_uris']()
@@ -0,0 +1,68 @@
+import StringIO
+import os
+import time
+import unittest
+import zipfile
+
+import util.zip_stream
+
+
+class TestZipStream(unittest.TestCase):
+    def _read_archive(self, entries, modified_time=1453355837):
+        return zipfile.ZipFile(StringIO.StringIO(''.join(util.zip_stream.iter_zip(entries, modified_time))))
+
+    def test_is_compressed_mime_type(self):
+        for mime_type in ['image/png', 'image/jpeg', 'video/mp4', 'audio/mpeg', 'application/zip', 'APPLICATION/PDF']:
+            self.assertTrue(util.zip_stream.is_compressed_mime_type(mime_type))
+        for mime_type in ['text/plain', 'text/html; charset=utf-8', 'image/svg+xml', 'image/bmp', 'application/json', None]:
+            self.assertFalse(util.zip_stream.is_compressed_mime_type(mime_type))
+
+    def test_iter_zip(self):
+        binary_data = os.urandom(100000)
+        archive = self._read_archive([
+            ('text.txt', 22, True, iter(['hello, world', '\n' * 10])),
+            ('image.png', len(binary_data), False, iter([binary_data[:1000], binary_data[1000:]])),
+            (u'caf\xe9.txt', None, True, iter([])),
+        ])
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(
+            ['text.txt', 'image.png', u'caf\xe9.txt'],
+            [info.filename for info in archive.infolist()],
+        )
+        self.assertEqual(
+            [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED],
+            [info.compress_type for info in archive.infolist()],
+        )
+        self.assertEqual('hello, world' + '\n' * 10, archive.read('text.txt'))
+        self.assertEqual(binary_data, archive.read('image.png'))
+        self.assertEqual('', archive.read(u'caf\xe9.txt'))
+        self.assertEqual(len(binary_data), archive.getinfo('image.png').compress_size)
+        self.assertEqual(0o100644, archive.getinfo('text.txt').external_attr >> 16)
+
+    def test_iter_zip_lazy(self):
+        consumed = []
+
+        def chunks(name):
+            consumed.append(name)
+            yield name
+
+        archive = util.zip_stream.iter_zip((name, None, False, chunks(name)) for name in ['a', 'b'])
+        next(archive)
+        # Only the first entry has been started
+        self.assertEqual([], consumed)
+        next(archive)
+        self.assertEqual(['a'], consumed)
+        list(archive)
+        self.assertEqual(['a', 'b'], consumed)
+
+    def test_iter_zip_empty(self):
+        archive = self._read_archive([])
+        self.assertEqual([], archive.infolist())
+
+    def test_dos_date_time(self):
+        info = self._read_archive([('file', 0, False, iter([]))]).getinfo('file')
+        local_time = time.localtime(1453355837)
+        self.assertEqual(tuple(local_time[:5]) + (local_time.tm_sec // 2 * 2,), info.date_time)
+        # Dates before 1980 cannot be represented
+        info = self._read_archive([('file', 0, False, iter([]))], modified_time=0).getinfo('file')
+        self.assertEqual((1980, 1, 1, 0, 0, 0), info.date_time)
@@ -1,15 +1,25 @@
 import StringIO
 import base64
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
 import time
+import zipfile
 
 import flask
 import mock
 
+import config
 import database.attachment
 import database.paste
+import database.view_buffer
 import util.cryptography
+import util.paste_unlock
 import util.testing
 import views.paste
+from modern_paste import db
 
 
 class TestPaste(util.testing.DatabaseTestCase):
@@ -45,6 +55,23 @@ class TestPaste(util.testing.DatabaseTestCase):
         # Ensure that the paste title is the window title
         self.assertIn('Test title - Modern Paste', views.paste.paste_view(util.cryptography.get_id_repr(paste.paste_id)))
 
+    def test_paste_view_buffered(self):
+        config.ENABLE_VIEW_COUNT_BUFFER = True
+        view_count_buffer = database.view_buffer.ViewCountBuffer(flush_interval=3600, max_buffered_delta=100)
+        view_count_buffer._ensure_started = mock.Mock()
+        with mock.patch.object(database.view_buffer, 'get_view_count_buffer', return_value=view_count_buffer):
+            paste = util.testing.PasteFactory.generate()
+            # Views still in the buffer count towards the view count, so only the first viewer sees the token
+            self.assertIn(paste.deactivation_token, views.paste.paste_view(util.cryptography.get_id_repr(paste.paste_id)))
+            self.assertNotIn(paste.deactivation_token, views.paste.paste_view(util.cryptography.get_id_repr(paste.paste_id)))
+            self.assertEqual(2, paste.views)
+
+            # Once flushed, the views are counted exactly once
+            view_count_buffer.flush()
+            db.session.commit()
+            self.assertNotIn(paste.deactivation_token, views.paste.paste_view(util.cryptography.get_id_repr(paste.paste_id)))
+            self.assertEqual(3, paste.views)
+
     def test_paste_view_raw(self):
         # Non-existent paste
         self.assertEqual('This paste either does not exist or has been deleted.', views.paste.paste_view_raw(-1).data)
@@ -65,7 +92,18 @@ class TestPaste(util.testing.DatabaseTestCase):
 
         # Password-protected, correct password supplied
         flask.request.args = {'password': 'password'}
+        resp = views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id))
+        self.assertEqual(paste.contents, resp.data)
+        self.assertIn(util.paste_unlock.UNLOCK_TOKEN_COOKIE, resp.headers['Set-Cookie'])
+
+        # Password-protected, unlock token supplied in place of the password
+        flask.request.args = {'unlock_token': util.paste_unlock.make_unlock_token(paste)}
         self.assertEqual(paste.contents, views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id)).data)
+        flask.request.args = {'unlock_token': 'invalid'}
+        self.assertIn(
+            'In order to view the raw contents of a password-protected paste',
+            views.paste.paste_view_raw(util.cryptography.get_id_repr(paste.paste_id)).data,
+        )
 
         # Deactivated paste
         database.paste.deactivate_paste(paste.paste_id)
@@ -75,6 +113,7 @@ class TestPaste(util.testing.DatabaseTestCase):
         )
 
     def test_paste_attachment(self):
+        attachments_dir = config.ATTACHMENTS_DIR
         paste = util.testing.PasteFactory.generate()
         attachment = util.testing.AttachmentFactory.generate(paste_id=paste.paste_id)
 
@@ -95,6 +134,56 @@ class TestPaste(util.testing.DatabaseTestCase):
         self.assertEqual(404, resp[1])
 
         # Valid input
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        try:
+            file_path = '{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(attachment),
+            )
+            os.makedirs(os.path.dirname(file_path))
+            with open(file_path, 'wb') as attachment_file:
+                attachment_file.write('file contents')
+
+            resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+            resp.direct_passthrough = False
+            self.assertEqual('file contents', resp.get_data())
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual('image/png', resp.mimetype)
+            self.assertEqual('"{digest}"'.format(digest=attachment.blob_digest), resp.headers['ETag'])
+            self.assertEqual('bytes', resp.headers['Accept-Ranges'])
+            resp.close()
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
+        # Offloaded to the web server
+        config.ATTACHMENT_SENDFILE_HEADER = 'X-Sendfile'
+        resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('', resp.get_data())
+        self.assertEqual(
+            '{attachments_dir}/{relative_file_path}'.format(
+                attachments_dir=config.ATTACHMENTS_DIR,
+                relative_file_path=database.attachment.get_attachment_file_path(attachment),
+            ),
+            resp.headers['X-Sendfile'],
+        )
+
+        config.ATTACHMENT_SENDFILE_HEADER = 'X-Accel-Redirect'
+        config.ATTACHMENT_ACCEL_REDIRECT_PREFIX = '/protected/'
+        resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('image/png', resp.mimetype)
+        self.assertEqual(
+            '/protected/{relative_file_path}'.format(
+                relative_file_path=database.attachment.get_attachment_file_path(attachment),
+            ),
+            resp.headers['X-Accel-Redirect'],
+        )
+        config.ATTACHMENT_SENDFILE_HEADER = None
+
+        # Legacy base64-encoded attachment file
+        attachment.is_raw = None
         with mock.patch('__builtin__.open') as mock_open:
             mock_file_obj = mock.Mock(spec=file, wraps=StringIO.StringIO(base64.b64encode('file contents')))
             mock_open.return_value = mock_file_obj
@@ -105,6 +194,21 @@ class TestPaste(util.testing.DatabaseTestCase):
             self.assertEqual('file contents', resp.get_data())
             self.assertEqual(200, resp.status_code)
 
+        # Attachment stored inline in the database
+        attachment.is_raw = True
+        attachment.data = 'inline contents'
+        with mock.patch('__builtin__.open') as mock_open:
+            resp = views.paste.paste_attachment(util.cryptography.get_id_repr(paste.paste_id), attachment.file_name)
+            self.assertEqual(0, mock_open.call_count)
+            resp.direct_passthrough = False
+            self.assertEqual('inline contents', resp.get_data())
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual('image/png', resp.mimetype)
+            self.assertEqual(
+                '"{digest}"'.format(digest=hashlib.sha256('inline contents').hexdigest()),
+                resp.headers['ETag'],
+            )
+
         # Undefined server error
         with mock.patch.object(database.attachment, 'get_attachment_by_name') as mock_get_attachment:
             mock_get_attachment.side_effect = Exception
@@ -115,5 +219,71 @@ class TestPaste(util.testing.DatabaseTestCase):
             )
             self.assertEqual(500, resp[1])
 
+    def test_paste_attachments_archive(self):
+        # Non-existent paste
+        resp = views.paste.paste_attachments_archive(util.cryptography.get_id_repr(10))
+        self.assertEqual(404, resp[1])
+
+        attachments_dir = config.ATTACHMENTS_DIR
+        config.ATTACHMENTS_DIR = tempfile.mkdtemp()
+        config.ATTACHMENT_INLINE_MAX_FILE_SIZE = 100
+        try:
+            paste = util.testing.PasteFactory.generate(password='password')
+            image_data = os.urandom(1000)
+            for file_name, mime_type, data in [
+                ('small.txt', 'text/plain', 'small file'),
+                ('image.png', 'image/png', image_data),
+                ('large.txt', 'text/plain', 'large file ' * 100),
+            ]:
+                database.attachment.create_new_attachment(
+                    paste_id=paste.paste_id,
+                    file_name=file_name,
+                    file_size=len(data),
+                    mime_type=mime_type,
+                    file_data=base64.b64encode(data),
+                )
+
+            # Password-protected, no password supplied
+            resp = views.paste.paste_attachments_archive(util.cryptography.get_id_repr(paste.paste_id))
+            self.assertIn('you must supply the password', resp[0])
+            self.assertEqual(401, resp[1])
+
+            # Password-protected, wrong password supplied
+            flask.request.args = {'password': 'invalid'}
+            resp = views.paste.paste_attachments_archive(util.cryptography.get_id_repr(paste.paste_id))
+            self.assertEqual(403, resp[1])
+
+            # Password-protected, correct password supplied
+            flask.request.args = {'password': 'password'}
+            resp = views.paste.paste_attachments_archive(util.cryptography.get_id_repr(paste.paste_id))
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual('application/zip', resp.mimetype)
+            self.assertIn('attachments.zip', resp.headers['Content-Disposition'])
+            archive_data = resp.get_data()
+            archive = zipfile.ZipFile(StringIO.StringIO(archive_data))
+            self.assertIsNone(archive.testzip())
+            self.assertEqual('small file', archive.read('small.txt'))
+            self.assertEqual(image_data, archive.read('image.png'))
+            self.assertEqual('large file ' * 100, archive.read('large.txt'))
+            # Already-compressed types are stored as they are
+            self.assertEqual(zipfile.ZIP_STORED, archive.getinfo('image.png').compress_type)
+            self.assertEqual(zipfile.ZIP_DEFLATED, archive.getinfo('large.txt').compress_type)
+            # The stated file sizes are not trusted, so entries are written with ZIP64 sizes (version needed 4.5)
+            self.assertEqual(45, struct.unpack('<H', archive_data[4:6])[0])
+
+            # Paste without attachments
+            other_paste = util.testing.PasteFactory.generate(password=None)
+            resp = views.paste.paste_attachments_archive(util.cryptography.get_id_repr(other_paste.paste_id))
+            self.assertEqual(404, resp[1])
+
+            # Deactivated paste
+            database.paste.deactivate_paste(paste.paste_id)
+            resp = views.paste.paste_attachments_archive(util.cryptography.get_id_repr(paste.paste_id))
+            self.assertIn('No paste with the given ID could be found', resp[0])
+            self.assertEqual(404, resp[1])
+        finally:
+            shutil.rmtree(config.ATTACHMENTS_DIR)
+            config.ATTACHMENTS_DIR = attachments_dir
+
     def test_paste_archive(self):
         self.assertIsNotNone(views.paste.paste_archive())